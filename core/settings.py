@@ -14,6 +14,56 @@ SECRET_KEY = 'e99zf4+9(%@@6mw^=t#w*b1%&(gfeh^b=3fp5o)(uti&lauq06'
 
 STRIPE_SECRET_KEY = 'sk_test_WxXNQZbVYFQdabJOXvDBZh0F00Hfu4Nmnp'
 
+# Payments are charged by the payment worker (manage.py process_payments)
+
+# use 'ecommerce.gateways.FakeGateway' to run checkouts locally without Stripe
+PAYMENT_GATEWAY = 'ecommerce.gateways.StripeGateway'
+
+# seconds after which a payment left processing by a dead worker is retried
+PAYMENT_INTENT_LEASE = 300
+
+# network and rate limit errors are retried up to this many attempts
+PAYMENT_INTENT_MAX_ATTEMPTS = 3
+
+# seconds the fake gateway waits per charge, to mimic Stripe's latency
+FAKE_PAYMENT_GATEWAY_DELAY = 0
+
+# Guest carts (ecommerce.guest_cart), merged into the user's cart on login
+
+GUEST_CART_COOKIE = 'cart'
+
+# seconds a guest cart is kept without any change
+GUEST_CART_MAX_AGE = 60 * 60 * 24 * 14
+
+# lines a guest cart can hold, to keep the cookie well under the 4KB limit
+GUEST_CART_MAX_LINES = 50
+
+# Order maintenance (manage.py cleanup_orders)
+
+# seconds a cart can stay untouched before it is deleted
+CART_IDLE_TTL = 60 * 60 * 24 * 30
+
+# seconds after their order date when received orders move to the archive table
+ORDER_ARCHIVE_AFTER = 60 * 60 * 24 * 365
+
+# Inventory
+
+# stock rows of each best seller selection, taken from at random by concurrent checkouts
+STOCK_SHARDS = 8
+
+# ASGI (core/asgi.py)
+
+# threads serving the read endpoints below, so at most this many hold a database connection
+ASGI_READ_THREADS = 32
+
+# GET requests under these paths skip the single thread of Django's ASGI handler
+ASGI_READ_PATHS = [
+    '/api/products/',
+    '/api/order-summary/',
+    '/api/country/list/',
+    '/api/user/id/'
+]
+
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
 
@@ -47,12 +97,14 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'ecommerce.middleware.RequestProfilingMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'ecommerce.middleware.GuestCartMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -89,6 +141,51 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/3.0/topics/cache/
+
+# point 'catalog' at a shared backend (memcached, redis) when running several workers
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # local memory cache evicts the least recently used entries past MAX_ENTRIES
+    'catalog': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'catalog',
+        'TIMEOUT': 60 * 60,
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000,
+        },
+    },
+}
+
+CATALOG_CACHE_ALIAS = 'catalog'
+
+
+# Product search and facets
+
+# 'ecommerce.search.InvertedIndexBackend' works on every database
+SEARCH_BACKEND = 'ecommerce.search.SQLiteFTSBackend'
+
+# ranked matches considered for paging and facet counts
+SEARCH_MAX_RESULTS = 1000
+
+# price buckets of the price facet, as (min, max) with max excluded; None is unbounded
+FACET_PRICE_RANGES = [(0, 100), (100, 500), (500, 1000), (1000, None)]
+
+
+# Image derivatives
+
+# widths (px) of the resized copies of product images, offered as srcset candidates
+IMAGE_DERIVATIVE_WIDTHS = [160, 320, 640, 1280]
+
+# build derivatives in a background thread pool after the upload is committed;
+# False builds them right after the commit, in the saving thread
+IMAGE_DERIVATIVES_ASYNC = True
+IMAGE_DERIVATIVE_WORKERS = 2
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
 
@@ -167,3 +264,14 @@ REST_FRAMEWORK = {
         'rest_framework.authentication.TokenAuthentication',
     ),
 }
+
+# Request profiling
+
+# per-request timing, query counts and Server-Timing headers (ecommerce.middleware)
+REQUEST_PROFILING_ENABLED = DEBUG
+
+# requests slower than this (ms) are logged as JSON to the 'ecommerce.profiling' logger
+REQUEST_PROFILING_SLOW_MS = 500
+
+# latest requests per route kept for the staff profiling endpoint
+REQUEST_PROFILING_WINDOW = 1000
@@ -1,30 +1,152 @@
 from django.contrib import admin
-from .models import Item, OrderItem, Order, Payment, Coupon, Refund, Address, UserProfile, Option, OptionValue
+from django.core.paginator import Paginator
+from django.db import DatabaseError, connection, transaction
+from django.utils.functional import cached_property
+
+from .models import Item, OrderItem, Order, Payment, Coupon, Refund, Address, UserProfile, Option, OptionValue, Stock
+
+
+# rows updated per statement by the bulk actions
+ACTION_BATCH_SIZE = 1000
+
+
+def estimate_row_count(model):
+    # the planner statistics of the table, or None when the database has none
+    table = model._meta.db_table
+    queries = {
+        'postgresql': 'SELECT reltuples::bigint FROM pg_class WHERE relname = %s',
+        'mysql': 'SELECT table_rows FROM information_schema.tables '
+                 'WHERE table_schema = DATABASE() AND table_name = %s',
+        # filled by ANALYZE
+        'sqlite': 'SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1'
+    }
+    if connection.vendor not in queries:
+        return None
+
+    try:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(queries[connection.vendor], [table])
+            row = cursor.fetchone()
+
+    except DatabaseError:
+        return None
+
+    if row is None or row[0] is None:
+        return None
+    return int(str(row[0]).split()[0])
+
+
+class EstimatedCountPaginator(Paginator):
+    # COUNT(*) reads the whole table: unfiltered changelists of large tables use the
+    # planner estimate, filtered ones count at most count_limit rows
+    count_limit = 10000
+
+    @cached_property
+    def count(self):
+        if not self.object_list.query.where:
+            estimate = estimate_row_count(self.object_list.model)
+            if estimate is not None and estimate >= self.count_limit:
+                return estimate
+
+        return self.object_list[:self.count_limit].count()
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    # skip the second, unfiltered COUNT(*) behind "x of y selected"
+    show_full_result_count = False
+
+
+def update_in_batches(queryset, **values):
+    # short UPDATEs by primary key range instead of one statement locking the selection
+    pks = queryset.order_by('pk').values_list('pk', flat=True)
+    last_pk = None
+    updated = 0
+
+    while True:
+        batch = pks if last_pk is None else pks.filter(pk__gt=last_pk)
+        batch = list(batch[:ACTION_BATCH_SIZE])
+        if not batch:
+            return updated
+
+        with transaction.atomic():
+            updated += queryset.model.objects.filter(
+                pk__in=batch).update(**values)
+        last_pk = batch[-1]
 
 
 # create custom action
 def make_refund_accepted(modeladmin, request, queryset):
-    queryset.update(refund_requested=False, refund_granted=True)
+    updated = update_in_batches(
+        queryset, refund_requested=False, refund_granted=True)
+    modeladmin.message_user(request, f'{updated} orders updated')
 
 
 make_refund_accepted.short_description = 'Update orders to refund granted'
 
 
 def make_being_delivered(modeladmin, request, queryset):
-    queryset.update(being_delivered=True)
+    updated = update_in_batches(queryset, being_delivered=True)
+    modeladmin.message_user(request, f'{updated} orders updated')
 
 
 make_being_delivered.short_description = 'Update orders to being delivered'
 
 
 def make_order_received(modeladmin, request, queryset):
-    queryset.update(being_delivered=False, received=True)
+    updated = update_in_batches(
+        queryset, being_delivered=False, received=True)
+    modeladmin.message_user(request, f'{updated} orders updated')
 
 
 make_order_received.short_description = 'Update orders to received'
 
 
-class OrderAdmin(admin.ModelAdmin):
+class ItemAdmin(admin.ModelAdmin):
+    list_display = [
+        'title',
+        'slug',
+        'category',
+        'label',
+        'price',
+        'discount_price'
+    ]
+    list_filter = [
+        'category',
+        'label'
+    ]
+    search_fields = [
+        'title',
+        'slug'
+    ]
+
+
+class OrderItemAdmin(LargeTableAdmin):
+    list_display = [
+        '__str__',
+        'user',
+        'ordered',
+        'quantity'
+    ]
+    list_select_related = [
+        'item',
+        'user'
+    ]
+    list_filter = [
+        'ordered'
+    ]
+    search_fields = [
+        'user__username',
+        'item__title'
+    ]
+    autocomplete_fields = [
+        'user',
+        'item',
+        'item_options'
+    ]
+
+
+class OrderAdmin(LargeTableAdmin):
     list_display = [
         'user',
         'ordered',
@@ -44,6 +166,14 @@ class OrderAdmin(admin.ModelAdmin):
         'payment',
         'coupon'
     ]
+    # the __str__ of the addresses and the payment show their user too
+    list_select_related = [
+        'user',
+        'billing_address__user',
+        'shipping_address__user',
+        'payment__user',
+        'coupon'
+    ]
     list_filter = [
         'being_delivered',
         'received',
@@ -54,6 +184,22 @@ class OrderAdmin(admin.ModelAdmin):
         'user__username',
         'ref_code'
     ]
+    autocomplete_fields = [
+        'user',
+        'items',
+        'billing_address',
+        'shipping_address',
+        'payment',
+        'coupon'
+    ]
+    # kept up to date by the cart service
+    readonly_fields = [
+        'subtotal',
+        'discount',
+        'coupon_amount',
+        'total',
+        'line_count'
+    ]
     actions = [
         make_refund_accepted,
         make_being_delivered,
@@ -61,7 +207,72 @@ class OrderAdmin(admin.ModelAdmin):
     ]
 
 
-class AddressAdmin(admin.ModelAdmin):
+class PaymentAdmin(LargeTableAdmin):
+    list_display = [
+        'user',
+        'stripe_charge_id',
+        'amount',
+        'timestamp'
+    ]
+    list_select_related = [
+        'user'
+    ]
+    search_fields = [
+        'user__username',
+        'stripe_charge_id'
+    ]
+    autocomplete_fields = [
+        'user'
+    ]
+
+
+class CouponAdmin(admin.ModelAdmin):
+    list_display = [
+        'code',
+        'kind',
+        'amount',
+        'minimum_spend',
+        'category',
+        'max_uses',
+        'used',
+        'active'
+    ]
+    list_filter = [
+        'kind',
+        'active'
+    ]
+    search_fields = [
+        'code'
+    ]
+    # kept by ecommerce.coupons as carts take and give back uses
+    readonly_fields = [
+        'used'
+    ]
+
+
+class RefundAdmin(LargeTableAdmin):
+    list_display = [
+        '__str__',
+        'order',
+        'accepted',
+        'email'
+    ]
+    list_select_related = [
+        'order__user'
+    ]
+    list_filter = [
+        'accepted'
+    ]
+    search_fields = [
+        'order__ref_code',
+        'email'
+    ]
+    autocomplete_fields = [
+        'order'
+    ]
+
+
+class AddressAdmin(LargeTableAdmin):
     list_display = [
         'user',
         'street_address',
@@ -71,17 +282,39 @@ class AddressAdmin(admin.ModelAdmin):
         'address_type',
         'default'
     ]
+    list_select_related = [
+        'user'
+    ]
     list_filter = [
         'default',
         'address_type',
         'country'
     ]
     search_fields = [
-        'user',
+        'user__username',
         'street_address',
         'apartment_address',
         'zip'
     ]
+    autocomplete_fields = [
+        'user'
+    ]
+
+
+class UserProfileAdmin(LargeTableAdmin):
+    list_display = [
+        'user',
+        'one_click_purchasing'
+    ]
+    list_select_related = [
+        'user'
+    ]
+    search_fields = [
+        'user__username'
+    ]
+    autocomplete_fields = [
+        'user'
+    ]
 
 
 class OptionValueAdmin(admin.ModelAdmin):
@@ -91,12 +324,17 @@ class OptionValueAdmin(admin.ModelAdmin):
         'additional_price',
         'attachment'
     ]
-    list_filter = [
-        'option',
-        'option__item'
+    list_select_related = [
+        'option'
     ]
+    # an option or item list filter would render every row of the catalog
     search_fields = [
-        'value'
+        'value',
+        'option__name',
+        'option__item__title'
+    ]
+    autocomplete_fields = [
+        'option'
     ]
 
 
@@ -110,22 +348,46 @@ class OptionAdmin(admin.ModelAdmin):
         'item',
         'name'
     ]
-    list_filter = [
+    list_select_related = [
         'item'
     ]
     search_fields = [
-        'name'
+        'name',
+        'item__title'
+    ]
+    autocomplete_fields = [
+        'item'
     ]
     inlines = [OptionValueInlineAdmin]
 
 
-admin.site.register(Item)
+class StockAdmin(LargeTableAdmin):
+    list_display = [
+        'item',
+        'option_signature',
+        'shard',
+        'quantity'
+    ]
+    list_select_related = [
+        'item'
+    ]
+    search_fields = [
+        'item__title',
+        'item__slug'
+    ]
+    autocomplete_fields = [
+        'item'
+    ]
+
+
+admin.site.register(Item, ItemAdmin)
 admin.site.register(Option, OptionAdmin)
 admin.site.register(OptionValue, OptionValueAdmin)
-admin.site.register(OrderItem)
+admin.site.register(OrderItem, OrderItemAdmin)
 admin.site.register(Order, OrderAdmin)
-admin.site.register(Payment)
-admin.site.register(Coupon)
-admin.site.register(Refund)
+admin.site.register(Payment, PaymentAdmin)
+admin.site.register(Coupon, CouponAdmin)
+admin.site.register(Refund, RefundAdmin)
 admin.site.register(Address, AddressAdmin)
-admin.site.register(UserProfile)
+admin.site.register(UserProfile, UserProfileAdmin)
+admin.site.register(Stock, StockAdmin)
@@ -0,0 +1,17 @@
+from rest_framework.pagination import CursorPagination
+
+
+class ItemCursorPagination(CursorPagination):
+    # keyset pagination on the primary key, so deep pages cost the same as the first one
+    ordering = 'id'
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+class PaymentCursorPagination(CursorPagination):
+    # newest first; the id breaks ties between payments of the same timestamp
+    ordering = ('-timestamp', '-id')
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
@@ -1,6 +1,7 @@
 from rest_framework import serializers
 from django_countries.serializer_fields import CountryField
 
+from ecommerce.images import get_srcset
 from ecommerce.models import Address, Item, Order, OrderItem, Coupon, Option, OptionValue, Payment
 
 
@@ -14,13 +15,17 @@ class CouponSerializer(serializers.ModelSerializer):
         fields = [
             'id',
             'code',
-            'amount'
+            'kind',
+            'amount',
+            'minimum_spend',
+            'category'
         ]
 
 
 class ItemSerializer(serializers.ModelSerializer):
     category = serializers.SerializerMethodField()
     label = serializers.SerializerMethodField()
+    image_srcset = serializers.SerializerMethodField()
 
     class Meta:
         model = Item
@@ -34,7 +39,8 @@ class ItemSerializer(serializers.ModelSerializer):
             'slug',
             'short_description',
             'long_description',
-            'image'
+            'image',
+            'image_srcset'
         ]
 
     def get_category(self, obj):
@@ -43,6 +49,18 @@ class ItemSerializer(serializers.ModelSerializer):
     def get_label(self, obj):
         return obj.get_label_display()
 
+    def get_image_srcset(self, obj):
+        return get_srcset(obj.image_hash)
+
+
+class ItemSummarySerializer(ItemSerializer):
+    # sparse representation for the product grid
+    class Meta(ItemSerializer.Meta):
+        fields = [
+            field for field in ItemSerializer.Meta.fields
+            if field != 'long_description'
+        ]
+
 
 class OptionSerializer(serializers.ModelSerializer):
     item_options = serializers.SerializerMethodField()
@@ -60,6 +78,8 @@ class OptionSerializer(serializers.ModelSerializer):
 
 
 class OptionValueSerializer(serializers.ModelSerializer):
+    attachment_srcset = serializers.SerializerMethodField()
+
     class Meta:
         model = OptionValue
         fields = [
@@ -67,13 +87,18 @@ class OptionValueSerializer(serializers.ModelSerializer):
             'value',
             'additional_price',
             'default',
-            'attachment'
+            'attachment',
+            'attachment_srcset'
         ]
 
+    def get_attachment_srcset(self, obj):
+        return get_srcset(obj.attachment_hash)
+
 
 class ItemDetailSerializer(serializers.ModelSerializer):
     category = serializers.SerializerMethodField()
     label = serializers.SerializerMethodField()
+    image_srcset = serializers.SerializerMethodField()
     options = serializers.SerializerMethodField()
 
     class Meta:
@@ -89,6 +114,7 @@ class ItemDetailSerializer(serializers.ModelSerializer):
             'short_description',
             'long_description',
             'image',
+            'image_srcset',
             'options'
         ]
 
@@ -98,6 +124,9 @@ class ItemDetailSerializer(serializers.ModelSerializer):
     def get_label(self, obj):
         return obj.get_label_display()
 
+    def get_image_srcset(self, obj):
+        return get_srcset(obj.image_hash)
+
     def get_options(self, obj):
         return OptionSerializer(obj.option_set.all(), many=True).data
 
@@ -113,6 +142,7 @@ class OptionDetailSerializer(serializers.ModelSerializer):
 
 class OptionValueDetailSerializer(serializers.ModelSerializer):
     option = serializers.SerializerMethodField()
+    attachment_srcset = serializers.SerializerMethodField()
 
     class Meta:
         model = OptionValue
@@ -122,12 +152,16 @@ class OptionValueDetailSerializer(serializers.ModelSerializer):
             'value',
             'additional_price',
             'default',
-            'attachment'
+            'attachment',
+            'attachment_srcset'
         ]
 
     def get_option(self, obj):
         return OptionDetailSerializer(obj.option).data
 
+    def get_attachment_srcset(self, obj):
+        return get_srcset(obj.attachment_hash)
+
 
 class OrderItemSerializer(serializers.ModelSerializer):
     # item = StringSerializer()
@@ -181,6 +215,35 @@ class OrderSerializer(serializers.ModelSerializer):
         return None
 
 
+class GuestLineSerializer(serializers.Serializer):
+    # an unsaved line of ecommerce.guest_cart.GuestCart.get_lines()
+    id = serializers.CharField(source='key')
+    item = ItemSerializer()
+    item_options = OptionValueDetailSerializer(source='options', many=True)
+    quantity = serializers.IntegerField()
+    final_price = serializers.FloatField(source='get_final_price')
+
+
+class GuestCartSerializer(serializers.Serializer):
+    # same shape as OrderSerializer
+    id = serializers.SerializerMethodField()
+    order_items = serializers.SerializerMethodField()
+    total = serializers.SerializerMethodField()
+    coupon = serializers.SerializerMethodField()
+
+    def get_id(self, obj):
+        return None
+
+    def get_order_items(self, obj):
+        return GuestLineSerializer(obj.get_lines(), many=True).data
+
+    def get_total(self, obj):
+        return obj.get_total()
+
+    def get_coupon(self, obj):
+        return None
+
+
 class PaymentSerializer(serializers.ModelSerializer):
     order = serializers.SerializerMethodField()
 
@@ -194,7 +257,11 @@ class PaymentSerializer(serializers.ModelSerializer):
         ]
 
     def get_order(self, obj):
-        return OrderSerializer(obj.order_set.all()).data
+        # a payment settles one order; list() keeps to the prefetched orders
+        orders = list(obj.order_set.all())
+        if not orders:
+            return None
+        return OrderSerializer(orders[0]).data
 
 
 class AddressSerializer(serializers.ModelSerializer):
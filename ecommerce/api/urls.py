@@ -1,13 +1,15 @@
 from django.urls import path
-from ecommerce.api.views.products import ItemListView, ItemDetailView, AddToCartView, SubtractItemQuantityView
-from ecommerce.api.views.orders import OrderDetailView, OrderItemDeleteView
-from ecommerce.api.views.payments import PaymentView, PaymentListView
+from ecommerce.api.views.products import ItemListView, ItemSearchView, ItemFacetView, ItemDetailView, AddToCartView, SubtractItemQuantityView
+from ecommerce.api.views.orders import CartView, OrderDetailView, OrderItemDeleteView, OrderExportView
+from ecommerce.api.views.payments import PaymentView, PaymentStatusView, PaymentListView
 from ecommerce.api.views.addresses import AddressListView, AddressCreateView, AddressUpdateView, AddressDeleteView
-from ecommerce.api.views.views import UserIDView, AddCouponView, CountryListView
+from ecommerce.api.views.views import UserIDView, AddCouponView, CountryListView, CatalogCacheStatsView, RequestProfilingView
 
 
 urlpatterns = [
     path('products/', ItemListView.as_view(), name='product-list'),
+    path('products/search/', ItemSearchView.as_view(), name='product-search'),
+    path('products/facets/', ItemFacetView.as_view(), name='product-facets'),
     path('products/<pk>/', ItemDetailView.as_view(), name='product-detail'),
     path('add-to-cart/', AddToCartView.as_view(), name='add-to-cart'),
     path('order-item/subtract/',
@@ -15,7 +17,10 @@ urlpatterns = [
     path('order-item/<pk>/delete/',
          OrderItemDeleteView.as_view(), name='order-item-delete'),
     path('order-summary/', OrderDetailView.as_view(), name='order-summary'),
+    path('cart/', CartView.as_view(), name='cart'),
+    path('orders/export/', OrderExportView.as_view(), name='order-export'),
     path('checkout/', PaymentView.as_view(), name='checkout'),
+    path('checkout/<key>/', PaymentStatusView.as_view(), name='checkout-status'),
     path('payments/', PaymentListView.as_view(), name='payment-list'),
     path('add-coupon/', AddCouponView.as_view(), name='add-coupon'),
     path('address/list/', AddressListView.as_view(), name='address-list'),
@@ -23,5 +28,8 @@ urlpatterns = [
     path('address/<pk>/update/', AddressUpdateView.as_view(), name='address-update'),
     path('address/<pk>/delete/', AddressDeleteView.as_view(), name='address-delete'),
     path('country/list/', CountryListView.as_view(), name='country-list'),
-    path('user/id/', UserIDView.as_view(), name='user-id')
+    path('user/id/', UserIDView.as_view(), name='user-id'),
+    path('catalog/cache-stats/', CatalogCacheStatsView.as_view(),
+         name='catalog-cache-stats'),
+    path('profiling/', RequestProfilingView.as_view(), name='request-profiling')
 ]
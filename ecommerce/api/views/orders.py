@@ -1,21 +1,37 @@
 from rest_framework.generics import DestroyAPIView, RetrieveAPIView
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import AllowAny, IsAdminUser
+from rest_framework.response import Response
+from rest_framework.status import HTTP_204_NO_CONTENT, HTTP_400_BAD_REQUEST, HTTP_404_NOT_FOUND
+from rest_framework.views import APIView
 
-from django.http import Http404
+from django.http import Http404, StreamingHttpResponse
 from django.core.exceptions import ObjectDoesNotExist
 
-from ecommerce.models import Order, OrderItem
-from ecommerce.api.serializers import OrderSerializer
+from ecommerce.cart import CartError, parse_operations, remove_line, update_cart
+from ecommerce.models import Order
+from ecommerce.order_export import FORMATS, get_orders, parse_bound, stream_orders
+from ecommerce.api.serializers import GuestCartSerializer, OrderSerializer
 
 
 class OrderDetailView(RetrieveAPIView):
     serializer_class = OrderSerializer
-    permission_classes = [IsAuthenticated]
+    permission_classes = [AllowAny]
+
+    def retrieve(self, request, *args, **kwargs):
+        # visitors get the cart of their cookie in the same shape
+        if not request.user.is_authenticated:
+            guest_cart = request.guest_cart
+            if not guest_cart.lines:
+                raise Http404('You do not have an active order.')
+            return Response(GuestCartSerializer(guest_cart).data)
+
+        return super().retrieve(request, *args, **kwargs)
 
     # fetching the queryset
     def get_object(self):
         try:
-            order = Order.objects.get(user=self.request.user, ordered=False)
+            order = Order.objects.with_items().get(
+                user=self.request.user, ordered=False)
             return order
 
         except ObjectDoesNotExist:
@@ -23,5 +39,74 @@ class OrderDetailView(RetrieveAPIView):
 
 
 class OrderItemDeleteView(DestroyAPIView):
-    permission_classes = [IsAuthenticated]
-    queryset = OrderItem.objects.all()
+    permission_classes = [AllowAny]
+
+    # only lines of the user's open order can be deleted, keeping its totals in step;
+    # the lines of a guest cart are identified by their key
+    def destroy(self, request, *args, **kwargs):
+        try:
+            if request.user.is_authenticated:
+                remove_line(request.user, self.kwargs['pk'])
+            else:
+                request.guest_cart.remove_key(self.kwargs['pk'])
+
+        except CartError as e:
+            return Response({'message': str(e)}, status=HTTP_404_NOT_FOUND)
+
+        return Response(status=HTTP_204_NO_CONTENT)
+
+
+class CartView(APIView):
+    # PATCH {"operations": [{"op": "add", "slug", "options", "quantity"},
+    # {"op": "set", "line", "quantity"}, {"op": "remove", "line"}]}, applied all or
+    # nothing; the response is the updated cart
+    permission_classes = [AllowAny]
+
+    def patch(self, request, *args, **kwargs):
+        try:
+            operations = parse_operations(request.data.get('operations'))
+
+            if request.user.is_authenticated:
+                order = update_cart(request.user, operations)
+            else:
+                request.guest_cart.update(operations)
+
+        except CartError as e:
+            return Response({'message': str(e)}, status=HTTP_400_BAD_REQUEST)
+
+        if not request.user.is_authenticated:
+            return Response(GuestCartSerializer(request.guest_cart).data)
+
+        order = Order.objects.with_items().get(pk=order.pk)
+        return Response(OrderSerializer(order).data)
+
+
+class OrderExportView(APIView):
+    # ?output=csv|jsonl&since=&until=&include_open=1, streamed one order at a time
+    permission_classes = [IsAdminUser]
+    content_types = {
+        'csv': 'text/csv',
+        'jsonl': 'application/x-ndjson'
+    }
+
+    def get(self, request, *args, **kwargs):
+        file_format = request.query_params.get('output', 'csv')
+        if file_format not in FORMATS:
+            return Response({'message': f'Unknown output {file_format!r}'}, status=HTTP_400_BAD_REQUEST)
+
+        since = request.query_params.get('since', None)
+        until = request.query_params.get('until', None)
+
+        try:
+            since = parse_bound(since) if since else None
+            until = parse_bound(until) if until else None
+        except ValueError as e:
+            return Response({'message': str(e)}, status=HTTP_400_BAD_REQUEST)
+
+        include_open = request.query_params.get('include_open', '') in ('1', 'true')
+        response = StreamingHttpResponse(
+            stream_orders(get_orders(since, until, include_open), file_format),
+            content_type=self.content_types[file_format]
+        )
+        response['Content-Disposition'] = f'attachment; filename="orders.{file_format}"'
+        return response
@@ -1,114 +1,76 @@
+from rest_framework.exceptions import ValidationError
 from rest_framework.views import APIView
 from rest_framework.generics import ListAPIView
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
-from rest_framework.status import HTTP_200_OK, HTTP_400_BAD_REQUEST
+from rest_framework.status import HTTP_200_OK, HTTP_202_ACCEPTED, HTTP_400_BAD_REQUEST
 
-from django.conf import settings
+from django.db.models import Prefetch
+from django.shortcuts import get_object_or_404
 
-from ecommerce.models import Order, UserProfile, Address, Payment
+from ecommerce.cart import CartError
+from ecommerce.checkout import create_payment_intent, get_intent_status
+from ecommerce.models import Order, Payment, PaymentIntent
+from ecommerce.order_export import parse_bound
+from ecommerce.api.pagination import PaymentCursorPagination
 from ecommerce.api.serializers import PaymentSerializer
 
-import stripe
-
-stripe.api_key = settings.STRIPE_SECRET_KEY
-
 
 class PaymentView(APIView):
+    # records the checkout and returns at once; poll PaymentStatusView for the result
     def post(self, request, *args, **kwargs):
-        order = Order.objects.get(user=self.request.user, ordered=False)
-        userprofile = UserProfile.objects.get(user=self.request.user)
-        token = request.data.get('stripeToken')
-        billing_address_id = request.data.get('defaultBillingAddress')
-        shipping_address_id = request.data.get('defaultShippingAddress')
-        billing_address = Address.objects.get(id=billing_address_id)
-        shipping_address = Address.objects.get(id=shipping_address_id)
-
-        # if stripe id already exists
-        if userprofile.stripe_customer_id != '' and userprofile.stripe_customer_id is not None:
-            customer = stripe.Customer.retrieve(
-                userprofile.stripe_customer_id)
-            customer.sources.create(source=token)
-
-        # if stripe id doesn't exist
-        else:
-            customer = stripe.Customer.create(
-                email=self.request.user.email,
-            )
-            customer.sources.create(source=token)
-            userprofile.stripe_customer_id = customer['id']
-            userprofile.one_click_purchasing = True
-            userprofile.save()
-
-        amount = int(order.get_total() * 100)
-
         try:
-            # charge the customer because we cannot charge the token more than once
-            charge = stripe.Charge.create(
-                amount=amount,  # cents
-                currency="usd",
-                customer=userprofile.stripe_customer_id
+            intent = create_payment_intent(
+                request.user,
+                request.data.get('stripeToken'),
+                billing_address_id=request.data.get('defaultBillingAddress'),
+                shipping_address_id=request.data.get('defaultShippingAddress'),
+                save_card=True,
+                idempotency_key=request.META.get('HTTP_IDEMPOTENCY_KEY')
             )
 
-            # create the payment
-            payment = Payment(
-                stripe_charge_id=charge['id'],
-                user=self.request.user,
-                amount=order.get_total()
-            )
-            payment.save()
-
-            # assign the payment to the order
-            order_items = order.items.all()
-            order_items.update(ordered=True)
-            for item in order_items:
-                item.save()
+        except CartError as e:
+            return Response({"message": str(e)}, status=HTTP_400_BAD_REQUEST)
 
-            order.ordered = True
-            order.payment = payment
-            order.billing_address = billing_address
-            order.shipping_address = shipping_address
-            order.save()
+        return Response(get_intent_status(intent), status=HTTP_202_ACCEPTED)
 
-            return Response(status=HTTP_200_OK)
 
-        except stripe.error.CardError as e:
-            body = e.json_body
-            err = body.get('error', {})
-            return Response({"message": f"{err.get('message')}"}, status=HTTP_400_BAD_REQUEST)
-
-        except stripe.error.RateLimitError as e:
-            # Too many requests made to the API too quickly
-            return Response({"message": "Rate limit error"}, status=HTTP_400_BAD_REQUEST)
+class PaymentStatusView(APIView):
+    permission_classes = [IsAuthenticated]
 
-        except stripe.error.InvalidRequestError as e:
-            # Invalid parameters were supplied to Stripe's API
-            return Response({"message": "Invalid parameters"}, status=HTTP_400_BAD_REQUEST)
+    def get(self, request, *args, **kwargs):
+        intent = get_object_or_404(
+            PaymentIntent, idempotency_key=self.kwargs['key'], user=request.user)
+        return Response(get_intent_status(intent), status=HTTP_200_OK)
 
-        except stripe.error.AuthenticationError as e:
-            # Authentication with Stripe's API failed
-            # (maybe you changed API keys recently)
-            return Response({"message": "Not authenticated"}, status=HTTP_400_BAD_REQUEST)
 
-        except stripe.error.APIConnectionError as e:
-            # Network communication with Stripe failed
-            return Response({"message": "Network error"}, status=HTTP_400_BAD_REQUEST)
+class PaymentListView(ListAPIView):
+    # ?since=&until= (ISO dates) limit the payment timestamps, until being excluded
+    permission_classes = [IsAuthenticated]
+    serializer_class = PaymentSerializer
+    pagination_class = PaymentCursorPagination
 
-        except stripe.error.StripeError as e:
-            # Display a very generic error to the user, and maybe send
-            # yourself an email
-            return Response({"message": "Something went wrong. You were not charged. Please try again."}, status=HTTP_400_BAD_REQUEST)
+    def get_bound(self, name):
+        value = self.request.query_params.get(name, None)
+        if not value:
+            return None
 
-        except Exception as e:
-            # send an email to ourselves
-            return Response({"message": "A serious error occurred. We have been notifed."}, status=HTTP_400_BAD_REQUEST)
+        try:
+            return parse_bound(value)
+        except ValueError as e:
+            raise ValidationError({name: str(e)})
 
-        return Response({"message": "Invalid data received"}, status=HTTP_400_BAD_REQUEST)
+    def get_queryset(self):
+        queryset = Payment.objects.filter(user=self.request.user)
 
+        since = self.get_bound('since')
+        if since is not None:
+            queryset = queryset.filter(timestamp__gte=since)
 
-class PaymentListView(ListAPIView):
-    permission_classes = [IsAuthenticated]
-    serializer_class = PaymentSerializer
+        until = self.get_bound('until')
+        if until is not None:
+            queryset = queryset.filter(timestamp__lt=until)
 
-    def get_queryset(self):
-        return Payment.objects.filter(user=self.request.user)
+        # the orders of a page with their lines, items and options in a fixed number of queries
+        return queryset.prefetch_related(
+            Prefetch('order_set', queryset=Order.objects.with_items()))
@@ -2,25 +2,181 @@ from rest_framework.views import APIView
 from rest_framework.generics import ListAPIView, RetrieveAPIView
 from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
-from rest_framework.status import HTTP_200_OK, HTTP_400_BAD_REQUEST
+from rest_framework.utils.urls import replace_query_param
+from rest_framework.status import HTTP_200_OK, HTTP_304_NOT_MODIFIED, HTTP_400_BAD_REQUEST
 
+from django.conf import settings
+from django.db.models import Count
 from django.shortcuts import get_object_or_404
-from django.utils import timezone
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags, quote_etag
+
+from ecommerce.cart import CartError, add_to_cart, subtract_from_cart
+from ecommerce.catalog import get_catalog_version, get_cached
+from ecommerce.facets import filter_items, get_facet_counts, get_filters
+from ecommerce.models import CATEGORY_CHOICES, LABEL_CHOICES, Item
+from ecommerce.search import get_search_backend
+from ecommerce.api.pagination import ItemCursorPagination
+from ecommerce.api.serializers import ItemSerializer, ItemSummarySerializer, ItemDetailSerializer
+
+from collections import Counter
+import hashlib
+
+
+class CatalogETagMixin:
+    # answer conditional GETs from the catalog version without touching the database
+    def get_etag(self, request):
+        key = '{}:{}:{}'.format(
+            get_catalog_version(),
+            request.get_full_path(),
+            request.META.get('HTTP_ACCEPT', '')
+        )
+        return quote_etag(hashlib.md5(key.encode()).hexdigest())
+
+    def get(self, request, *args, **kwargs):
+        etag = self.get_etag(request)
+        if_none_match = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+
+        if etag in if_none_match or '*' in if_none_match:
+            response = Response(status=HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+            patch_vary_headers(response, ['Accept'])
+            return response
 
-from ecommerce.models import Item, OrderItem, Order, Option
-from ecommerce.api.serializers import ItemSerializer, ItemDetailSerializer
+        response = super().get(request, *args, **kwargs)
+        if response.status_code == HTTP_200_OK:
+            response['ETag'] = etag
+            # keeps the headers varied on by the middleware and DRF
+            patch_vary_headers(response, ['Accept'])
+        return response
+
+
+class ItemListView(CatalogETagMixin, ListAPIView):
+    permission_classes = [AllowAny]
+    pagination_class = ItemCursorPagination
+
+    def is_summary(self):
+        summary = self.request.query_params.get('summary', '')
+        return summary.lower() in ('1', 'true')
+
+    def get_serializer_class(self):
+        if self.is_summary():
+            return ItemSummarySerializer
+        return ItemSerializer
+
+    def get_queryset(self):
+        # category, label, price and option filters from the URL
+        queryset = filter_items(
+            Item.objects.all(), get_filters(self.request.query_params))
+
+        # don't load the long description when it is not rendered
+        if self.is_summary():
+            queryset = queryset.defer('long_description')
+
+        return queryset
+
+    def list(self, request, *args, **kwargs):
+        # pagination links are absolute, so the host is part of the key
+        data = get_cached(
+            'product-list',
+            request.build_absolute_uri(),
+            lambda: super(ItemListView, self).list(
+                request, *args, **kwargs).data
+        )
+        return Response(data)
 
 
-class ItemListView(ListAPIView):
+class ItemSearchView(CatalogETagMixin, ListAPIView):
+    permission_classes = [AllowAny]
+    serializer_class = ItemSummarySerializer
+    page_size = 20
+    max_page_size = 100
+
+    def list(self, request, *args, **kwargs):
+        data = get_cached('product-search', request.build_absolute_uri(),
+                          lambda: self.search(request))
+        return Response(data)
+
+    def get_page(self, request):
+        try:
+            page = max(int(request.query_params.get('page', 1)), 1)
+            page_size = min(
+                max(int(request.query_params.get('page_size', self.page_size)), 1), self.max_page_size)
+
+        except ValueError:
+            page, page_size = 1, self.page_size
+
+        return page, page_size
+
+    def search(self, request):
+        query = request.query_params.get('q', '')
+        filters = get_filters(request.query_params)
+        page, page_size = self.get_page(request)
+
+        # ranked ids from the index, then one query for the facets of every match
+        ranked_ids = get_search_backend().search(
+            query, settings.SEARCH_MAX_RESULTS)
+        matches = Item.objects.filter(pk__in=ranked_ids)
+        rows = list(matches.values_list('pk', 'category', 'label'))
+
+        category_counts = Counter(
+            item_category for pk, item_category, item_label in rows)
+        label_counts = Counter(
+            item_label for pk, item_category, item_label in rows)
+
+        # and one more to narrow them down when filters are selected
+        if filters:
+            selected = set(filter_items(matches, filters).values_list(
+                'pk', flat=True))
+        else:
+            selected = {pk for pk, item_category, item_label in rows}
+
+        ids = [pk for pk in ranked_ids if pk in selected]
+
+        page_ids = ids[(page - 1) * page_size:page * page_size]
+        items = Item.objects.defer('long_description').in_bulk(page_ids)
+        url = request.build_absolute_uri()
+
+        return {
+            'count': len(ids),
+            'next': replace_query_param(url, 'page', page + 1) if page * page_size < len(ids) else None,
+            'previous': replace_query_param(url, 'page', page - 1) if page > 1 else None,
+            'results': self.get_serializer([items[pk] for pk in page_ids], many=True).data,
+            'facets': {
+                'category': [
+                    {'value': value, 'name': name,
+                        'count': category_counts[value]}
+                    for value, name in CATEGORY_CHOICES if category_counts[value]
+                ],
+                'label': [
+                    {'value': value, 'name': name,
+                        'count': label_counts[value]}
+                    for value, name in LABEL_CHOICES if label_counts[value]
+                ]
+            }
+        }
+
+
+class ItemFacetView(CatalogETagMixin, ListAPIView):
+    # item counts of every facet value, for the filter sidebar
     permission_classes = [AllowAny]
-    serializer_class = ItemSerializer
-    queryset = Item.objects.all()
 
+    def list(self, request, *args, **kwargs):
+        return Response(get_facet_counts())
 
-class ItemDetailView(RetrieveAPIView):
+
+class ItemDetailView(CatalogETagMixin, RetrieveAPIView):
     permission_classes = [AllowAny]
     serializer_class = ItemDetailSerializer
-    queryset = Item.objects.all()
+    queryset = Item.objects.prefetch_related('option_set__optionvalue_set')
+
+    def retrieve(self, request, *args, **kwargs):
+        data = get_cached(
+            'product-detail',
+            self.kwargs['pk'],
+            lambda: super(ItemDetailView, self).retrieve(
+                request, *args, **kwargs).data
+        )
+        return Response(data)
 
 
 class AddToCartView(APIView):
@@ -30,84 +186,37 @@ class AddToCartView(APIView):
         if slug is None:
             return Response({'message': 'Invalid request.'}, status=HTTP_400_BAD_REQUEST)
 
-        item = get_object_or_404(Item, slug=slug)
+        item = get_object_or_404(
+            Item.objects.annotate(option_count=Count('option')), slug=slug)
 
-        # check if every option was selected
-        minimum_option_count = Option.objects.filter(item=item).count()
-        if len(options) < minimum_option_count:
-            return Response({'message': 'Please specify the required options.'}, status=HTTP_400_BAD_REQUEST)
-
-        order_item_queryset = OrderItem.objects.filter(
-            item=item,
-            user=request.user,
-            ordered=False
-        )
+        try:
+            if request.user.is_authenticated:
+                add_to_cart(request.user, item, options)
+            else:
+                request.guest_cart.add(item, options)
 
-        for option in options:
-            order_item_queryset = order_item_queryset.filter(
-                item_options__exact=option
-            )
+        except CartError as e:
+            return Response({'message': str(e)}, status=HTTP_400_BAD_REQUEST)
 
-        if order_item_queryset.exists():
-            order_item = order_item_queryset.first()
-            order_item.quantity += 1
-            order_item.save()
-        else:
-            order_item = OrderItem.objects.create(
-                item=item,
-                user=request.user,
-                ordered=False
-            )
-            order_item.item_options.add(*options)
-            order_item.save()
-
-        order_queryset = Order.objects.filter(user=request.user, ordered=False)
-        # if there is an active order
-        if order_queryset.exists():
-            order = order_queryset.first()
-
-            # if it is not in the order
-            if not order.items.filter(item__id=order_item.id).exists():
-                order.items.add(order_item)
-            return Response(status=HTTP_200_OK)
-
-        # if there is no active order
-        else:
-            ordered_date = timezone.now()
-            order = Order.objects.create(
-                user=request.user, ordered_date=ordered_date)
-            order.items.add(order_item)
-            return Response(status=HTTP_200_OK)
+        return Response(status=HTTP_200_OK)
 
 
 class SubtractItemQuantityView(APIView):
     def post(self, request, *args, **kwargs):
         slug = request.data.get('slug', None)
+        options = request.data.get('options', None)
         if slug is None:
             return Response({'message': 'Invalid data'}, status=HTTP_400_BAD_REQUEST)
 
         item = get_object_or_404(Item, slug=slug)
-        order_queryset = Order.objects.filter(user=request.user, ordered=False)
-
-        if order_queryset.exists():
-            order = order_queryset.first()
-            # check if the item exists in the order
-            if order.items.filter(item__slug=item.slug).exists():
-                order_item = OrderItem.objects.filter(
-                    item=item, user=request.user, ordered=False).first()
-
-                if order_item.quantity > 1:
-                    order_item.quantity -= 1
-                    order_item.save()
-
-                else:
-                    order.items.remove(order_item)
-                    order.save()
-
-                return Response({'message': 'This item quantity was updated.'}, status=HTTP_200_OK)
 
+        try:
+            if request.user.is_authenticated:
+                subtract_from_cart(request.user, item, options)
             else:
-                return Response({'message': 'This item was not in your cart.'}, status=HTTP_400_BAD_REQUEST)
+                request.guest_cart.subtract(item, options)
 
-        else:
-            return Response({'message': 'You do not have an active order.'}, status=HTTP_400_BAD_REQUEST)
+        except CartError as e:
+            return Response({'message': str(e)}, status=HTTP_400_BAD_REQUEST)
+
+        return Response({'message': 'This item quantity was updated.'}, status=HTTP_200_OK)
@@ -1,11 +1,16 @@
 from rest_framework.views import APIView
+from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
-from rest_framework.status import HTTP_200_OK, HTTP_400_BAD_REQUEST
+from rest_framework.status import HTTP_200_OK, HTTP_204_NO_CONTENT, HTTP_400_BAD_REQUEST
 
-from django.shortcuts import get_object_or_404
+from django.conf import settings
+from django.http import Http404
 from django_countries import countries
 
-from ecommerce.models import Order, Coupon
+from ecommerce.cart import CartError, apply_coupon
+from ecommerce.catalog import get_cache_stats
+from ecommerce.coupons import get_coupon
+from ecommerce.profiling import route_stats
 
 
 class UserIDView(APIView):
@@ -20,14 +25,40 @@ class AddCouponView(APIView):
         if code is None:
             return Response({'message': 'Invalid coupon code.'}, status=HTTP_400_BAD_REQUEST)
 
-        order = Order.objects.get(
-            user=request.user, ordered=False)
-        coupon = get_object_or_404(Coupon, code=code)
-        order.coupon = coupon
-        order.save()
+        coupon = get_coupon(code)
+        if coupon is None:
+            raise Http404('This coupon does not exist.')
+
+        try:
+            apply_coupon(request.user, coupon)
+
+        except CartError as e:
+            return Response({'message': str(e)}, status=HTTP_400_BAD_REQUEST)
+
         return Response({'message': 'Coupon successfully submitted.'}, status=HTTP_200_OK)
 
 
 class CountryListView(APIView):
     def get(self, request, *args, **kwargs):
         return Response(countries, status=HTTP_200_OK)
+
+
+class CatalogCacheStatsView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        return Response(get_cache_stats(), status=HTTP_200_OK)
+
+
+class RequestProfilingView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        return Response({
+            'enabled': settings.REQUEST_PROFILING_ENABLED,
+            'routes': route_stats.summary()
+        }, status=HTTP_200_OK)
+
+    def delete(self, request, *args, **kwargs):
+        route_stats.reset()
+        return Response(status=HTTP_204_NO_CONTENT)
@@ -1,5 +1,11 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class EcommerceConfig(AppConfig):
     name = 'ecommerce'
+
+    def ready(self):
+        # connect the search index, facet count, image derivative, guest cart and coupon signals
+        from . import coupons, facets, guest_cart, images, search
+        post_migrate.connect(search.create_search_table, sender=self)
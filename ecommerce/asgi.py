@@ -0,0 +1,46 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import django
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.db import close_old_connections
+
+
+class ReadPathASGIHandler(ASGIHandler):
+    # Django 3.0 has no async views or ORM, and its ASGI handler runs every request on
+    # one shared thread. GET requests of the read endpoints run in a bounded pool of
+    # threads instead: slow clients wait in the event loop, not in a thread, and at
+    # most ASGI_READ_THREADS requests touch the database at once
+    read_methods = ('GET', 'HEAD')
+
+    def __init__(self):
+        super().__init__()
+        self.executor = ThreadPoolExecutor(
+            max_workers=settings.ASGI_READ_THREADS, thread_name_prefix='asgi-read')
+
+    def is_read(self, request):
+        return request.method in self.read_methods and request.path_info.startswith(
+            tuple(settings.ASGI_READ_PATHS))
+
+    def get_read_response(self, request):
+        # each pool thread keeps its own connection, checked like a WSGI worker's
+        close_old_connections()
+        try:
+            return super().get_response(request)
+        finally:
+            close_old_connections()
+
+    async def get_response(self, request):
+        if self.is_read(request):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, self.get_read_response, request)
+
+        # everything else keeps Django's single thread
+        return await sync_to_async(super().get_response)(request)
+
+
+def get_asgi_application():
+    django.setup(set_prefix=False)
+    return ReadPathASGIHandler()
@@ -0,0 +1,63 @@
+import time
+
+from django.db import connection
+
+from ecommerce.checkout import claim_next_intent, create_payment_intent, finalize_order
+from ecommerce.profiling import QueryRecorder, percentile
+
+from .seed import fill_cart
+
+
+def run_finalization(catalog, cart_sizes, repeats, stdout=None):
+    # statements and DB time of finalize_order() for carts of growing size
+    results = {}
+    user = catalog.users[0]
+    address = catalog.addresses[user.pk]['B']
+
+    for cart_size in cart_sizes:
+        durations = []
+        db_durations = []
+        query_counts = []
+
+        for index in range(repeats):
+            fill_cart(catalog, catalog.rng, user, cart_size)
+            create_payment_intent(user, 'tok_visa', billing_address_id=address.pk)
+            intent = claim_next_intent()
+
+            recorder = QueryRecorder()
+            with connection.execute_wrapper(recorder):
+                start = time.perf_counter()
+                finalize_order(intent, f'ch_bench_{cart_size}_{index}')
+                durations.append((time.perf_counter() - start) * 1000)
+
+            db_durations.append(recorder.duration * 1000)
+            query_counts.append(recorder.count)
+
+        durations.sort()
+        db_durations.sort()
+        results[str(cart_size)] = {
+            'requests': repeats,
+            'latency_ms': {
+                'p50': round(percentile(durations, 50), 3),
+                'p95': round(percentile(durations, 95), 3)
+            },
+            'db_ms': {
+                'p50': round(percentile(db_durations, 50), 3),
+                'p95': round(percentile(db_durations, 95), 3)
+            },
+            'queries': {
+                'min': min(query_counts),
+                'max': max(query_counts),
+                'mean': round(sum(query_counts) / len(query_counts), 2)
+            }
+        }
+
+        if stdout is not None:
+            stdout.write('finalize {:>5} lines  p50 {:>8.2f} ms  db p50 {:>8.2f} ms  {:>3} queries'.format(
+                cart_size,
+                results[str(cart_size)]['latency_ms']['p50'],
+                results[str(cart_size)]['db_ms']['p50'],
+                results[str(cart_size)]['queries']['max']
+            ))
+
+    return results
@@ -0,0 +1,66 @@
+from django.db.models import F
+
+from ecommerce.cart import CartError, apply_coupon
+from ecommerce.coupons import get_coupon
+from ecommerce.models import Coupon, Order
+from ecommerce.profiling import percentile
+
+from .runner import run_concurrently
+
+
+def redeem_as(user, code):
+    return apply_coupon(user, get_coupon(code))
+
+
+def run_redemptions(catalog, threads, max_uses=None, stdout=None):
+    # every user applies the same code at once from its own thread and connection
+    code = 'RUSH' if max_uses is not None else 'RUSH-ALL'
+    Coupon.objects.create(code=code, amount=5.0, max_uses=max_uses)
+    Order.objects.filter(ordered=False).update(
+        coupon=None, coupon_amount=0, total=F('subtotal'))
+
+    users = catalog.users
+    outcomes, elapsed = run_concurrently(redeem_as, [(user, code) for user in users], threads)
+
+    latencies = sorted(duration for result, duration, retries in outcomes)
+    counts = {'redeemed': 0, 'rejected': 0, 'failed': 0}
+    for result, duration, retries in outcomes:
+        if isinstance(result, CartError):
+            counts['rejected'] += 1
+        elif isinstance(result, Exception):
+            counts['failed'] += 1
+        else:
+            counts['redeemed'] += 1
+
+    coupon = Coupon.objects.get(code=code)
+    holding = Order.objects.filter(ordered=False, coupon=coupon).count()
+    report = dict(counts, **{
+        'users': len(users),
+        'max_uses': max_uses,
+        'used': coupon.used,
+        'holding': holding,
+        # never more carts holding the code than its limit
+        'over_redeemed': max_uses is not None and holding > max_uses,
+        'retries': sum(retries for result, duration, retries in outcomes),
+        'throughput_rps': round(len(users) / elapsed, 1),
+        'latency_ms': {
+            'p50': round(percentile(latencies, 50), 3),
+            'p95': round(percentile(latencies, 95), 3)
+        }
+    })
+
+    if stdout is not None:
+        stdout.write('{:<8} {:>4} users  {:>8.1f} rps  p95 {:>8.2f} ms  redeemed {:>4}  rejected {:>4}  '
+                     'failed {:>3}  holding {:>4}'.format(
+                         code, len(users), report['throughput_rps'], report['latency_ms']['p95'],
+                         counts['redeemed'], counts['rejected'], counts['failed'], holding))
+
+    return report
+
+
+def run_coupon_scenario(catalog, threads, stdout=None):
+    # a code limited to half of the users, then one without a limit
+    return {
+        'limited': run_redemptions(catalog, threads, max(len(catalog.users) // 2, 1), stdout),
+        'unlimited': run_redemptions(catalog, threads, None, stdout)
+    }
@@ -0,0 +1,78 @@
+from django.db.models import Sum
+from django.test.utils import override_settings
+
+from ecommerce.cart import CartError, add_to_cart
+from ecommerce.checkout import PENDING, create_payment_intent
+from ecommerce.inventory import get_available, release_orders, set_stock
+from ecommerce.models import Item, Order, PaymentIntent, Reservation
+from ecommerce.profiling import percentile
+
+from .runner import run_concurrently
+
+
+def checkout_as(catalog, user):
+    return create_payment_intent(
+        user, 'tok_visa', billing_address_id=catalog.addresses[user.pk]['B'].pk)
+
+
+def run_checkouts(catalog, item, units, shards, threads, stdout=None):
+    # every user checks out the same best seller at once, with units for half of them
+    release_orders(list(Order.objects.filter(ordered=False).values_list('pk', flat=True)))
+    PaymentIntent.objects.filter(status=PENDING).delete()
+
+    with override_settings(STOCK_SHARDS=shards):
+        set_stock(item, [], units)
+
+    users = catalog.users
+    outcomes, elapsed = run_concurrently(
+        checkout_as, [(catalog, user) for user in users], threads)
+
+    latencies = sorted(duration for result, duration, retries in outcomes)
+    counts = {'reserved': 0, 'rejected': 0, 'failed': 0}
+    for result, duration, retries in outcomes:
+        if isinstance(result, CartError):
+            counts['rejected'] += 1
+        elif isinstance(result, Exception):
+            counts['failed'] += 1
+        else:
+            counts['reserved'] += 1
+
+    reserved = Reservation.objects.filter(stock__item=item).aggregate(
+        units=Sum('quantity'))['units'] or 0
+    report = dict(counts, **{
+        'users': len(users),
+        'units': units,
+        'shards': shards,
+        'reserved_units': reserved,
+        # reserved and available units always add up to the stock that was set
+        'oversold': reserved + get_available(item) != units or reserved > units,
+        'retries': sum(retries for result, duration, retries in outcomes),
+        'throughput_rps': round(len(users) / elapsed, 1),
+        'latency_ms': {
+            'p50': round(percentile(latencies, 50), 3),
+            'p95': round(percentile(latencies, 95), 3)
+        }
+    })
+
+    if stdout is not None:
+        stdout.write('{:>2} shards {:>4} users  {:>8.1f} rps  p95 {:>8.2f} ms  reserved {:>4}  '
+                     'rejected {:>4}  failed {:>3}  oversold {}'.format(
+                         shards, len(users), report['throughput_rps'], report['latency_ms']['p95'],
+                         counts['reserved'], counts['rejected'], counts['failed'], report['oversold']))
+
+    return report
+
+
+def run_inventory_scenario(catalog, threads, shards, stdout=None):
+    # one stock row against shards stock rows for the same best seller
+    item = Item.objects.create(
+        title='Benchmark best seller', slug='bench-best-seller', price=10.0,
+        category='P', label='B', short_description='short', long_description='long')
+    for user in catalog.users:
+        add_to_cart(user, item)
+
+    units = max(len(catalog.users) // 2, 1)
+    return {
+        str(count): run_checkouts(catalog, item, units, count, threads, stdout)
+        for count in sorted({1, shards})
+    }
@@ -0,0 +1,224 @@
+from ecommerce.cart import add_to_cart, get_open_order
+from ecommerce.checkout import create_payment_intent, process_pending_intents
+from ecommerce.gateways import FakeGateway
+from ecommerce.models import PAYMENT_IN_PROGRESS, Address, Order, PaymentIntent
+
+from .seed import fill_cart
+
+
+class Route:
+    # path and data are either constants or callables taking (catalog, user, context),
+    # where context is what prepare() returned before the (untimed) request
+    def __init__(self, name, method, path, data=None, auth='token', prepare=None, json=True):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.data = data
+        self.auth = auth
+        self.prepare = prepare
+        self.json = json
+
+    def build(self, catalog, user, context):
+        path = self.path(catalog, user, context) if callable(
+            self.path) else self.path
+        data = self.data(catalog, user, context) if callable(
+            self.data) else self.data
+        return path, data
+
+
+def settle_pending(user):
+    # a checkout in progress freezes the cart, charge it before changing the cart
+    if PaymentIntent.objects.filter(user=user, status__in=PAYMENT_IN_PROGRESS).exists():
+        process_pending_intents(FakeGateway())
+
+
+def ensure_cart(catalog, user):
+    settle_pending(user)
+    if get_open_order(user) is None:
+        fill_cart(catalog, catalog.rng, user, catalog.cart_lines)
+    return {}
+
+
+def settle_checkout(catalog, user):
+    # charge the previous checkout so every request starts a new one
+    process_pending_intents(FakeGateway())
+    return ensure_cart(catalog, user)
+
+
+def pick_item(catalog, user):
+    ensure_cart(catalog, user)
+    return {'item': catalog.rng.choice(catalog.items)}
+
+
+def add_line(catalog, user):
+    settle_pending(user)
+    item = catalog.rng.choice(catalog.items)
+    order_item, created = add_to_cart(
+        user, item, catalog.random_selection(catalog.rng, item))
+    return {'item': item, 'order_item': order_item}
+
+
+def start_checkout(catalog, user):
+    settle_checkout(catalog, user)
+    intent = create_payment_intent(
+        user, 'tok_visa', billing_address_id=catalog.addresses[user.pk]['B'].pk)
+    return {'intent': intent}
+
+
+def ensure_checkout(catalog, user):
+    settle_checkout(catalog, user)
+    Order.objects.filter(user=user, ordered=False).update(
+        billing_address=catalog.addresses[user.pk]['B'],
+        shipping_address=catalog.addresses[user.pk]['S']
+    )
+    return {}
+
+
+def create_address(catalog, user):
+    address = Address.objects.create(
+        user=user,
+        street_address='2 Benchmark Street',
+        apartment_address='Suite 2',
+        country='US',
+        zip='12345',
+        address_type='S'
+    )
+    return {'address': address}
+
+
+def last_ref_code(catalog, user):
+    order = Order.objects.filter(user=user, ordered=True).exclude(
+        ref_code=None).order_by('-pk').first()
+    return {'ref_code': order.ref_code}
+
+
+def address_form(catalog, user, context):
+    return {
+        'street_address': '3 Benchmark Street',
+        'apartment_address': 'Suite 3',
+        'country': 'US',
+        'zip': '54321',
+        'default': False
+    }
+
+
+def cart_operations(catalog, user, context):
+    item = catalog.rng.choice(catalog.items)
+    return {'operations': [
+        {'op': 'set', 'line': context['order_item'].pk, 'quantity': 2},
+        {'op': 'add', 'slug': item.slug, 'options': catalog.random_selection(catalog.rng, item)}
+    ]}
+
+
+def checkout_data(catalog, user, context):
+    return {
+        'stripeToken': 'tok_visa',
+        'defaultBillingAddress': catalog.addresses[user.pk]['B'].pk,
+        'defaultShippingAddress': catalog.addresses[user.pk]['S'].pk
+    }
+
+
+API_ROUTES = [
+    Route('api:product-list', 'get', '/api/products/', auth=None),
+    Route('api:product-list-summary', 'get',
+          '/api/products/?summary=1', auth=None),
+    Route('api:product-list-filtered', 'get',
+          '/api/products/?category=P&price=100-500&option=option-0:value-1', auth=None),
+    Route('api:product-search', 'get',
+          '/api/products/search/?q=product&label=D', auth=None),
+    Route('api:product-facets', 'get', '/api/products/facets/', auth=None),
+    Route('api:product-detail', 'get',
+          lambda catalog, user, context: f'/api/products/{catalog.rng.choice(catalog.items).pk}/',
+          auth=None),
+    Route('api:add-to-cart', 'post', '/api/add-to-cart/',
+          data=lambda catalog, user, context: {
+              'slug': context['item'].slug,
+              'options': catalog.random_selection(catalog.rng, context['item'])
+          },
+          prepare=pick_item),
+    Route('api:order-item-subtract', 'post', '/api/order-item/subtract/',
+          data=lambda catalog, user, context: {
+              'slug': context['item'].slug,
+              'options': [value.pk for value in context['order_item'].item_options.all()]
+          },
+          prepare=add_line),
+    Route('api:order-item-delete', 'delete',
+          lambda catalog, user, context: f'/api/order-item/{context["order_item"].pk}/delete/',
+          prepare=add_line),
+    Route('api:order-summary', 'get',
+          '/api/order-summary/', prepare=ensure_cart),
+    Route('api:cart-update', 'patch', '/api/cart/',
+          data=cart_operations, prepare=add_line),
+    Route('api:order-export', 'get', '/api/orders/export/', auth='staff'),
+    Route('api:order-export-jsonl', 'get',
+          '/api/orders/export/?output=jsonl', auth='staff'),
+    Route('api:checkout', 'post', '/api/checkout/',
+          data=checkout_data, prepare=settle_checkout),
+    Route('api:checkout-status', 'get',
+          lambda catalog, user, context: f'/api/checkout/{context["intent"].idempotency_key}/',
+          prepare=start_checkout),
+    Route('api:payment-list', 'get', '/api/payments/'),
+    Route('api:add-coupon', 'post', '/api/add-coupon/',
+          data={'code': 'BENCH'}, prepare=ensure_cart),
+    Route('api:address-list', 'get', '/api/address/list/?address_type=S'),
+    Route('api:address-create', 'post', '/api/address/create/',
+          data=lambda catalog, user, context: {
+              'formData': address_form(catalog, user, context),
+              'address_type': 'S'
+          }),
+    Route('api:address-update', 'put',
+          lambda catalog, user, context: f'/api/address/{catalog.addresses[user.pk]["S"].pk}/update/',
+          data=lambda catalog, user, context: {
+              'formData': dict(address_form(catalog, user, context),
+                               id=catalog.addresses[user.pk]['S'].pk, default=True),
+              'address_type': 'S'
+          }),
+    Route('api:address-delete', 'delete',
+          lambda catalog, user, context: f'/api/address/{context["address"].pk}/delete/',
+          prepare=create_address),
+    Route('api:country-list', 'get', '/api/country/list/', auth=None),
+    Route('api:user-id', 'get', '/api/user/id/'),
+    Route('api:catalog-cache-stats', 'get',
+          '/api/catalog/cache-stats/', auth='staff'),
+    Route('api:request-profiling', 'get', '/api/profiling/', auth='staff'),
+]
+
+HTML_ROUTES = [
+    Route('html:home', 'get', '/', auth=None),
+    Route('html:home-page-2', 'get', '/?page=2', auth=None),
+    Route('html:home-filtered', 'get',
+          '/?category=P&price=100-500&option=option-0:value-1', auth=None),
+    Route('html:product', 'get',
+          lambda catalog, user, context: f'/product/{catalog.rng.choice(catalog.items).slug}/',
+          auth=None),
+    Route('html:order-summary', 'get', '/order-summary/',
+          auth='session', prepare=ensure_cart),
+    Route('html:add-to-cart', 'get',
+          lambda catalog, user, context: f'/add-to-cart/{context["item"].slug}/',
+          auth='session', prepare=pick_item),
+    Route('html:remove-from-cart', 'get',
+          lambda catalog, user, context: f'/remove-from-cart/{context["item"].slug}/',
+          auth='session', prepare=add_line),
+    Route('html:remove-single-item-from-cart', 'get',
+          lambda catalog, user, context: f'/remove-single-item-from-cart/{context["item"].slug}/',
+          auth='session', prepare=add_line),
+    Route('html:checkout', 'get', '/checkout/',
+          auth='session', prepare=ensure_cart),
+    Route('html:payment', 'get', '/payment/stripe/',
+          auth='session', prepare=ensure_checkout),
+    Route('html:payment-submit', 'post', '/payment/stripe/',
+          data={'stripeToken': 'tok_visa'},
+          auth='session', prepare=ensure_checkout, json=False),
+    Route('html:add-coupon', 'post', '/add-coupon/', data={'code': 'BENCH'},
+          auth='session', prepare=ensure_cart, json=False),
+    Route('html:request-refund', 'get', '/request-refund/', auth=None),
+    Route('html:request-refund-submit', 'post', '/request-refund/',
+          data=lambda catalog, user, context: {
+              'ref_code': context['ref_code'],
+              'message': 'Benchmark refund',
+              'email': 'bench@example.com'
+          },
+          auth=None, prepare=last_ref_code, json=False),
+]
+
+ROUTES = API_ROUTES + HTML_ROUTES
@@ -0,0 +1,199 @@
+import json
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.cache import caches
+from django.db import OperationalError, connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from ecommerce.profiling import percentile
+
+
+def run_concurrently(function, arguments, threads, retries=200):
+    # calls function(*args) for every args at once from a pool of threads, each with its
+    # own connection; returns (result or exception, ms, retries) per call. SQLite makes
+    # concurrent writers fail with a locked database, they are retried after a short wait
+    start_gate = threading.Event()
+
+    def call(args):
+        start_gate.wait()
+        start = time.perf_counter()
+
+        try:
+            for attempt in range(retries + 1):
+                try:
+                    result = function(*args)
+
+                except OperationalError as e:
+                    result = e
+                    if attempt < retries:
+                        time.sleep(random.uniform(0, min(0.001 * 2 ** attempt, 0.1)))
+                        continue
+
+                except Exception as e:
+                    result = e
+
+                return result, (time.perf_counter() - start) * 1000, attempt
+
+        finally:
+            connection.close()
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = [executor.submit(call, args) for args in arguments]
+        start = time.perf_counter()
+        start_gate.set()
+        outcomes = [future.result() for future in futures]
+
+    return outcomes, time.perf_counter() - start
+
+
+class ClientPool:
+    # one session per user for the HTML views, token headers for the API
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.anonymous = Client(raise_request_exception=False)
+        self.sessions = {}
+
+    def get(self, route, user):
+        if route.auth == 'session':
+            if user.pk not in self.sessions:
+                client = Client(raise_request_exception=False)
+                client.force_login(user)
+                self.sessions[user.pk] = client
+            return self.sessions[user.pk], {}
+
+        if route.auth == 'token':
+            return self.anonymous, {'HTTP_AUTHORIZATION': f'Token {self.catalog.tokens[user.pk]}'}
+
+        if route.auth == 'staff':
+            return self.anonymous, {'HTTP_AUTHORIZATION': f'Token {self.catalog.tokens[self.catalog.staff.pk]}'}
+
+        return self.anonymous, {}
+
+
+def send(client, route, path, data, headers):
+    method = getattr(client, route.method)
+
+    if data is None:
+        return method(path, **headers)
+
+    if route.json:
+        return method(path, data=json.dumps(data), content_type='application/json', **headers)
+
+    return method(path, data=data, **headers)
+
+
+def run_route(route, catalog, clients, iterations, warmup=5, cold=False):
+    latencies = []
+    query_counts = []
+    statuses = {}
+
+    for index in range(warmup + iterations):
+        user = catalog.users[index % len(catalog.users)]
+        context = route.prepare(catalog, user) if route.prepare else {}
+        path, data = route.build(catalog, user, context)
+        client, headers = clients.get(route, user)
+
+        if cold:
+            for cache in caches.all():
+                cache.clear()
+
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            response = send(client, route, path, data, headers)
+            # streamed responses are only rendered while they are read
+            if response.streaming:
+                b''.join(response.streaming_content)
+            elapsed = time.perf_counter() - start
+
+        if index < warmup:
+            continue
+
+        latencies.append(elapsed * 1000)
+        query_counts.append(len(queries.captured_queries))
+        statuses[response.status_code] = statuses.get(
+            response.status_code, 0) + 1
+
+    latencies.sort()
+    total_seconds = sum(latencies) / 1000
+
+    return {
+        'method': route.method.upper(),
+        'requests': iterations,
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+        'errors': sum(count for status, count in statuses.items() if status >= 500),
+        'latency_ms': {
+            'mean': round(sum(latencies) / len(latencies), 3),
+            'p50': round(percentile(latencies, 50), 3),
+            'p90': round(percentile(latencies, 90), 3),
+            'p95': round(percentile(latencies, 95), 3),
+            'p99': round(percentile(latencies, 99), 3),
+            'max': round(latencies[-1], 3)
+        },
+        'throughput_rps': round(iterations / total_seconds, 1) if total_seconds else None,
+        'queries': {
+            'min': min(query_counts),
+            'max': max(query_counts),
+            'mean': round(sum(query_counts) / len(query_counts), 2)
+        }
+    }
+
+
+def run_benchmarks(routes, catalog, iterations, warmup=5, cold=False, stdout=None):
+    clients = ClientPool(catalog)
+    results = {}
+
+    # server errors are counted per route instead of logging a traceback per request
+    request_logger = logging.getLogger('django.request')
+    previous_level = request_logger.level
+    request_logger.setLevel(logging.CRITICAL)
+
+    try:
+        for route in routes:
+            results[route.name] = run_route(
+                route, catalog, clients, iterations, warmup, cold)
+            if stdout is not None:
+                write_result(stdout, route.name, results[route.name])
+
+    finally:
+        request_logger.setLevel(previous_level)
+
+    return results
+
+
+def write_result(stdout, name, result):
+    stdout.write('{:<36} p50 {:>8.2f} ms  p95 {:>8.2f} ms  {:>8} rps  {:>5} queries  {}'.format(
+        name,
+        result['latency_ms']['p50'],
+        result['latency_ms']['p95'],
+        result['throughput_rps'],
+        result['queries']['max'],
+        ' '.join(f'{status}x{count}' for status,
+                 count in result['statuses'].items())
+    ))
+
+
+def compare_results(baseline, results, threshold):
+    # latency regressions beyond the threshold ratio, and any growth in the query count
+    regressions = []
+
+    for name, result in results.items():
+        previous = baseline.get('results', {}).get(name)
+        if previous is None:
+            continue
+
+        old_p95 = previous['latency_ms']['p95']
+        new_p95 = result['latency_ms']['p95']
+        if old_p95 and new_p95 > old_p95 * threshold:
+            regressions.append(
+                f'{name}: p95 {old_p95:.2f} ms -> {new_p95:.2f} ms')
+
+        if result['queries']['max'] > previous['queries']['max']:
+            regressions.append(
+                f'{name}: queries {previous["queries"]["max"]} -> {result["queries"]["max"]}')
+
+    return regressions
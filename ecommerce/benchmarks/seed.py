@@ -0,0 +1,184 @@
+import random
+import string
+
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from ecommerce.cart import add_to_cart
+from ecommerce.facets import refresh_facet_counts
+from ecommerce.models import (
+    CATEGORY_CHOICES, LABEL_CHOICES, Item, Option, OptionValue, Order, OrderItem, Address, Payment,
+    Coupon, get_option_signature
+)
+from ecommerce.pricing import get_unit_prices
+from ecommerce.search import rebuild_index
+
+
+class Catalog:
+    # everything the benchmark routes need to build their requests
+    def __init__(self, rng, cart_lines):
+        self.rng = rng
+        self.cart_lines = cart_lines
+        self.items = []
+        self.option_values = {}
+        self.users = []
+        self.tokens = {}
+        self.addresses = {}
+        self.coupon = None
+        self.staff = None
+
+    def random_selection(self, rng, item):
+        # one value of each option of the item
+        return [rng.choice(values) for values in self.option_values[item.pk]]
+
+
+def seed_catalog(catalog, rng, items, options, values):
+    categories = [code for code, name in CATEGORY_CHOICES]
+    labels = [code for code, name in LABEL_CHOICES]
+
+    Item.objects.bulk_create([
+        Item(
+            title=f'Product {index}',
+            price=round(rng.uniform(100, 2000), 2),
+            discount_price=round(rng.uniform(50, 100),
+                                 2) if index % 3 == 0 else None,
+            category=rng.choice(categories),
+            label=rng.choice(labels),
+            slug=f'product-{index}',
+            short_description='Short description ' * 4,
+            long_description='Long description ' * 100
+        )
+        for index in range(items)
+    ])
+    catalog.items = list(Item.objects.order_by('pk'))
+
+    Option.objects.bulk_create([
+        Option(item=item, name=f'option-{index}')
+        for item in catalog.items for index in range(options)
+    ])
+    OptionValue.objects.bulk_create([
+        OptionValue(
+            option=option,
+            value=f'value-{index}',
+            additional_price=rng.choice([None, 10.0, 50.0]),
+            default=index == 0
+        )
+        for option in Option.objects.all() for index in range(values)
+    ])
+
+    for item in catalog.items:
+        catalog.option_values[item.pk] = []
+
+    option_values = {}
+    for option_id, value_id in OptionValue.objects.values_list('option_id', 'pk').order_by('pk'):
+        option_values.setdefault(option_id, []).append(value_id)
+
+    for option_id, item_id in Option.objects.values_list('pk', 'item_id').order_by('pk'):
+        catalog.option_values[item_id].append(option_values[option_id])
+
+    # bulk_create skips the signals that maintain these
+    rebuild_index()
+    refresh_facet_counts()
+
+
+def seed_users(catalog, users):
+    User = get_user_model()
+
+    for index in range(users):
+        user = User.objects.create_user(
+            username=f'bench-user-{index}',
+            email=f'bench-user-{index}@example.com',
+            password='password'
+        )
+        catalog.users.append(user)
+        catalog.tokens[user.pk] = Token.objects.create(user=user).key
+        catalog.addresses[user.pk] = {
+            address_type: Address.objects.create(
+                user=user,
+                street_address='1 Benchmark Street',
+                apartment_address='Suite 1',
+                country='US',
+                zip='12345',
+                address_type=address_type,
+                default=True
+            )
+            for address_type in ('B', 'S')
+        }
+
+    catalog.staff = User.objects.create_user(
+        username='bench-staff', password='password', is_staff=True)
+    catalog.tokens[catalog.staff.pk] = Token.objects.create(
+        user=catalog.staff).key
+    catalog.coupon = Coupon.objects.create(code='BENCH', amount=10.0)
+
+
+def fill_cart(catalog, rng, user, lines):
+    for item in rng.sample(catalog.items, min(lines, len(catalog.items))):
+        add_to_cart(user, item, catalog.random_selection(rng, item))
+
+
+def seed_order_history(catalog, rng, user, orders, lines):
+    # completed orders are inserted in bulk, outside of the cart service
+    for index in range(orders):
+        items = rng.sample(catalog.items, min(lines, len(catalog.items)))
+        selections = [(item, catalog.random_selection(rng, item)) for item in items]
+        prices = get_unit_prices(selections)
+        order_items = []
+
+        for item, option_ids in selections:
+            signature = get_option_signature(option_ids)
+            order_item = OrderItem(
+                user=user,
+                item=item,
+                ordered=True,
+                quantity=rng.randint(1, 3),
+                option_signature=signature
+            )
+            order_item.snapshot_prices(prices[(item.pk, signature)])
+            order_items.append(order_item)
+
+        OrderItem.objects.bulk_create(order_items)
+        order_items = list(OrderItem.objects.filter(
+            user=user, ordered=True).order_by('-pk')[:len(order_items)])
+
+        subtotal = sum(order_item.get_final_price()
+                       for order_item in order_items)
+        payment = Payment.objects.create(
+            stripe_charge_id=f'ch_bench_{user.pk}_{index}',
+            user=user,
+            amount=subtotal
+        )
+        order = Order.objects.create(
+            user=user,
+            ordered=True,
+            ordered_date=timezone.now(),
+            payment=payment,
+            billing_address=catalog.addresses[user.pk]['B'],
+            shipping_address=catalog.addresses[user.pk]['S'],
+            ref_code=''.join(rng.choices(
+                string.ascii_lowercase + string.digits, k=20)),
+            subtotal=subtotal,
+            discount=sum(order_item.get_amount_saved()
+                         for order_item in order_items),
+            total=subtotal,
+            line_count=len(order_items)
+        )
+        Order.items.through.objects.bulk_create([
+            Order.items.through(order=order, orderitem=order_item)
+            for order_item in order_items
+        ])
+
+
+def seed(items=100, options=2, values=3, users=5, cart_lines=5, orders=10, seed=0):
+    rng = random.Random(seed)
+    catalog = Catalog(rng, cart_lines)
+
+    seed_catalog(catalog, rng, items, options, values)
+    seed_users(catalog, users)
+
+    for user in catalog.users:
+        seed_order_history(catalog, rng, user, orders, cart_lines)
+        fill_cart(catalog, rng, user, cart_lines)
+
+    return catalog
@@ -0,0 +1,172 @@
+import asyncio
+import io
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+from django.test.utils import override_settings
+
+from ecommerce.asgi import ReadPathASGIHandler
+from ecommerce.profiling import percentile
+
+from .routes import ROUTES
+
+
+READ_ROUTES = ['api:product-list', 'api:product-detail', 'api:order-summary',
+               'api:country-list', 'api:user-id']
+
+
+def build_requests(catalog, clients):
+    # (route name, path, query string, headers) of every client, round robin over the
+    # read routes and the users; carts are filled before anything is timed
+    routes = [route for route in ROUTES if route.name in READ_ROUTES]
+    requests = []
+
+    for index in range(clients):
+        route = routes[index % len(routes)]
+        user = catalog.users[index % len(catalog.users)]
+        context = route.prepare(catalog, user) if route.prepare else {}
+        path, data = route.build(catalog, user, context)
+        path, _, query = path.partition('?')
+        headers = {}
+        if route.auth == 'token':
+            headers['authorization'] = f'Token {catalog.tokens[user.pk]}'
+        requests.append((route.name, path, query, headers))
+
+    return requests
+
+
+def serve_wsgi(requests, delay, workers):
+    # a threaded WSGI server: a worker thread is held while its client sends the request
+    handler = WSGIHandler()
+
+    def call(request):
+        name, path, query, headers = request
+        time.sleep(delay)
+
+        environ = {
+            'REQUEST_METHOD': 'GET',
+            'PATH_INFO': path,
+            'QUERY_STRING': query,
+            'SCRIPT_NAME': '',
+            'SERVER_NAME': 'testserver',
+            'SERVER_PORT': '80',
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'wsgi.input': io.BytesIO(),
+            'wsgi.url_scheme': 'http'
+        }
+        for header, value in headers.items():
+            environ['HTTP_' + header.upper()] = value
+
+        statuses = []
+        response = handler(environ, lambda status, headers: statuses.append(int(status[:3])))
+        try:
+            b''.join(response)
+        finally:
+            response.close()
+
+        return name, statuses[0], (time.perf_counter() - start) * 1000
+
+    # every client connects at once, latencies include the wait for a free worker
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(call, requests))
+
+
+def serve_asgi(handler, requests, delay):
+    # one event loop holds every client; the body arrives after the delay
+    async def call(request):
+        name, path, query, headers = request
+        start = time.perf_counter()
+        scope = {
+            'type': 'http',
+            'method': 'GET',
+            'path': path,
+            'query_string': query.encode(),
+            'headers': [(b'host', b'testserver')] + [
+                (header.encode(), value.encode()) for header, value in headers.items()],
+            'server': ('testserver', 80)
+        }
+        messages = []
+
+        async def receive():
+            await asyncio.sleep(delay)
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        await handler(scope, receive, send)
+        return name, messages[0]['status'], (time.perf_counter() - start) * 1000
+
+    async def serve():
+        return await asyncio.gather(*[call(request) for request in requests])
+
+    return asyncio.run(serve())
+
+
+def summarize(outcomes, elapsed):
+    latencies = sorted(duration for name, status, duration in outcomes)
+    routes = {}
+    for name, status, duration in outcomes:
+        routes.setdefault(name, []).append(duration)
+
+    return {
+        'requests': len(outcomes),
+        'errors': sum(1 for name, status, duration in outcomes if status >= 500),
+        'throughput_rps': round(len(outcomes) / elapsed, 1),
+        'latency_ms': {
+            'p50': round(percentile(latencies, 50), 3),
+            'p95': round(percentile(latencies, 95), 3)
+        },
+        'routes': {
+            name: {'p95_ms': round(percentile(sorted(durations), 95), 3)}
+            for name, durations in sorted(routes.items())
+        }
+    }
+
+
+def run_server_scenario(catalog, clients, delay, threads, stdout=None):
+    # the same slow clients against a threaded WSGI server, Django's ASGI handler and
+    # the ASGI handler of core/asgi.py; delay is in milliseconds
+    requests = build_requests(catalog, clients)
+    delay = delay / 1000
+
+    # as many WSGI worker threads as read pool threads
+    with override_settings(ASGI_READ_THREADS=threads):
+        read_handler = ReadPathASGIHandler()
+
+    servers = [
+        ('wsgi', lambda: serve_wsgi(requests, delay, threads)),
+        ('asgi', lambda: serve_asgi(ASGIHandler(), requests, delay)),
+        ('asgi-read-pool', lambda: serve_asgi(read_handler, requests, delay))
+    ]
+
+    # server errors are counted instead of logging a traceback or slow request each
+    loggers = [logging.getLogger(name) for name in ('django.request', 'ecommerce.profiling')]
+    previous_levels = [logger.level for logger in loggers]
+    for logger in loggers:
+        logger.setLevel(logging.CRITICAL)
+
+    results = {}
+    try:
+        for name, serve in servers:
+            start = time.perf_counter()
+            outcomes = serve()
+            results[name] = summarize(outcomes, time.perf_counter() - start)
+
+            if stdout is not None:
+                stdout.write('{:<16} {:>5} clients  {:>8.1f} rps  p50 {:>8.2f} ms  p95 {:>8.2f} ms  '
+                             'errors {:>3}'.format(
+                                 name, clients, results[name]['throughput_rps'],
+                                 results[name]['latency_ms']['p50'],
+                                 results[name]['latency_ms']['p95'], results[name]['errors']))
+
+    finally:
+        for logger, level in zip(loggers, previous_levels):
+            logger.setLevel(level)
+        read_handler.executor.shutdown()
+
+    return results
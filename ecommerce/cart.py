@@ -0,0 +1,485 @@
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, F
+from django.utils import timezone
+
+from .coupons import get_coupon_amount, get_coupon_by_id, redeem, release
+from .models import (
+    PAYMENT_IN_PROGRESS, Item, Order, OrderItem, OptionValue, PaymentIntent, get_option_signature)
+from .pricing import get_unit_prices
+
+
+CART_COUNT_KEY = 'cart:count:{}'
+
+
+class CartError(Exception):
+    # the message is shown to the user as is
+    pass
+
+
+def get_cart_count(user):
+    # number of lines in the user's open order, as shown on the navbar badge
+    key = CART_COUNT_KEY.format(user.pk)
+    count = cache.get(key)
+
+    if count is None:
+        count = Order.objects.filter(user=user, ordered=False).values_list(
+            'line_count', flat=True).first() or 0
+        cache.set(key, count)
+
+    return count
+
+
+def invalidate_cart_count(user_id):
+    # drop the entry once the change is committed, so it is not refilled with the old count
+    key = CART_COUNT_KEY.format(user_id)
+    transaction.on_commit(lambda: cache.delete(key))
+
+
+def lock_cart(user, checkout=False):
+    # serialize cart mutations of the same user (e.g. double clicks) on the user row,
+    # which exists even before the first order is created; the cart is frozen from
+    # checkout until the payment worker is done with it, unless checkout is set
+    get_user_model().objects.select_for_update().values_list(
+        'pk', flat=True).get(pk=user.pk)
+
+    if not checkout and PaymentIntent.objects.filter(
+            user=user, order__ordered=False, status__in=PAYMENT_IN_PROGRESS).exists():
+        raise CartError('Your payment is being processed. Please wait before changing your cart.')
+
+    invalidate_cart_count(user.pk)
+
+
+def get_open_order(user, create=False):
+    order = Order.objects.filter(user=user, ordered=False).first()
+
+    if order is None and create:
+        order = Order.objects.create(user=user, ordered_date=timezone.now())
+
+    return order
+
+
+def apply_totals(order, amount, discount, line_delta=0):
+    # add to the stored totals in one UPDATE, once the lines are written; the coupon
+    # amount follows the new subtotal
+    values = {'total': F('subtotal') + amount - F('coupon_amount')}
+
+    if order.coupon_id is not None:
+        coupon_amount = get_coupon_amount(
+            order, get_coupon_by_id(order.coupon_id), order.subtotal + amount)
+        values = {'coupon_amount': coupon_amount, 'total': F('subtotal') + amount - coupon_amount}
+
+    Order.objects.filter(pk=order.pk).update(
+        subtotal=F('subtotal') + amount,
+        discount=F('discount') + discount,
+        line_count=F('line_count') + line_delta,
+        updated=timezone.now(),
+        **values
+    )
+
+
+def update_totals(order, order_item, quantity_delta, line_delta=0):
+    # apply the price of the changed quantity to the stored totals
+    unit_price, final_unit_price = order_item.get_unit_prices()
+    apply_totals(
+        order,
+        quantity_delta * final_unit_price,
+        quantity_delta * (unit_price - final_unit_price),
+        line_delta
+    )
+
+
+def parse_option_ids(option_ids):
+    try:
+        return {int(option_id) for option_id in option_ids}
+
+    except (TypeError, ValueError):
+        raise CartError('Invalid options.')
+
+
+def get_option_count(item):
+    # use the annotated count when the caller loaded the item with it
+    option_count = getattr(item, 'option_count', None)
+    if option_count is None:
+        option_count = item.option_set.count()
+    return option_count
+
+
+def check_selection(option_ids, option_count, selected):
+    # selected: the option of each of option_ids that belongs to the item
+    if not option_ids:
+        if option_count:
+            raise CartError('Please specify the required options.')
+        return
+
+    # exactly one value of each option of this item must be selected
+    if len(selected) != len(option_ids) or len(set(selected)) != len(selected):
+        raise CartError('Invalid options.')
+
+    if len(selected) < option_count:
+        raise CartError('Please specify the required options.')
+
+
+def get_default_options(item):
+    # the default value of each option of the item, the first one if several are marked;
+    # options without a default are left for check_selection() to reject
+    defaults = {}
+    for option_id, pk in OptionValue.objects.filter(
+            option__item=item, default=True).order_by('pk').values_list('option_id', 'pk'):
+        defaults.setdefault(option_id, pk)
+    return list(defaults.values())
+
+
+def clean_options(item, option_ids):
+    option_ids = parse_option_ids(option_ids)
+    option_count = get_option_count(item)
+
+    selected = []
+    if option_ids:
+        selected = list(OptionValue.objects.filter(
+            pk__in=option_ids, option__item=item).values_list('option_id', flat=True))
+
+    check_selection(option_ids, option_count, selected)
+    return option_ids
+
+
+def get_line(order, item, option_ids=None):
+    # without options, the first line of the item is used
+    queryset = order.items.filter(item=item)
+
+    if option_ids is not None:
+        queryset = queryset.filter(
+            option_signature=get_option_signature(clean_options(item, option_ids)))
+
+    order_item = queryset.first()
+    if order_item is None:
+        raise CartError('This item is not in your cart.')
+
+    order_item.item = item
+    return order_item
+
+
+def get_open_order_or_error(user):
+    order = get_open_order(user)
+
+    if order is None:
+        raise CartError('You do not have an active order.')
+
+    return order
+
+
+@transaction.atomic
+def add_to_cart(user, item, option_ids=(), quantity=1):
+    # returns the cart line and whether it was created
+    option_ids = clean_options(item, option_ids)
+    signature = get_option_signature(option_ids)
+
+    lock_cart(user)
+    order = get_open_order(user, create=True)
+
+    order_item = order.items.filter(
+        item=item, option_signature=signature).first()
+
+    if order_item is not None:
+        order_item.item = item
+        OrderItem.objects.filter(pk=order_item.pk).update(
+            quantity=F('quantity') + quantity)
+        order_item.quantity += quantity
+        update_totals(order, order_item, quantity)
+        return order_item, False
+
+    order_item = OrderItem(
+        user=user,
+        item=item,
+        option_signature=signature,
+        quantity=quantity
+    )
+    order_item.snapshot_prices(get_unit_prices([(item, option_ids)])[(item.pk, signature)])
+    order_item.save()
+
+    OrderItem.item_options.through.objects.bulk_create([
+        OrderItem.item_options.through(orderitem=order_item, optionvalue_id=option_id)
+        for option_id in option_ids
+    ])
+    Order.items.through.objects.create(order=order, orderitem=order_item)
+    update_totals(order, order_item, quantity, line_delta=1)
+    return order_item, True
+
+
+@transaction.atomic
+def merge_lines(user, lines):
+    # adds [(item, option ids, quantity)] to the user's cart at once, summing the quantity
+    # of lines already in it; the options must have been validated by the caller
+    lock_cart(user)
+    order = get_open_order(user, create=True)
+
+    existing = {
+        (order_item.item_id, order_item.option_signature): order_item
+        for order_item in order.items.select_related('item')
+    }
+    changed = []
+    new_options = []
+    new_lines = []
+    amount = discount = 0
+    prices = get_unit_prices((item, option_ids) for item, option_ids, quantity in lines)
+
+    for item, option_ids, quantity in lines:
+        signature = get_option_signature(option_ids)
+        order_item = existing.get((item.pk, signature))
+
+        if order_item is None:
+            order_item = OrderItem(
+                user=user,
+                item=item,
+                option_signature=signature,
+                quantity=quantity
+            )
+            order_item.snapshot_prices(prices[(item.pk, signature)])
+            order_item.save()
+            existing[(item.pk, signature)] = order_item
+            new_lines.append(order_item)
+            new_options.extend(
+                OrderItem.item_options.through(orderitem=order_item, optionvalue_id=option_id)
+                for option_id in option_ids
+            )
+
+        else:
+            order_item.quantity += quantity
+            changed.append(order_item)
+
+        unit_price, final_unit_price = order_item.get_unit_prices()
+        amount += quantity * final_unit_price
+        discount += quantity * (unit_price - final_unit_price)
+
+    OrderItem.objects.bulk_update(changed, ['quantity'])
+    OrderItem.item_options.through.objects.bulk_create(new_options)
+    Order.items.through.objects.bulk_create([
+        Order.items.through(order=order, orderitem=order_item) for order_item in new_lines
+    ])
+    apply_totals(order, amount, discount, line_delta=len(new_lines))
+    return order
+
+
+def delete_line(order, order_item):
+    # the option and order links are removed by the cascade
+    order_item.delete()
+    update_totals(order, order_item, -order_item.quantity, line_delta=-1)
+
+
+@transaction.atomic
+def subtract_from_cart(user, item, option_ids=None):
+    # returns the line, or None when its last unit was removed
+    lock_cart(user)
+    order = get_open_order_or_error(user)
+    order_item = get_line(order, item, option_ids)
+
+    if order_item.quantity > 1:
+        OrderItem.objects.filter(pk=order_item.pk).update(
+            quantity=F('quantity') - 1)
+        order_item.quantity -= 1
+        update_totals(order, order_item, -1)
+        return order_item
+
+    delete_line(order, order_item)
+    return None
+
+
+@transaction.atomic
+def remove_from_cart(user, item, option_ids=None):
+    lock_cart(user)
+    order = get_open_order_or_error(user)
+    delete_line(order, get_line(order, item, option_ids))
+
+
+@transaction.atomic
+def remove_line(user, order_item_id):
+    lock_cart(user)
+    order = get_open_order_or_error(user)
+    order_item = order.items.select_related(
+        'item').filter(pk=order_item_id).first()
+
+    if order_item is None:
+        raise CartError('This item is not in your cart.')
+
+    delete_line(order, order_item)
+
+
+@transaction.atomic
+def apply_coupon(user, coupon):
+    lock_cart(user)
+    order = get_open_order_or_error(user)
+
+    if order.coupon_id == coupon.pk:
+        return order
+
+    if coupon.minimum_spend is not None and order.subtotal < coupon.minimum_spend:
+        raise CartError(f'This coupon requires a minimum spend of {coupon.minimum_spend:.2f}.')
+
+    # the use is taken when the coupon is applied, and given back if the cart drops it
+    if not redeem(coupon):
+        raise CartError('This coupon is no longer available.')
+
+    if order.coupon_id is not None:
+        release(order.coupon_id)
+
+    coupon_amount = get_coupon_amount(order, coupon, order.subtotal)
+    Order.objects.filter(pk=order.pk).update(
+        coupon=coupon,
+        coupon_amount=coupon_amount,
+        total=F('subtotal') - coupon_amount,
+        updated=timezone.now()
+    )
+    return order
+
+
+def parse_quantity(value, minimum):
+    if isinstance(value, bool) or not isinstance(value, int) or value < minimum:
+        raise CartError(f'The quantity must be a whole number of at least {minimum}.')
+    return value
+
+
+def parse_operations(operations):
+    # validates a list of {'op': 'add', 'slug', 'options', 'quantity'},
+    # {'op': 'set', 'line', 'quantity'} and {'op': 'remove', 'line'} operations into
+    # ('add', item, option ids, quantity), ('set', line, quantity) and ('remove', line),
+    # loading the items and option values of every add in two queries
+    if not isinstance(operations, list) or not operations:
+        raise CartError('Please specify a list of operations.')
+
+    slugs = set()
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict):
+            raise CartError(f'Operation {index}: invalid operation.')
+        if operation.get('op') == 'add':
+            slugs.add(str(operation.get('slug')))
+
+    items = Item.objects.annotate(option_count=Count('option')).in_bulk(
+        slugs, field_name='slug') if slugs else {}
+    parsed = []
+    option_ids = set()
+
+    for index, operation in enumerate(operations):
+        try:
+            op = operation.get('op')
+
+            if op == 'add':
+                item = items.get(str(operation.get('slug')))
+                if item is None:
+                    raise CartError('This item does not exist.')
+
+                ids = parse_option_ids(operation.get('options') or [])
+                option_ids.update(ids)
+                parsed.append(('add', item, ids, parse_quantity(
+                    operation.get('quantity', 1), 1)))
+
+            elif op == 'set':
+                parsed.append(('set', operation.get('line'), parse_quantity(
+                    operation.get('quantity'), 0)))
+
+            elif op == 'remove':
+                parsed.append(('remove', operation.get('line')))
+
+            else:
+                raise CartError('Unknown operation.')
+
+        except CartError as e:
+            raise CartError(f'Operation {index}: {e}')
+
+    # the selected options of every add, as clean_options() checks them one item at a time
+    values = {
+        pk: (option_id, item_id) for pk, option_id, item_id in
+        OptionValue.objects.filter(pk__in=option_ids).values_list(
+            'pk', 'option_id', 'option__item_id')
+    } if option_ids else {}
+
+    for index, operation in enumerate(parsed):
+        if operation[0] == 'add':
+            op, item, ids, quantity = operation
+            selected = [values[pk][0] for pk in ids if pk in values and values[pk][1] == item.pk]
+
+            try:
+                check_selection(ids, item.option_count, selected)
+            except CartError as e:
+                raise CartError(f'Operation {index}: {e}')
+
+    return parsed
+
+
+@transaction.atomic
+def update_cart(user, operations):
+    # applies parse_operations() to the user's cart under one lock, with bulk writes and
+    # a single update of the stored totals; nothing is written if an operation fails
+    lock_cart(user)
+    creates = any(operation[0] == 'add' for operation in operations)
+    order = get_open_order(user, create=creates)
+    if order is None:
+        raise CartError('You do not have an active order.')
+
+    lines = {order_item.pk: order_item for order_item in order.items.select_related('item')}
+    by_signature = {
+        (order_item.item_id, order_item.option_signature): order_item
+        for order_item in lines.values()
+    }
+    previous = {pk: order_item.quantity for pk, order_item in lines.items()}
+    new_lines = []
+    prices = get_unit_prices(
+        operation[1:3] for operation in operations if operation[0] == 'add')
+
+    for index, operation in enumerate(operations):
+        if operation[0] == 'add':
+            op, item, option_ids, quantity = operation
+            signature = get_option_signature(option_ids)
+            order_item = by_signature.get((item.pk, signature))
+
+            if order_item is None:
+                order_item = OrderItem(user=user, item=item, option_signature=signature, quantity=0)
+                order_item.snapshot_prices(prices[(item.pk, signature)])
+                order_item.option_ids = option_ids
+                by_signature[(item.pk, signature)] = order_item
+                new_lines.append(order_item)
+
+            order_item.quantity += quantity
+            continue
+
+        try:
+            order_item = lines[int(operation[1])]
+        except (KeyError, TypeError, ValueError):
+            raise CartError(f'Operation {index}: This item is not in your cart.')
+
+        order_item.quantity = operation[2] if operation[0] == 'set' else 0
+
+    # a line set to 0 is deleted; totals move by the quantity change of every line
+    amount = discount = 0
+    deleted = []
+    changed = []
+
+    for order_item in list(lines.values()) + new_lines:
+        delta = order_item.quantity - previous.get(order_item.pk, 0)
+        unit_price, final_unit_price = order_item.get_unit_prices()
+        amount += delta * final_unit_price
+        discount += delta * (unit_price - final_unit_price)
+
+        if order_item.pk is not None:
+            if order_item.quantity == 0:
+                deleted.append(order_item.pk)
+            elif delta:
+                changed.append(order_item)
+
+    # new lines are saved one by one: bulk_create does not return primary keys on
+    # every database, and the option and order links need them
+    new_lines = [order_item for order_item in new_lines if order_item.quantity]
+    for order_item in new_lines:
+        order_item.save()
+
+    OrderItem.objects.filter(pk__in=deleted).delete()
+    OrderItem.objects.bulk_update(changed, ['quantity'])
+    OrderItem.item_options.through.objects.bulk_create([
+        OrderItem.item_options.through(orderitem=order_item, optionvalue_id=option_id)
+        for order_item in new_lines for option_id in order_item.option_ids
+    ])
+    Order.items.through.objects.bulk_create([
+        Order.items.through(order=order, orderitem=order_item) for order_item in new_lines
+    ])
+    apply_totals(order, amount, discount, line_delta=len(new_lines) - len(deleted))
+    return order
@@ -0,0 +1,108 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+CATALOG_VERSION_KEY = 'catalog:version'
+
+# sentinel so that cached falsy payloads still count as hits
+_missing = object()
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def get_catalog_cache():
+    return caches[settings.CATALOG_CACHE_ALIAS]
+
+
+def get_catalog_version():
+    cache = get_catalog_cache()
+    version = cache.get(CATALOG_VERSION_KEY)
+
+    # seed from the clock so a flushed cache never reuses an old version
+    if version is None:
+        cache.add(CATALOG_VERSION_KEY, int(time.time() * 1000), None)
+        version = cache.get(CATALOG_VERSION_KEY)
+
+    return version
+
+
+def bump_catalog_version(*args, **kwargs):
+    cache = get_catalog_cache()
+
+    try:
+        return cache.incr(CATALOG_VERSION_KEY)
+
+    except ValueError:
+        get_catalog_version()
+        return cache.incr(CATALOG_VERSION_KEY)
+
+
+def _record(name, outcome, count=1):
+    with _stats_lock:
+        counters = _stats.setdefault(name, {'hits': 0, 'misses': 0})
+        counters[outcome] += count
+
+
+def get_cached(name, key, build):
+    # entries of older versions are never read again and age out of the LRU
+    cache = get_catalog_cache()
+    cache_key = f'catalog:{get_catalog_version()}:{name}:{key}'
+    value = cache.get(cache_key, _missing)
+
+    if value is _missing:
+        _record(name, 'misses')
+        value = build()
+        cache.set(cache_key, value)
+
+    else:
+        _record(name, 'hits')
+
+    return value
+
+
+def get_cached_many(name, keys, build):
+    # get_cached() of several keys in one cache lookup; build(missing keys) returns
+    # {key: value} of the keys that were not cached
+    cache = get_catalog_cache()
+    prefix = f'catalog:{get_catalog_version()}:{name}:'
+    found = cache.get_many([prefix + str(key) for key in keys])
+
+    values = {}
+    missing = []
+    for key in keys:
+        if prefix + str(key) in found:
+            values[key] = found[prefix + str(key)]
+        else:
+            missing.append(key)
+
+    _record(name, 'hits', len(values))
+    if missing:
+        _record(name, 'misses', len(missing))
+        built = build(missing)
+        cache.set_many({prefix + str(key): value for key, value in built.items()})
+        values.update(built)
+
+    return values
+
+
+def get_cache_stats():
+    with _stats_lock:
+        stats = {name: dict(counters) for name, counters in _stats.items()}
+
+    for counters in stats.values():
+        lookups = counters['hits'] + counters['misses']
+        counters['hit_ratio'] = counters['hits'] / lookups if lookups else 0.0
+
+    return {
+        'version': get_catalog_version(),
+        'caches': stats
+    }
+
+
+def reset_cache_stats():
+    with _stats_lock:
+        _stats.clear()
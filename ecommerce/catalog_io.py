@@ -0,0 +1,338 @@
+import csv
+import json
+
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_slug
+from django.db import transaction
+
+from .catalog import bump_catalog_version
+from .models import CATEGORY_CHOICES, LABEL_CHOICES, Item, Option, OptionValue
+from .search import index_items
+
+
+ITEM_FIELDS = ['slug', 'title', 'price', 'discount_price', 'category',
+               'label', 'short_description', 'long_description']
+
+# a CSV row is one option value, with the columns of its item repeated
+CSV_FIELDS = ITEM_FIELDS + ['option', 'value', 'additional_price', 'default']
+
+FORMATS = ('csv', 'jsonl')
+
+
+class CatalogRowError(Exception):
+    def __init__(self, line, message):
+        super().__init__(f'line {line}: {message}')
+        self.line = line
+
+
+def get_format(path, file_format=None):
+    file_format = file_format or path.rpartition('.')[2].lower()
+    if file_format not in FORMATS:
+        raise ValueError(f'Unknown catalog format {file_format!r}, use one of {", ".join(FORMATS)}')
+    return file_format
+
+
+def parse_float(value, name, required=False):
+    if value is None or value == '':
+        if required:
+            raise ValueError(f'{name} is required')
+        return None
+
+    try:
+        value = float(value)
+
+    except (TypeError, ValueError):
+        raise ValueError(f'{name} must be a number')
+
+    if value < 0:
+        raise ValueError(f'{name} must not be negative')
+    return value
+
+
+def parse_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes')
+    return bool(value)
+
+
+def clean_record(line, record):
+    # validated copy of a {item fields, options: [{name, values: [{value, ...}]}]} record
+    try:
+        item = {field: record.get(field) or '' for field in ITEM_FIELDS}
+
+        try:
+            validate_slug(item['slug'])
+        except ValidationError:
+            raise ValueError(f'invalid slug {item["slug"]!r}')
+
+        if not item['title']:
+            raise ValueError('title is required')
+
+        if len(item['title']) > 100:
+            raise ValueError('title is longer than 100 characters')
+
+        item['price'] = parse_float(record.get('price'), 'price', required=True)
+        item['discount_price'] = parse_float(
+            record.get('discount_price'), 'discount_price')
+
+        if item['category'] not in dict(CATEGORY_CHOICES):
+            raise ValueError(f'unknown category {item["category"]!r}')
+
+        if item['label'] not in dict(LABEL_CHOICES):
+            raise ValueError(f'unknown label {item["label"]!r}')
+
+        options = []
+        for option in record.get('options') or []:
+            name = option.get('name') or ''
+            if not name or len(name) > 50:
+                raise ValueError(f'invalid option name {name!r}')
+
+            values = []
+            for value in option.get('values') or []:
+                if not value.get('value') or len(value['value']) > 50:
+                    raise ValueError(f'invalid value {value.get("value")!r} of option {name!r}')
+
+                values.append({
+                    'value': value['value'],
+                    'additional_price': parse_float(
+                        value.get('additional_price'), 'additional_price'),
+                    'default': parse_bool(value.get('default'))
+                })
+            options.append({'name': name, 'values': values})
+
+    except (AttributeError, TypeError, ValueError) as e:
+        raise CatalogRowError(line, str(e))
+
+    item['options'] = options
+    return item
+
+
+def read_jsonl(file):
+    # yields (line number, record), one item per line
+    for line, text in enumerate(file, 1):
+        if not text.strip():
+            continue
+
+        try:
+            record = json.loads(text)
+
+        except ValueError as e:
+            yield line, CatalogRowError(line, f'invalid JSON: {e}')
+            continue
+
+        if not isinstance(record, dict):
+            yield line, CatalogRowError(line, 'a record must be an object')
+            continue
+
+        yield line, record
+
+
+def read_csv(file):
+    # yields (line number, record), the consecutive rows of an item being merged into one
+    record = None
+    options = {}
+
+    reader = csv.DictReader(file)
+
+    for row in reader:
+        line = reader.line_num
+        if record is not None and row.get('slug') != record['slug']:
+            yield record['line'], record
+            record = None
+
+        if record is None:
+            record = {field: row.get(field) for field in ITEM_FIELDS}
+            record['line'] = line
+            record['options'] = []
+            options = {}
+
+        name = row.get('option')
+        if name:
+            if name not in options:
+                options[name] = {'name': name, 'values': []}
+                record['options'].append(options[name])
+
+            if row.get('value'):
+                options[name]['values'].append({
+                    'value': row['value'],
+                    'additional_price': row.get('additional_price'),
+                    'default': row.get('default')
+                })
+
+    if record is not None:
+        yield record['line'], record
+
+
+def read_records(file, file_format):
+    reader = read_csv if file_format == 'csv' else read_jsonl
+    return reader(file)
+
+
+def merge_records(records):
+    # a slug repeated in a batch is one item: later fields win, options are combined
+    merged = {}
+
+    for record in records:
+        previous = merged.get(record['slug'])
+        if previous is not None:
+            record['options'] = previous['options'] + record['options']
+        merged[record['slug']] = record
+
+    return list(merged.values())
+
+
+@transaction.atomic
+def upsert_batch(records):
+    # creates or updates the items of the batch by slug, then their options and values
+    # by name; existing options and values absent from the file are kept
+    records = merge_records(records)
+    stats = {'created': 0, 'updated': 0, 'options': 0, 'values': 0}
+
+    existing = Item.objects.in_bulk(
+        [record['slug'] for record in records], field_name='slug')
+    new_items = []
+    changed_items = []
+
+    for record in records:
+        item = existing.get(record['slug'])
+        if item is None:
+            new_items.append(Item(**{field: record[field] for field in ITEM_FIELDS}))
+            continue
+
+        if any(getattr(item, field) != record[field] for field in ITEM_FIELDS):
+            for field in ITEM_FIELDS:
+                setattr(item, field, record[field])
+            changed_items.append(item)
+
+    Item.objects.bulk_create(new_items)
+    Item.objects.bulk_update(changed_items, ITEM_FIELDS[1:])
+    stats['created'] = len(new_items)
+    stats['updated'] = len(changed_items)
+
+    # bulk_create does not set primary keys on every database, so they are read back
+    item_ids = dict(Item.objects.filter(slug__in=[record['slug'] for record in records])
+                    .values_list('slug', 'pk'))
+
+    option_ids = {
+        (item_id, name): pk for pk, item_id, name in
+        Option.objects.filter(item_id__in=item_ids.values()).values_list('pk', 'item_id', 'name')
+    }
+    new_options = {
+        (item_ids[record['slug']], option['name'])
+        for record in records for option in record['options']
+    } - set(option_ids)
+
+    Option.objects.bulk_create([
+        Option(item_id=item_id, name=name) for item_id, name in sorted(new_options)
+    ])
+    stats['options'] = len(new_options)
+
+    if new_options:
+        option_ids.update({
+            (item_id, name): pk for pk, item_id, name in
+            Option.objects.filter(item_id__in={item_id for item_id, name in new_options})
+            .values_list('pk', 'item_id', 'name')
+        })
+
+    values = {}
+    for record in records:
+        for option in record['options']:
+            option_id = option_ids[(item_ids[record['slug']], option['name'])]
+            for value in option['values']:
+                values[(option_id, value['value'])] = value
+
+    existing_values = {
+        (value.option_id, value.value): value for value in
+        OptionValue.objects.filter(option_id__in={option_id for option_id, name in values})
+    }
+    new_values = []
+    changed_values = []
+
+    for (option_id, name), value in values.items():
+        option_value = existing_values.get((option_id, name))
+        if option_value is None:
+            new_values.append(OptionValue(
+                option_id=option_id,
+                value=name,
+                additional_price=value['additional_price'],
+                default=value['default']
+            ))
+
+        elif (option_value.additional_price, option_value.default) != (
+                value['additional_price'], value['default']):
+            option_value.additional_price = value['additional_price']
+            option_value.default = value['default']
+            changed_values.append(option_value)
+
+    OptionValue.objects.bulk_create(new_values)
+    OptionValue.objects.bulk_update(changed_values, ['additional_price', 'default'])
+    stats['values'] = len(new_values) + len(changed_values)
+
+    # the bulk queries skip the signals that keep the search index and caches up to date
+    index_items(Item.objects.filter(pk__in=item_ids.values()))
+    transaction.on_commit(bump_catalog_version)
+    return stats
+
+
+def iter_catalog(batch_size=500):
+    # items with their options and values, a batch of items in memory at a time
+    queryset = Item.objects.order_by('pk').prefetch_related('option_set__optionvalue_set')
+    last_pk = 0
+
+    while True:
+        batch = list(queryset.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            return
+
+        for item in batch:
+            record = {field: getattr(item, field) for field in ITEM_FIELDS}
+            record['options'] = [
+                {
+                    'name': option.name,
+                    'values': [
+                        {
+                            'value': value.value,
+                            'additional_price': value.additional_price,
+                            'default': value.default
+                        }
+                        for value in option.optionvalue_set.all()
+                    ]
+                }
+                for option in item.option_set.all()
+            ]
+            yield record
+
+        last_pk = batch[-1].pk
+
+
+def write_jsonl(records, file):
+    count = 0
+    for record in records:
+        file.write(json.dumps(record) + '\n')
+        count += 1
+    return count
+
+
+def write_csv(records, file):
+    writer = csv.DictWriter(file, fieldnames=CSV_FIELDS)
+    writer.writeheader()
+    count = 0
+
+    for record in records:
+        item = {field: record[field] for field in ITEM_FIELDS}
+        rows = []
+        for option in record['options']:
+            rows.extend(dict(item, option=option['name'], **value)
+                        for value in option['values'])
+            if not option['values']:
+                rows.append(dict(item, option=option['name']))
+
+        writer.writerows(rows or [item])
+        count += 1
+
+    return count
+
+
+def write_records(records, file, file_format):
+    writer = write_csv if file_format == 'csv' else write_jsonl
+    return writer(records, file)
@@ -0,0 +1,250 @@
+import random
+import re
+import string
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .cart import CartError, get_open_order_or_error, invalidate_cart_count, lock_cart
+from .gateways import PaymentError, get_gateway
+from .inventory import confirm_order, release_orders, reserve_order
+from .models import Address, Order, OrderItem, Payment, PaymentIntent
+
+
+PENDING = 'P'
+PROCESSING = 'R'
+SUCCEEDED = 'S'
+FAILED = 'F'
+
+# client supplied idempotency keys, e.g. a UUID; PaymentIntent.idempotency_key is 64 long
+IDEMPOTENCY_KEY_RE = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+def create_ref_code():
+    # create a random ordered char + number code which the length is 20
+    return ''.join(random.choices(string.ascii_lowercase + string.digits, k=20))
+
+
+@transaction.atomic
+def create_payment_intent(user, token, billing_address_id=None, shipping_address_id=None,
+                          save_card=False, idempotency_key=None):
+    # only records the checkout; the charge is made by the payment worker
+    if idempotency_key:
+        if not IDEMPOTENCY_KEY_RE.match(idempotency_key):
+            raise CartError('Invalid idempotency key.')
+
+        # keys are unique across users
+        intent = PaymentIntent.objects.filter(idempotency_key=idempotency_key).first()
+        if intent is not None:
+            if intent.user_id != user.pk:
+                raise CartError('This idempotency key is already in use.')
+            return intent
+
+    lock_cart(user, checkout=True)
+    order = get_open_order_or_error(user)
+
+    # a double submission returns the checkout already in progress
+    intent = PaymentIntent.objects.filter(
+        order=order, status__in=[PENDING, PROCESSING]).first()
+    if intent is not None:
+        return intent
+
+    if not token:
+        raise CartError('Invalid data received')
+
+    if not order.line_count:
+        raise CartError('Your cart is empty.')
+
+    try:
+        address_ids = [int(address_id) if address_id else None
+                       for address_id in (billing_address_id, shipping_address_id)]
+
+    except (TypeError, ValueError):
+        raise CartError('Invalid data received')
+
+    addresses = Address.objects.filter(user=user, pk__in=address_ids)
+    addresses = {address.pk: address for address in addresses}
+    billing_address = addresses.get(
+        address_ids[0]) if address_ids[0] else order.billing_address
+    shipping_address = addresses.get(
+        address_ids[1]) if address_ids[1] else order.shipping_address
+
+    if billing_address is None:
+        raise CartError('You have not added a billing address.')
+
+    # units are held from checkout until the payment succeeds or fails
+    reserve_order(order)
+
+    try:
+        return PaymentIntent.objects.create(
+            idempotency_key=idempotency_key or uuid.uuid4().hex,
+            user=user,
+            order=order,
+            amount=order.total,
+            stripe_token=token,
+            save_card=save_card,
+            billing_address=billing_address,
+            shipping_address=shipping_address
+        )
+
+    except IntegrityError:
+        # the same key sent at once by another user; rolls the reservation back
+        raise CartError('This idempotency key is already in use.')
+
+
+def claim_next_intent():
+    # at most one worker wins the conditional update, without holding a lock across the charge
+    while True:
+        intent = PaymentIntent.objects.filter(
+            status=PENDING).order_by('updated').first()
+        if intent is None:
+            return None
+
+        claim = uuid.uuid4().hex
+        claimed = PaymentIntent.objects.filter(pk=intent.pk, status=PENDING).update(
+            status=PROCESSING, claim=claim, attempts=F('attempts') + 1, updated=timezone.now())
+        if claimed:
+            intent.status = PROCESSING
+            intent.claim = claim
+            intent.attempts += 1
+            return intent
+
+
+def get_claimed(intent):
+    # the intent while this worker's lease on it holds
+    return PaymentIntent.objects.filter(pk=intent.pk, status=PROCESSING, claim=intent.claim)
+
+
+def release_stale_intents():
+    # intents of a worker that died mid-charge; retrying is safe thanks to the idempotency key
+    stale_before = timezone.now() - timedelta(seconds=settings.PAYMENT_INTENT_LEASE)
+    return PaymentIntent.objects.filter(status=PROCESSING, updated__lt=stale_before).update(
+        status=PENDING, claim='', updated=timezone.now())
+
+
+def retry_intent(intent, message):
+    return bool(get_claimed(intent).update(
+        status=PENDING, claim='', error=message[:255], updated=timezone.now()))
+
+
+@transaction.atomic
+def fail_intent(intent, message):
+    # returns False when the lease was lost, the intent is then left to its new worker
+    failed = get_claimed(intent).update(
+        status=FAILED, error=message[:255], updated=timezone.now())
+    if failed:
+        release_orders([intent.order_id])
+    return bool(failed)
+
+
+@transaction.atomic
+def finalize_order(intent, charge_id):
+    # a fixed number of statements whatever the cart size: lock the order, insert the
+    # payment, one UPDATE each for the lines, the order and the intent, then drop the
+    # stock reservations
+    ordered, total = Order.objects.select_for_update().values_list(
+        'ordered', 'total').get(pk=intent.order_id)
+    if ordered:
+        # never pay the same order twice
+        raise PaymentError('This order was already paid.')
+    if round(total, 2) != round(intent.amount, 2):
+        raise PaymentError('Your cart changed during the payment. You were refunded.')
+
+    payment = Payment.objects.create(
+        stripe_charge_id=charge_id,
+        user_id=intent.user_id,
+        amount=intent.amount
+    )
+
+    OrderItem.objects.filter(order=intent.order_id).update(ordered=True)
+
+    Order.objects.filter(pk=intent.order_id, ordered=False).update(
+        ordered=True,
+        ordered_date=timezone.now(),
+        payment=payment,
+        billing_address=intent.billing_address_id,
+        shipping_address=intent.shipping_address_id,
+        ref_code=create_ref_code()
+    )
+
+    succeeded = get_claimed(intent).update(
+        status=SUCCEEDED, payment=payment, error='', updated=timezone.now())
+    if not succeeded:
+        # re-claimed after the lease expired; rolls everything back
+        raise PaymentError('This payment is handled by another worker.')
+
+    confirm_order(intent.order_id)
+    invalidate_cart_count(intent.user_id)
+    return payment
+
+
+def process_intent(intent, gateway):
+    try:
+        charge_id = gateway.charge(intent)
+
+    except PaymentError as e:
+        if e.retryable and intent.attempts < settings.PAYMENT_INTENT_MAX_ATTEMPTS:
+            retry_intent(intent, str(e))
+        else:
+            fail_intent(intent, str(e))
+        return
+
+    except Exception:
+        # send an email to ourselves
+        fail_intent(intent, 'A serious error occurred. We have been notified.')
+        raise
+
+    try:
+        finalize_order(intent, charge_id)
+
+    except PaymentError as e:
+        if not get_claimed(intent).exists():
+            # re-claimed after the lease expired: the new worker replays the same charge,
+            # then finalizes or refunds it (or already has)
+            return
+
+        try:
+            gateway.refund(intent, charge_id)
+        except PaymentError:
+            # stays claimed, so it is charged (replayed) and refunded again after the lease
+            return
+
+        fail_intent(intent, str(e))
+
+
+def process_pending_intents(gateway=None, limit=None):
+    # returns the number of intents processed
+    gateway = gateway or get_gateway()
+    release_stale_intents()
+    processed = 0
+
+    while limit is None or processed < limit:
+        intent = claim_next_intent()
+        if intent is None:
+            break
+
+        process_intent(intent, gateway)
+        processed += 1
+
+    return processed
+
+
+def get_intent_status(intent):
+    data = {
+        'idempotencyKey': intent.idempotency_key,
+        'status': intent.get_status_display().lower(),
+        'amount': intent.amount
+    }
+
+    if intent.status == SUCCEEDED:
+        data['refCode'] = Order.objects.values_list(
+            'ref_code', flat=True).get(pk=intent.order_id)
+
+    if intent.status == FAILED:
+        data['message'] = intent.error
+
+    return data
@@ -0,0 +1,118 @@
+import threading
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, FloatField, Sum
+from django.db.models.signals import post_delete, post_save
+
+from .models import Coupon, OrderItem
+
+
+COUPONS_VERSION_KEY = 'coupons:version'
+
+# coupon definitions of this process by code and by id, dropped when the shared version
+# changes; the usage counter is never read from them
+_coupons = {'version': None, 'by_code': {}, 'by_id': {}}
+_coupons_lock = threading.Lock()
+
+
+def get_coupons_version():
+    version = cache.get(COUPONS_VERSION_KEY)
+
+    # seed from the clock so a flushed cache never reuses an old version
+    if version is None:
+        cache.add(COUPONS_VERSION_KEY, int(time.time() * 1000), None)
+        version = cache.get(COUPONS_VERSION_KEY)
+
+    return version
+
+
+def bump():
+    try:
+        cache.incr(COUPONS_VERSION_KEY)
+
+    except ValueError:
+        get_coupons_version()
+        cache.incr(COUPONS_VERSION_KEY)
+
+
+def bump_coupons_version(*args, **kwargs):
+    # again on commit, in case another process reloaded the old row in between
+    bump()
+    transaction.on_commit(bump)
+
+
+def get_definitions():
+    version = get_coupons_version()
+
+    with _coupons_lock:
+        if _coupons['version'] != version:
+            _coupons.update(version=version, by_code={}, by_id={})
+        return _coupons
+
+
+def remember(coupons, coupon):
+    with _coupons_lock:
+        coupons['by_code'][coupon.code] = coupon
+        coupons['by_id'][coupon.pk] = coupon
+    return coupon
+
+
+def get_coupon(code):
+    # the active coupon with this code, or None; unknown codes are not remembered
+    coupons = get_definitions()
+    coupon = coupons['by_code'].get(code)
+    if coupon is not None:
+        return coupon if coupon.active else None
+
+    coupon = Coupon.objects.filter(code=code).first()
+    if coupon is None:
+        return None
+
+    remember(coupons, coupon)
+    return coupon if coupon.active else None
+
+
+def get_coupon_by_id(coupon_id):
+    # the coupon of a cart, even if it was deactivated since
+    coupons = get_definitions()
+    coupon = coupons['by_id'].get(coupon_id)
+    if coupon is None:
+        coupon = remember(coupons, Coupon.objects.get(pk=coupon_id))
+    return coupon
+
+
+def redeem(coupon):
+    # one conditional UPDATE, so concurrent carts never take more uses than the limit;
+    # codes without a limit are not counted and never contend on their row
+    if coupon.max_uses is None:
+        return True
+
+    return bool(Coupon.objects.filter(pk=coupon.pk, active=True, used__lt=F('max_uses')).update(
+        used=F('used') + 1))
+
+
+def release(coupon_id, count=1):
+    # gives back the uses of carts that dropped the coupon or were deleted
+    Coupon.objects.filter(pk=coupon_id, max_uses__isnull=False, used__gte=count).update(
+        used=F('used') - count)
+
+
+def get_eligible_subtotal(order, coupon, subtotal):
+    # subtotal of the lines the coupon applies to, from the line price snapshots
+    if not coupon.category:
+        return subtotal
+
+    eligible = OrderItem.objects.filter(order=order, item__category=coupon.category).aggregate(
+        eligible=Sum(F('quantity') * F('final_unit_price'), output_field=FloatField()))['eligible']
+    return eligible or 0
+
+
+def get_coupon_amount(order, coupon, subtotal):
+    # subtotal: the cart subtotal once the pending line changes are applied
+    return coupon.get_discount(subtotal, get_eligible_subtotal(order, coupon, subtotal))
+
+
+post_save.connect(bump_coupons_version, sender=Coupon)
+post_delete.connect(bump_coupons_version, sender=Coupon)
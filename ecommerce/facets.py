@@ -0,0 +1,163 @@
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Q
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_save, post_delete
+
+from .catalog import bump_catalog_version, get_cached
+from .models import CATEGORY_CHOICES, LABEL_CHOICES, FacetCount, Item, Option, OptionValue
+
+
+FILTER_PARAMS = ('category', 'label', 'price', 'option')
+
+
+def get_price_ranges():
+    # {key: (min, max)}, the key being the value of the price filter, e.g. 100-500
+    return {
+        '{}-{}'.format(low, '' if high is None else high): (low, high)
+        for low, high in settings.FACET_PRICE_RANGES
+    }
+
+
+def get_price_name(low, high):
+    if high is None:
+        return f'${low}+'
+    return f'${low} - ${high}'
+
+
+def price_filter(low, high):
+    # on the price the customer pays, see with_effective_price()
+    condition = Q(effective_price__gte=low)
+    if high is not None:
+        condition &= Q(effective_price__lt=high)
+    return condition
+
+
+def with_effective_price(queryset):
+    return queryset.annotate(effective_price=Coalesce('discount_price', 'price'))
+
+
+def get_filters(params):
+    # the selected values of each facet, in a canonical order so they can key caches
+    filters = {}
+
+    for name in FILTER_PARAMS:
+        values = sorted(set(params.getlist(name)))
+        if values:
+            filters[name] = values
+
+    return filters
+
+
+def filter_items(queryset, filters):
+    # values of the same facet are alternatives, different facets must all match
+    if 'category' in filters:
+        queryset = queryset.filter(category__in=filters['category'])
+
+    if 'label' in filters:
+        queryset = queryset.filter(label__in=filters['label'])
+
+    if 'price' in filters:
+        ranges = get_price_ranges()
+        condition = Q(pk__in=[])
+        for key in filters['price']:
+            if key in ranges:
+                condition |= price_filter(*ranges[key])
+        queryset = with_effective_price(queryset).filter(condition)
+
+    if 'option' in filters:
+        # option values are per item, so they are selected by option name and value
+        selected = defaultdict(list)
+        for option in filters['option']:
+            name, separator, value = option.partition(':')
+            selected[name].append(value)
+
+        for name, values in selected.items():
+            queryset = queryset.filter(pk__in=OptionValue.objects.filter(
+                option__name=name, value__in=values).values('option__item_id'))
+
+    return queryset
+
+
+@transaction.atomic
+def refresh_facet_counts():
+    # one GROUP BY per facet over the whole catalog, stored in display order
+    rows = []
+
+    categories = dict(Item.objects.values_list('category').annotate(
+        count=Count('pk')).order_by())
+    rows.extend(
+        FacetCount(facet='category', value=value,
+                   name=name, count=categories[value])
+        for value, name in CATEGORY_CHOICES if categories.get(value)
+    )
+
+    labels = dict(Item.objects.values_list('label').annotate(
+        count=Count('pk')).order_by())
+    rows.extend(
+        FacetCount(facet='label', value=value,
+                   name=name, count=labels[value])
+        for value, name in LABEL_CHOICES if labels.get(value)
+    )
+
+    ranges = get_price_ranges()
+    prices = with_effective_price(Item.objects.all()).aggregate(**{
+        key: Count('pk', filter=price_filter(low, high))
+        for key, (low, high) in ranges.items()
+    })
+    rows.extend(
+        FacetCount(facet='price', value=key,
+                   name=get_price_name(low, high), count=prices[key])
+        for key, (low, high) in ranges.items() if prices[key]
+    )
+
+    options = OptionValue.objects.values_list('option__name', 'value').annotate(
+        count=Count('option__item', distinct=True)).order_by('option__name', 'value')
+    rows.extend(
+        FacetCount(facet='option', value=f'{name}:{value}',
+                   name=value, count=count)
+        for name, value, count in options
+    )
+
+    FacetCount.objects.all().delete()
+    FacetCount.objects.bulk_create(rows)
+
+    # pages cached while the counts were being refreshed are dropped
+    transaction.on_commit(bump_catalog_version)
+    return len(rows)
+
+
+def load_facet_counts():
+    facets = {facet: [] for facet in FILTER_PARAMS}
+
+    for facet, value, name, count in FacetCount.objects.order_by('pk').values_list(
+            'facet', 'value', 'name', 'count'):
+        entry = {'value': value, 'name': name, 'count': count}
+        if facet == 'option':
+            entry['option'] = value.partition(':')[0]
+        facets[facet].append(entry)
+
+    return facets
+
+
+def get_facet_counts():
+    # the sidebar of every page, read from the summary table once per catalog version
+    return get_cached('facet-counts', '', load_facet_counts)
+
+
+def schedule_refresh(*args, **kwargs):
+    # refresh once per transaction, however many catalog rows it changed
+    connection = transaction.get_connection()
+    if not any(func is refresh_facet_counts for sids, func in connection.run_on_commit):
+        transaction.on_commit(refresh_facet_counts)
+
+
+# bulk operations skip these signals and call refresh_facet_counts() themselves
+post_save.connect(schedule_refresh, sender=Item)
+post_delete.connect(schedule_refresh, sender=Item)
+post_save.connect(schedule_refresh, sender=Option)
+post_delete.connect(schedule_refresh, sender=Option)
+post_save.connect(schedule_refresh, sender=OptionValue)
+post_delete.connect(schedule_refresh, sender=OptionValue)
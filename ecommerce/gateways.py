@@ -0,0 +1,123 @@
+import itertools
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+import stripe
+
+stripe.api_key = settings.STRIPE_SECRET_KEY
+
+
+class PaymentError(Exception):
+    # the message is shown to the user as is; retryable errors are tried again later
+    def __init__(self, message, retryable=False):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class StripeGateway:
+    def charge(self, intent):
+        # returns the charge id; the idempotency key makes a retried charge replay the first one
+        try:
+            if intent.save_card:
+                customer_id = self.get_customer(intent)
+                charge = stripe.Charge.create(
+                    amount=int(intent.amount * 100),  # cents
+                    currency='usd',
+                    customer=customer_id,
+                    idempotency_key=intent.idempotency_key
+                )
+            else:
+                charge = stripe.Charge.create(
+                    amount=int(intent.amount * 100),  # cents
+                    currency='usd',
+                    source=intent.stripe_token,
+                    idempotency_key=intent.idempotency_key
+                )
+            return charge['id']
+
+        except stripe.error.CardError as e:
+            body = e.json_body
+            err = body.get('error', {})
+            raise PaymentError(f"{err.get('message')}")
+
+        except stripe.error.RateLimitError:
+            # Too many requests made to the API too quickly
+            raise PaymentError('Rate limit error', retryable=True)
+
+        except stripe.error.InvalidRequestError:
+            # Invalid parameters were supplied to Stripe's API
+            raise PaymentError('Invalid parameters')
+
+        except stripe.error.AuthenticationError:
+            # Authentication with Stripe's API failed
+            # (maybe you changed API keys recently)
+            raise PaymentError('Not authenticated')
+
+        except stripe.error.APIConnectionError:
+            # Network communication with Stripe failed
+            raise PaymentError('Network error', retryable=True)
+
+        except stripe.error.StripeError:
+            raise PaymentError(
+                'Something went wrong. You were not charged. Please try again.')
+
+    def refund(self, intent, charge_id):
+        # refunds the whole charge; retried refunds replay the first one
+        try:
+            stripe.Refund.create(
+                charge=charge_id,
+                idempotency_key=f'{intent.idempotency_key}-refund'
+            )
+
+        except stripe.error.StripeError:
+            raise PaymentError('Refund failed', retryable=True)
+
+    def get_customer(self, intent):
+        userprofile = intent.user.userprofile
+
+        # if stripe id already exists
+        if userprofile.stripe_customer_id:
+            customer = stripe.Customer.retrieve(userprofile.stripe_customer_id)
+            customer.sources.create(
+                source=intent.stripe_token,
+                idempotency_key=f'{intent.idempotency_key}-source'
+            )
+            return customer['id']
+
+        # if stripe id doesn't exist
+        customer = stripe.Customer.create(
+            email=intent.user.email,
+            source=intent.stripe_token,
+            idempotency_key=f'{intent.idempotency_key}-customer'
+        )
+        userprofile.stripe_customer_id = customer['id']
+        userprofile.one_click_purchasing = True
+        userprofile.save(
+            update_fields=['stripe_customer_id', 'one_click_purchasing'])
+        return customer['id']
+
+
+class FakeGateway:
+    # local stand-in for Stripe: 'tok_chargeDeclined' is declined, anything else succeeds
+    ids = itertools.count(1)
+
+    def __init__(self):
+        self.refunds = []
+
+    def charge(self, intent):
+        if settings.FAKE_PAYMENT_GATEWAY_DELAY:
+            time.sleep(settings.FAKE_PAYMENT_GATEWAY_DELAY)
+
+        if intent.stripe_token == 'tok_chargeDeclined':
+            raise PaymentError('Your card was declined.')
+
+        return f'ch_fake_{next(self.ids)}'
+
+    def refund(self, intent, charge_id):
+        self.refunds.append(charge_id)
+
+
+def get_gateway(path=None):
+    return import_string(path or settings.PAYMENT_GATEWAY)()
@@ -0,0 +1,233 @@
+from django.conf import settings
+from django.contrib.auth.signals import user_logged_in
+from django.core import signing
+from django.db.models import Count
+
+from .cart import CartError, clean_options, merge_lines
+from .models import Item, OptionValue, OrderItem, get_option_signature
+from .pricing import get_unit_prices, price_lines
+
+
+SALT = 'ecommerce.guest_cart'
+
+
+def get_key(item_id, option_ids):
+    # item id and sorted option value ids, e.g. '12:3,7'
+    return '{}:{}'.format(item_id, ','.join(str(option_id) for option_id in sorted(option_ids)))
+
+
+def parse_key(key):
+    item_id, separator, option_ids = key.partition(':')
+    return int(item_id), [int(option_id) for option_id in option_ids.split(',') if option_id]
+
+
+class GuestCart:
+    # cart of an anonymous visitor, kept in a signed cookie as {key: quantity} so that
+    # browsing costs no database writes; merged into the user's order on login
+    def __init__(self, lines=None):
+        self.lines = dict(lines or {})
+        self.modified = False
+        self._resolved = None
+        self._lines = None
+
+    @classmethod
+    def from_request(cls, request):
+        value = request.COOKIES.get(settings.GUEST_CART_COOKIE)
+        if not value:
+            return cls()
+
+        try:
+            lines = signing.loads(value, salt=SALT, max_age=settings.GUEST_CART_MAX_AGE)
+            for key, quantity in lines.items():
+                parse_key(key)
+                if not isinstance(quantity, int) or quantity < 1:
+                    raise ValueError
+
+        except (signing.BadSignature, AttributeError, ValueError):
+            # tampered with, expired or from an older format
+            cart = cls()
+            cart.modified = True
+            return cart
+
+        return cls(lines)
+
+    def dumps(self):
+        return signing.dumps(self.lines, salt=SALT, compress=True)
+
+    def save(self, response):
+        if not self.lines:
+            response.delete_cookie(settings.GUEST_CART_COOKIE)
+            return
+
+        response.set_cookie(
+            settings.GUEST_CART_COOKIE,
+            self.dumps(),
+            max_age=settings.GUEST_CART_MAX_AGE,
+            secure=settings.SESSION_COOKIE_SECURE,
+            httponly=True,
+            samesite='Lax'
+        )
+
+    def changed(self):
+        self.modified = True
+        self._resolved = None
+        self._lines = None
+
+    def get_count(self):
+        return len(self.lines)
+
+    def find_key(self, item, option_ids=None):
+        # without options, the first line of the item is used
+        if option_ids is not None:
+            key = get_key(item.pk, clean_options(item, option_ids))
+            if key in self.lines:
+                return key
+
+        else:
+            for key in self.lines:
+                if parse_key(key)[0] == item.pk:
+                    return key
+
+        raise CartError('This item is not in your cart.')
+
+    def add(self, item, option_ids=(), quantity=1):
+        # returns whether a line was created, like ecommerce.cart.add_to_cart
+        key = get_key(item.pk, clean_options(item, option_ids))
+        created = key not in self.lines
+
+        if created and len(self.lines) >= settings.GUEST_CART_MAX_LINES:
+            raise CartError('Your cart is full, please log in to add more items.')
+
+        self.lines[key] = self.lines.get(key, 0) + quantity
+        self.changed()
+        return created
+
+    def subtract(self, item, option_ids=None):
+        key = self.find_key(item, option_ids)
+
+        if self.lines[key] > 1:
+            self.lines[key] -= 1
+        else:
+            del self.lines[key]
+        self.changed()
+
+    def remove(self, item, option_ids=None):
+        self.remove_key(self.find_key(item, option_ids))
+
+    def remove_key(self, key):
+        if key not in self.lines:
+            raise CartError('This item is not in your cart.')
+
+        del self.lines[key]
+        self.changed()
+
+    def update(self, operations):
+        # applies ecommerce.cart.parse_operations(), the lines being identified by their
+        # key; the cart is left unchanged if an operation fails
+        lines = dict(self.lines)
+
+        try:
+            for index, operation in enumerate(operations):
+                if operation[0] == 'add':
+                    op, item, option_ids, quantity = operation
+                    key = get_key(item.pk, option_ids)
+                    if key not in self.lines and len(self.lines) >= settings.GUEST_CART_MAX_LINES:
+                        raise CartError('Your cart is full, please log in to add more items.')
+                    self.lines[key] = self.lines.get(key, 0) + quantity
+                    continue
+
+                key = operation[1]
+                if not isinstance(key, str) or (key not in lines and key not in self.lines):
+                    raise CartError('This item is not in your cart.')
+
+                if operation[0] == 'set' and operation[2]:
+                    self.lines[key] = operation[2]
+                else:
+                    self.lines.pop(key, None)
+
+        except CartError as e:
+            self.lines = lines
+            raise CartError(f'Operation {index}: {e}')
+
+        self.changed()
+
+    def clear(self):
+        if self.lines:
+            self.lines = {}
+            self.changed()
+
+    def resolve(self):
+        # [(key, item, option values, quantity)] in two queries; lines whose item or
+        # options no longer exist, or whose options are no longer complete, are skipped
+        if self._resolved is not None:
+            return self._resolved
+
+        parsed = {key: parse_key(key) for key in self.lines}
+        items = Item.objects.annotate(option_count=Count('option')).in_bulk(
+            {item_id for item_id, option_ids in parsed.values()})
+        values = OptionValue.objects.select_related('option').in_bulk(
+            {option_id for item_id, option_ids in parsed.values() for option_id in option_ids})
+
+        self._resolved = []
+        for key, (item_id, option_ids) in parsed.items():
+            item = items.get(item_id)
+            options = [values[option_id] for option_id in option_ids if option_id in values]
+
+            if item is None or len(options) != len(option_ids) or len(options) != item.option_count:
+                continue
+
+            if any(value.option.item_id != item_id for value in options):
+                continue
+
+            if len({value.option_id for value in options}) != len(options):
+                continue
+
+            self._resolved.append((key, item, options, self.lines[key]))
+
+        return self._resolved
+
+    def get_lines(self):
+        # unsaved order lines, priced at the current price of their selection
+        if self._lines is not None:
+            return self._lines
+
+        resolved = self.resolve()
+        prices = get_unit_prices(
+            (item, [value.pk for value in options]) for key, item, options, quantity in resolved)
+        lines = []
+
+        for key, item, options, quantity in resolved:
+            order_item = OrderItem(item=item, quantity=quantity)
+            order_item.snapshot_prices(
+                prices[(item.pk, get_option_signature([value.pk for value in options]))])
+            order_item.key = key
+            order_item.options = options
+            lines.append(order_item)
+
+        self._lines = lines
+        return lines
+
+    def get_total(self):
+        return price_lines(self.get_lines()).total
+
+    def merge_into(self, user):
+        lines = [
+            (item, {value.pk for value in options}, quantity)
+            for key, item, options, quantity in self.resolve()
+        ]
+        if lines:
+            merge_lines(user, lines)
+        self.clear()
+
+
+def merge_on_login(sender, request, user, **kwargs):
+    guest_cart = getattr(request, 'guest_cart', None)
+    if guest_cart is not None and guest_cart.lines:
+        try:
+            guest_cart.merge_into(user)
+        except CartError:
+            # e.g. a checkout in progress: the cookie keeps the lines until the next login
+            pass
+
+
+user_logged_in.connect(merge_on_login)
@@ -0,0 +1,193 @@
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+from django.db.models import Q
+from django.db.models.signals import post_save
+from PIL import Image, ImageOps
+
+from .catalog import bump_catalog_version
+from .models import Item, OptionValue
+
+
+logger = logging.getLogger('ecommerce.images')
+
+# Pillow format and save options of each derivative format
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True})
+}
+
+# the image field of each model and the field storing the content hash of its derivatives
+IMAGE_FIELDS = {
+    Item: ('image', 'image_hash'),
+    OptionValue: ('attachment', 'attachment_hash')
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def derivative_name(content_hash, width, image_format):
+    # the name changes with the content, so the files can be cached forever
+    return f'derivatives/{content_hash[:2]}/{content_hash}/{width}.{image_format}'
+
+
+def get_srcset(content_hash):
+    # {format: srcset}, or None until the derivatives are built
+    if not content_hash:
+        return None
+
+    return {
+        image_format: ', '.join(
+            '{} {}w'.format(default_storage.url(derivative_name(
+                content_hash, width, image_format)), width)
+            for width in settings.IMAGE_DERIVATIVE_WIDTHS
+        )
+        for image_format in FORMATS
+    }
+
+
+def save_derivative(image, name, image_format):
+    pillow_format, options = FORMATS[image_format]
+
+    # JPEG has no alpha channel, transparent pixels become white
+    if pillow_format == 'JPEG' and image.mode != 'RGB':
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        image = background
+
+    buffer = BytesIO()
+    image.save(buffer, pillow_format, **options)
+
+    if default_storage.exists(name):
+        default_storage.delete(name)
+    default_storage.save(name, ContentFile(buffer.getvalue()))
+
+
+def build_derivatives(name, force=False):
+    # returns the content hash of the stored image, once all of its derivatives exist
+    with default_storage.open(name) as source:
+        data = source.read()
+
+    content_hash = hashlib.sha256(data).hexdigest()[:32]
+    widths = sorted(settings.IMAGE_DERIVATIVE_WIDTHS, reverse=True)
+    missing = {
+        (width, image_format) for width in widths for image_format in FORMATS
+        if force or not default_storage.exists(derivative_name(content_hash, width, image_format))
+    }
+
+    if not missing:
+        return content_hash
+
+    image = ImageOps.exif_transpose(Image.open(BytesIO(data)))
+    image = image.convert('RGBA' if 'A' in image.getbands()
+                          or 'transparency' in image.info else 'RGB')
+
+    # each width is resized from the previous one, and smaller images are never upscaled
+    for width in widths:
+        image.thumbnail((width, image.height), Image.LANCZOS)
+        for image_format in FORMATS:
+            if (width, image_format) in missing:
+                save_derivative(image, derivative_name(
+                    content_hash, width, image_format), image_format)
+
+    return content_hash
+
+
+def build_rows(model_label, rows, force=False):
+    # [(pk, image name)] -> [(pk, image name, content hash)], run by the backfill processes
+    built = []
+
+    for pk, name in rows:
+        try:
+            built.append((pk, name, build_derivatives(name, force)))
+
+        except Exception:
+            logger.exception('Cannot build the derivatives of %s %s (%s)',
+                             model_label, pk, name)
+
+    return built
+
+
+def store_hashes(model, built):
+    # the hash is only stored if the image was not replaced in the meantime; update()
+    # skips the catalog signals, so the cached catalog pages are invalidated here
+    field, hash_field = IMAGE_FIELDS[model]
+
+    with transaction.atomic():
+        updated = 0
+        for pk, name, content_hash in built:
+            updated += model.objects.filter(pk=pk, **{field: name}).exclude(
+                **{hash_field: content_hash}).update(**{hash_field: content_hash})
+
+        if updated:
+            transaction.on_commit(bump_catalog_version)
+
+    return updated
+
+
+def process_instance(model, pk):
+    field, hash_field = IMAGE_FIELDS[model]
+    name = model.objects.filter(pk=pk).values_list(field, flat=True).first()
+
+    if name:
+        store_hashes(model, build_rows(model._meta.label, [(pk, name)]))
+
+
+def run_in_thread(model, pk):
+    try:
+        process_instance(model, pk)
+
+    finally:
+        connections.close_all()
+
+
+def get_executor():
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.IMAGE_DERIVATIVE_WORKERS,
+                thread_name_prefix='image-derivatives'
+            )
+        return _executor
+
+
+def clear_hash(model, pk):
+    # the image was removed: stop advertising its derivatives; update() fires no signal
+    field, hash_field = IMAGE_FIELDS[model]
+    empty = Q(**{field: ''}) | Q(**{f'{field}__isnull': True})
+    cleared = model.objects.filter(empty, pk=pk).exclude(
+        **{hash_field: ''}).update(**{hash_field: ''})
+
+    if cleared:
+        transaction.on_commit(bump_catalog_version)
+    return cleared
+
+
+def schedule_derivatives(sender, instance, **kwargs):
+    # rendering is slow, so it never runs in the request that uploaded the image
+    field, hash_field = IMAGE_FIELDS[sender]
+    if not getattr(instance, field):
+        if getattr(instance, hash_field):
+            clear_hash(sender, instance.pk)
+            setattr(instance, hash_field, '')
+        return
+
+    if settings.IMAGE_DERIVATIVES_ASYNC:
+        transaction.on_commit(lambda: get_executor().submit(
+            run_in_thread, sender, instance.pk))
+    else:
+        transaction.on_commit(lambda: process_instance(sender, instance.pk))
+
+
+post_save.connect(schedule_derivatives, sender=Item)
+post_save.connect(schedule_derivatives, sender=OptionValue)
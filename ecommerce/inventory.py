@@ -0,0 +1,124 @@
+import random
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Sum
+
+from .cart import CartError
+from .models import Reservation, Stock, get_option_signature
+
+
+def get_shard_count(item):
+    # best sellers are the rows concurrent checkouts fight over
+    return settings.STOCK_SHARDS if item.label == 'B' else 1
+
+
+@transaction.atomic
+def set_stock(item, option_ids, quantity):
+    # the units of a selection left to sell, spread evenly over its shards
+    signature = get_option_signature(option_ids)
+    shards = get_shard_count(item)
+    per_shard, extra = divmod(quantity, shards)
+
+    for shard in range(shards):
+        Stock.objects.update_or_create(
+            item=item, option_signature=signature, shard=shard,
+            defaults={'quantity': per_shard + (shard < extra)})
+
+    # shards of an earlier, larger split are kept for their reservations
+    Stock.objects.filter(item=item, option_signature=signature,
+                         shard__gte=shards).update(quantity=0)
+
+
+def get_available(item, option_ids=()):
+    # None when the selection is not tracked
+    return Stock.objects.filter(
+        item=item, option_signature=get_option_signature(option_ids)
+    ).aggregate(available=Sum('quantity'))['available']
+
+
+def take(shards, quantity):
+    # [(stock id, units)] decremented from the shards, or None when they hold fewer units;
+    # every decrement is a conditional UPDATE, never a read then a write
+    shards = list(shards)
+    random.shuffle(shards)
+
+    # usually a single shard holds the whole quantity, and the checkout locks one row
+    for pk in shards:
+        if Stock.objects.filter(pk=pk, quantity__gte=quantity).update(quantity=F('quantity') - quantity):
+            return [(pk, quantity)]
+
+    # otherwise the rest of each shard, the quantities read being only a hint
+    taken = []
+    remaining = quantity
+    for pk, available in Stock.objects.filter(pk__in=shards, quantity__gt=0).order_by(
+            'pk').values_list('pk', 'quantity'):
+        units = min(available, remaining)
+        if Stock.objects.filter(pk=pk, quantity__gte=units).update(quantity=F('quantity') - units):
+            taken.append((pk, units))
+            remaining -= units
+            if not remaining:
+                return taken
+
+    return None
+
+
+@transaction.atomic
+def reserve_order(order):
+    # takes the units of every tracked line of the cart, or none of them; a repeated
+    # checkout gives back what the previous one took first
+    release_orders([order.pk])
+
+    wanted = defaultdict(int)
+    titles = {}
+    for item_id, signature, quantity, title in order.items.values_list(
+            'item_id', 'option_signature', 'quantity', 'item__title'):
+        wanted[(item_id, signature)] += quantity
+        titles[item_id] = title
+
+    shards = defaultdict(list)
+    for pk, item_id, signature in Stock.objects.filter(
+            item_id__in=titles).values_list('pk', 'item_id', 'option_signature'):
+        shards[(item_id, signature)].append(pk)
+
+    reservations = []
+    # a fixed order, so concurrent checkouts of the same items lock rows in the same order
+    for (item_id, signature), quantity in sorted(wanted.items()):
+        if not shards[(item_id, signature)]:
+            continue
+
+        taken = take(shards[(item_id, signature)], quantity)
+        if taken is None:
+            raise CartError(f'There are not enough {titles[item_id]} left in stock.')
+
+        reservations.extend(
+            Reservation(order=order, stock_id=pk, quantity=units) for pk, units in taken)
+
+    Reservation.objects.bulk_create(reservations)
+    return reservations
+
+
+@transaction.atomic
+def release_orders(order_ids):
+    # puts the units reserved by these carts back on their shards
+    reserved = defaultdict(int)
+    pks = []
+    for pk, stock_id, quantity in Reservation.objects.select_for_update().filter(
+            order__in=order_ids).values_list('pk', 'stock_id', 'quantity'):
+        reserved[stock_id] += quantity
+        pks.append(pk)
+
+    if not pks:
+        return 0
+
+    for stock_id, quantity in sorted(reserved.items()):
+        Stock.objects.filter(pk=stock_id).update(quantity=F('quantity') + quantity)
+
+    Reservation.objects.filter(pk__in=pks).delete()
+    return sum(reserved.values())
+
+
+def confirm_order(order_id):
+    # a paid order keeps its units
+    Reservation.objects.filter(order=order_id).delete()
@@ -0,0 +1,135 @@
+import json
+import time
+from collections import Counter
+
+from django.contrib.auth import get_user_model
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+
+from .cart import invalidate_cart_count
+from .checkout import PENDING, PROCESSING
+from .coupons import release
+from .inventory import release_orders
+from .models import ArchivedOrder, Order, OrderItem
+from .order_export import serialize_order
+
+
+class Budget:
+    # wall clock deadline shared by the phases of a run, checked between batches
+    def __init__(self, seconds=None):
+        self.deadline = None if seconds is None else time.monotonic() + seconds
+
+    @property
+    def exhausted(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+
+def get_idle_carts(idle_before):
+    # carts with a payment in flight are left to the payment worker
+    return Order.objects.filter(ordered=False, updated__lt=idle_before).exclude(
+        paymentintent__status__in=[PENDING, PROCESSING])
+
+
+def get_orphan_lines():
+    # lines no order links to any more, e.g. left by removals before ecommerce.cart
+    return OrderItem.objects.filter(order__isnull=True)
+
+
+def get_archivable_orders(ordered_before):
+    # received orders without an open refund request
+    return Order.objects.filter(
+        ordered=True, received=True, ordered_date__lt=ordered_before).exclude(refund_requested=True)
+
+
+def run_in_batches(queryset, batch_size, budget, process):
+    # process(batch of pks) deletes or archives them and returns (objects, rows)
+    queryset = queryset.order_by('pk').values_list('pk', flat=True)
+    totals = {'objects': 0, 'rows': 0}
+    last_pk = 0
+
+    while not budget.exhausted:
+        batch = list(queryset.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            break
+
+        with transaction.atomic():
+            objects, rows = process(batch)
+        totals['objects'] += objects
+        totals['rows'] += rows
+        last_pk = batch[-1]
+
+    return totals
+
+
+def expire_carts(idle_before, batch_size=500, budget=None):
+    def process(batch):
+        # lock the owners like ecommerce.cart does, then make sure the carts are still idle
+        user_ids = Order.objects.filter(pk__in=batch).values_list('user_id', flat=True)
+        list(get_user_model().objects.select_for_update().filter(
+            pk__in=list(user_ids)).values_list('pk', flat=True))
+
+        carts = {
+            pk: (user_id, coupon_id) for pk, user_id, coupon_id in
+            get_idle_carts(idle_before).filter(pk__in=batch).values_list('pk', 'user_id', 'coupon_id')
+        }
+        if not carts:
+            return 0, 0
+
+        # give back the stock units and coupon uses the carts were holding
+        release_orders(list(carts))
+        lines, per_model = OrderItem.objects.filter(order__in=list(carts)).delete()
+        orders, per_model = Order.objects.filter(pk__in=list(carts)).delete()
+
+        for coupon_id, count in Counter(
+                coupon_id for user_id, coupon_id in carts.values() if coupon_id).items():
+            release(coupon_id, count)
+
+        for user_id in {user_id for user_id, coupon_id in carts.values()}:
+            invalidate_cart_count(user_id)
+        return len(carts), lines + orders
+
+    return run_in_batches(get_idle_carts(idle_before), batch_size, budget or Budget(), process)
+
+
+def delete_orphan_lines(batch_size=500, budget=None):
+    def process(batch):
+        queryset = get_orphan_lines().filter(pk__in=batch)
+        count = queryset.count()
+        rows, per_model = queryset.delete()
+        return count, rows
+
+    return run_in_batches(get_orphan_lines(), batch_size, budget or Budget(), process)
+
+
+def archive_orders(ordered_before, batch_size=500, budget=None):
+    def process(batch):
+        orders = list(get_archivable_orders(ordered_before).filter(pk__in=batch).with_items()
+                      .select_related('user', 'payment', 'billing_address', 'shipping_address')
+                      .prefetch_related('refund_set'))
+        if not orders:
+            return 0, 0
+
+        archived = []
+        for order in orders:
+            data = serialize_order(order)
+            data['refunds'] = [
+                {'reason': refund.reason, 'accepted': refund.accepted, 'email': refund.email}
+                for refund in order.refund_set.all()
+            ]
+            archived.append(ArchivedOrder(
+                order_id=order.pk,
+                user_id=order.user_id,
+                ref_code=order.ref_code,
+                ordered_date=order.ordered_date,
+                total=order.total,
+                data=json.dumps(data, cls=DjangoJSONEncoder)
+            ))
+        ArchivedOrder.objects.bulk_create(archived)
+
+        # refunds and payment intents go with the order, payments are kept
+        order_ids = [order.pk for order in orders]
+        lines, per_model = OrderItem.objects.filter(order__in=order_ids).delete()
+        rows, per_model = Order.objects.filter(pk__in=order_ids).delete()
+        return len(orders), lines + rows
+
+    return run_in_batches(get_archivable_orders(ordered_before), batch_size, budget or Budget(), process)
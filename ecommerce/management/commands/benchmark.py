@@ -0,0 +1,164 @@
+import json
+import platform
+import subprocess
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.utils import timezone
+
+from ecommerce.benchmarks.checkout import run_finalization
+from ecommerce.benchmarks.coupons import run_coupon_scenario
+from ecommerce.benchmarks.inventory import run_inventory_scenario
+from ecommerce.benchmarks.routes import ROUTES
+from ecommerce.benchmarks.runner import compare_results, run_benchmarks
+from ecommerce.benchmarks.seed import seed
+from ecommerce.benchmarks.servers import run_server_scenario
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = 'Seed a throwaway test database and measure every storefront and API route'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenario', choices=['routes', 'checkout', 'coupons', 'inventory', 'servers'],
+                            default='routes',
+                            help='routes: every URL; checkout: order finalization by cart size; '
+                                 'coupons: every user redeeming the same code at once; '
+                                 'inventory: every user checking out the same best seller at once; '
+                                 'servers: slow clients of the read endpoints over WSGI and ASGI')
+        parser.add_argument('--items', type=int, default=100)
+        parser.add_argument('--options', type=int, default=2,
+                            help='options per item')
+        parser.add_argument('--values', type=int, default=3,
+                            help='values per option')
+        parser.add_argument('--users', type=int, default=5)
+        parser.add_argument('--cart-lines', type=int, default=5)
+        parser.add_argument('--orders', type=int, default=10,
+                            help='completed orders per user')
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument('--warmup', type=int, default=5)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--route', action='append', dest='routes',
+                            help='only run routes whose name starts with this (repeatable)')
+        parser.add_argument('--cold', action='store_true',
+                            help='clear every cache before each request')
+        parser.add_argument('--cart-sizes', type=int, nargs='+', default=[1, 10, 50, 200],
+                            help='cart sizes of the checkout scenario')
+        parser.add_argument('--threads', type=int, default=16,
+                            help='worker threads of the coupons, inventory and servers scenarios')
+        parser.add_argument('--shards', type=int, default=settings.STOCK_SHARDS,
+                            help='stock shards compared against a single row by the inventory scenario')
+        parser.add_argument('--clients', type=int, default=200,
+                            help='concurrent clients of the servers scenario')
+        parser.add_argument('--client-delay', type=float, default=1000,
+                            help='milliseconds each client of the servers scenario takes to send its request')
+        parser.add_argument('--output', help='write the JSON report to this file')
+        parser.add_argument('--compare', help='JSON report of a previous run to compare against')
+        parser.add_argument('--threshold', type=float, default=1.25,
+                            help='p95 ratio over the baseline reported as a regression')
+
+    def handle(self, *args, **options):
+        routes = ROUTES
+        if options['routes']:
+            routes = [route for route in ROUTES if any(
+                route.name.startswith(prefix) for prefix in options['routes'])]
+            if not routes:
+                raise CommandError('No route matches the given names')
+
+        config = {
+            key: options[key] for key in
+            ['scenario', 'items', 'options', 'values', 'users', 'cart_lines',
+                'orders', 'iterations', 'warmup', 'seed', 'cold']
+        }
+        if options['scenario'] == 'checkout':
+            config['cart_sizes'] = options['cart_sizes']
+        if options['scenario'] in ('coupons', 'inventory', 'servers'):
+            config['threads'] = options['threads']
+        if options['scenario'] == 'inventory':
+            config['shards'] = options['shards']
+        if options['scenario'] == 'servers':
+            config['clients'] = options['clients']
+            config['client_delay'] = options['client_delay']
+
+        # never touch the configured database: seed and measure in a throwaway one
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False)
+
+        try:
+            items = options['items']
+            if options['scenario'] == 'checkout':
+                items = max(items, *options['cart_sizes'])
+
+            catalog = seed(
+                items=items,
+                options=options['options'],
+                values=options['values'],
+                users=options['users'],
+                cart_lines=options['cart_lines'],
+                orders=options['orders'],
+                seed=options['seed']
+            )
+
+            if options['scenario'] == 'checkout':
+                results = run_finalization(
+                    catalog, options['cart_sizes'], options['iterations'], stdout=self.stdout)
+            elif options['scenario'] == 'coupons':
+                results = run_coupon_scenario(
+                    catalog, options['threads'], stdout=self.stdout)
+            elif options['scenario'] == 'inventory':
+                results = run_inventory_scenario(
+                    catalog, options['threads'], options['shards'], stdout=self.stdout)
+            elif options['scenario'] == 'servers':
+                results = run_server_scenario(
+                    catalog, options['clients'], options['client_delay'], options['threads'],
+                    stdout=self.stdout)
+            else:
+                results = run_benchmarks(
+                    routes, catalog, options['iterations'], options['warmup'],
+                    options['cold'], stdout=self.stdout)
+
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        report = {
+            'meta': {
+                'commit': get_git_commit(),
+                'created': timezone.now().isoformat(),
+                'django': django.get_version(),
+                'python': platform.python_version(),
+                'database': connection.vendor,
+                'config': config
+            },
+            'results': results
+        }
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2, sort_keys=True)
+                output.write('\n')
+
+        if options['compare']:
+            with open(options['compare']) as baseline:
+                regressions = compare_results(
+                    json.load(baseline), results, options['threshold'])
+
+            if regressions:
+                raise CommandError(
+                    'Regressions found:\n' + '\n'.join(regressions))
+
+            self.stdout.write(self.style.SUCCESS('No regressions found'))
@@ -0,0 +1,41 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.core.management.base import BaseCommand
+
+from ecommerce.images import IMAGE_FIELDS, build_rows, store_hashes
+
+
+class Command(BaseCommand):
+    help = 'Build the resized derivatives of every product and option image'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count())
+        parser.add_argument('--chunk-size', type=int, default=20)
+        parser.add_argument('--force', action='store_true',
+                            help='Rebuild the derivatives that already exist')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        built = updated = 0
+
+        # the workers only decode and resize, the hashes are stored from this process
+        with ProcessPoolExecutor(max_workers=options['workers'], initializer=django.setup) as executor:
+            for model, (field, hash_field) in IMAGE_FIELDS.items():
+                rows = list(model.objects.exclude(**{field: ''}).exclude(
+                    **{f'{field}__isnull': True}).order_by('pk').values_list('pk', field))
+
+                futures = [
+                    executor.submit(build_rows, model._meta.label,
+                                    rows[start:start + chunk_size], options['force'])
+                    for start in range(0, len(rows), chunk_size)
+                ]
+
+                for future in as_completed(futures):
+                    result = future.result()
+                    built += len(result)
+                    updated += store_hashes(model, result)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Built the derivatives of {built} images, {updated} hashes updated'))
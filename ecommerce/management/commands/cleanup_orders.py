@@ -0,0 +1,63 @@
+import datetime
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ecommerce.maintenance import (
+    Budget, archive_orders, delete_orphan_lines, expire_carts, get_archivable_orders,
+    get_idle_carts, get_orphan_lines
+)
+
+
+class Command(BaseCommand):
+    help = 'Expire idle carts, delete orphaned order lines and archive old received orders'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cart-ttl', type=int, default=settings.CART_IDLE_TTL,
+                            help='seconds since the last change of a cart to expire it')
+        parser.add_argument('--archive-after', type=int, default=settings.ORDER_ARCHIVE_AFTER,
+                            help='seconds since the order date to archive a received order')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='rows handled per transaction')
+        parser.add_argument('--time-budget', type=float,
+                            help='seconds after which no new batch is started')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='only count what would be reclaimed')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        idle_before = now - datetime.timedelta(seconds=options['cart_ttl'])
+        ordered_before = now - datetime.timedelta(seconds=options['archive_after'])
+
+        if options['dry_run']:
+            self.stdout.write(
+                f'{get_idle_carts(idle_before).count()} idle carts, '
+                f'{get_orphan_lines().count()} orphaned lines and '
+                f'{get_archivable_orders(ordered_before).count()} orders to archive')
+            return
+
+        budget = Budget(options['time_budget'])
+        batch_size = options['batch_size']
+        started = time.perf_counter()
+
+        phases = [
+            ('expired carts', lambda: expire_carts(idle_before, batch_size, budget)),
+            ('orphaned lines', lambda: delete_orphan_lines(batch_size, budget)),
+            ('archived orders', lambda: archive_orders(ordered_before, batch_size, budget))
+        ]
+        reclaimed = 0
+
+        for name, run in phases:
+            totals = run()
+            reclaimed += totals['rows']
+            self.stdout.write(f'{totals["objects"]} {name}, {totals["rows"]} rows deleted')
+
+        elapsed = time.perf_counter() - started
+        message = f'Reclaimed {reclaimed} rows in {elapsed:.1f}s'
+        if budget.exhausted:
+            self.stdout.write(self.style.WARNING(
+                message + ', stopped at the time budget; run again to continue'))
+        else:
+            self.stdout.write(self.style.SUCCESS(message))
@@ -0,0 +1,38 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ecommerce.catalog_io import FORMATS, get_format, iter_catalog, write_records
+
+
+class Command(BaseCommand):
+    help = 'Write the catalog as CSV or JSONL, in the format read by import_catalog'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', help='defaults to stdout')
+        parser.add_argument('--format', choices=FORMATS,
+                            help='defaults to the output extension, or jsonl')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='items loaded per query')
+
+    def handle(self, *args, **options):
+        path = options['output']
+
+        try:
+            file_format = get_format(path or '', options['format'] or (None if path else 'jsonl'))
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        started = time.perf_counter()
+        records = iter_catalog(options['batch_size'])
+
+        if path:
+            with open(path, 'w', newline='', encoding='utf-8') as file:
+                count = write_records(records, file, file_format)
+        else:
+            count = write_records(records, sys.stdout, file_format)
+
+        elapsed = time.perf_counter() - started
+        self.stderr.write(
+            f'Exported {count} items in {elapsed:.1f}s ({count / max(elapsed, 1e-9):.0f} items/s)')
@@ -0,0 +1,49 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ecommerce.order_export import FORMATS, get_orders, parse_bound, stream_orders
+
+
+class Command(BaseCommand):
+    help = 'Write the order history with lines, options, addresses, payment and coupon'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', help='defaults to stdout')
+        parser.add_argument('--format', choices=FORMATS, default='csv')
+        parser.add_argument('--since', help='first ordered date (ISO date or datetime)')
+        parser.add_argument('--until', help='ordered date to stop at, excluded')
+        parser.add_argument('--include-open', action='store_true',
+                            help='also export carts that were not ordered')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='orders loaded per query')
+
+    def handle(self, *args, **options):
+        try:
+            since = parse_bound(options['since']) if options['since'] else None
+            until = parse_bound(options['until']) if options['until'] else None
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        queryset = get_orders(since, until, options['include_open'])
+        started = time.perf_counter()
+        chunks = 0
+
+        file = open(options['output'], 'w', newline='', encoding='utf-8') \
+            if options['output'] else sys.stdout
+
+        try:
+            for chunk in stream_orders(queryset, options['format'], options['batch_size']):
+                file.write(chunk)
+                chunks += 1
+
+        finally:
+            if file is not sys.stdout:
+                file.close()
+
+        # one chunk per order, after the CSV header
+        count = chunks - 1 if options['format'] == 'csv' else chunks
+        elapsed = time.perf_counter() - started
+        self.stderr.write(
+            f'Exported {count} orders in {elapsed:.1f}s ({count / max(elapsed, 1e-9):.0f} orders/s)')
@@ -0,0 +1,70 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ecommerce.catalog_io import CatalogRowError, clean_record, get_format, read_records, upsert_batch
+from ecommerce.facets import refresh_facet_counts
+
+
+class Command(BaseCommand):
+    help = 'Create or update items, options and option values from a CSV or JSONL catalog file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=['csv', 'jsonl'],
+                            help='defaults to the file extension')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='items upserted per transaction')
+        parser.add_argument('--max-errors', type=int, default=100,
+                            help='give up after this many invalid rows')
+
+    def handle(self, *args, **options):
+        try:
+            file_format = get_format(options['path'], options['format'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        totals = {'items': 0, 'created': 0, 'updated': 0,
+                  'options': 0, 'values': 0, 'errors': 0}
+        started = time.perf_counter()
+        batch = []
+
+        with open(options['path'], newline='', encoding='utf-8') as file:
+            for line, record in read_records(file, file_format):
+                try:
+                    if isinstance(record, CatalogRowError):
+                        raise record
+                    batch.append(clean_record(line, record))
+
+                except CatalogRowError as e:
+                    totals['errors'] += 1
+                    self.stderr.write(str(e))
+                    if totals['errors'] > options['max_errors']:
+                        raise CommandError('Too many invalid rows, stopping')
+                    continue
+
+                if len(batch) >= options['batch_size']:
+                    self.import_batch(batch, totals, started)
+                    batch = []
+
+            if batch:
+                self.import_batch(batch, totals, started)
+
+        # once for the whole file, the per-row signals being skipped by the bulk queries
+        refresh_facet_counts()
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            '{items} items ({created} created, {updated} updated), {options} options and '
+            '{values} option values written, {errors} invalid rows'.format(**totals)
+            + f' in {elapsed:.1f}s ({totals["items"] / max(elapsed, 1e-9):.0f} items/s)'))
+
+    def import_batch(self, batch, totals, started):
+        stats = upsert_batch(batch)
+        totals['items'] += len(batch)
+        for key, value in stats.items():
+            totals[key] += value
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f'{totals["items"]} items imported, {totals["items"] / max(elapsed, 1e-9):.0f} items/s')
@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ecommerce.checkout import process_pending_intents
+from ecommerce.gateways import get_gateway
+
+
+class Command(BaseCommand):
+    help = 'Charge pending checkouts and finalize their orders'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='process the pending checkouts and exit')
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help='seconds to wait when the queue is empty')
+        parser.add_argument('--fake', action='store_true',
+                            help='charge with the local fake gateway instead of Stripe')
+
+    def handle(self, *args, **options):
+        gateway = get_gateway(
+            'ecommerce.gateways.FakeGateway' if options['fake'] else None)
+
+        while True:
+            processed = process_pending_intents(gateway)
+            if processed:
+                self.stdout.write(f'Processed {processed} payments')
+
+            if options['once']:
+                break
+
+            if not processed:
+                time.sleep(options['interval'])
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from ecommerce.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the product search index from the catalog'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        indexed = rebuild_index(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Indexed {indexed} items'))
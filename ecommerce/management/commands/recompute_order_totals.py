@@ -0,0 +1,90 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from ecommerce.models import Order, OrderItem, get_option_signature
+from ecommerce.pricing import get_unit_prices
+
+
+TOTAL_FIELDS = ['subtotal', 'discount', 'coupon_amount', 'total', 'line_count']
+
+
+class Command(BaseCommand):
+    help = 'Recompute (or verify) the stored order totals and line price snapshots'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify', action='store_true',
+                            help='only report orders whose stored totals are out of date')
+        parser.add_argument('--open-only', action='store_true',
+                            help='only process orders that have not been ordered yet')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        queryset = Order.objects.order_by('pk')
+        if options['open_only']:
+            queryset = queryset.filter(ordered=False)
+
+        checked = 0
+        mismatched = 0
+        stale_lines = 0
+        last_pk = 0
+
+        # walk the orders by primary key so each batch is a fresh, prefetched query
+        while True:
+            batch = list(queryset.filter(pk__gt=last_pk).with_items()[
+                :options['batch_size']])
+            if not batch:
+                break
+
+            changed_orders, changed_items = self.process_batch(batch)
+            checked += len(batch)
+            mismatched += len(changed_orders)
+            stale_lines += len(changed_items)
+            last_pk = batch[-1].pk
+
+            if not options['verify']:
+                with transaction.atomic():
+                    Order.objects.bulk_update(changed_orders, TOTAL_FIELDS)
+                    OrderItem.objects.bulk_update(
+                        changed_items, ['option_signature', 'unit_price', 'final_unit_price'])
+
+        if options['verify']:
+            if mismatched or stale_lines:
+                raise CommandError(
+                    f'{mismatched} of {checked} orders have out of date totals, '
+                    f'{stale_lines} lines have no price snapshot or signature')
+            self.stdout.write(f'All {checked} orders are up to date')
+
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                f'Updated {mismatched} of {checked} orders and {stale_lines} lines'))
+
+    def process_batch(self, batch):
+        changed_orders = []
+        changed_items = []
+
+        # lines added before the snapshots existed take the current price of their selection
+        prices = get_unit_prices(
+            (order_item.item, [value.pk for value in order_item.item_options.all()])
+            for order in batch for order_item in order.items.all()
+            if order_item.unit_price is None or order_item.final_unit_price is None
+        )
+
+        for order in batch:
+            for order_item in order.items.all():
+                signature = get_option_signature(
+                    [value.pk for value in order_item.item_options.all()])
+                missing_prices = order_item.unit_price is None or order_item.final_unit_price is None
+
+                if missing_prices or order_item.option_signature != signature:
+                    if missing_prices:
+                        order_item.snapshot_prices(prices[(order_item.item_id, signature)])
+                    order_item.option_signature = signature
+                    changed_items.append(order_item)
+
+            totals = order.calculate_totals()
+            if any(abs(getattr(order, field) - value) > 0.005 for field, value in totals.items()):
+                for field, value in totals.items():
+                    setattr(order, field, value)
+                changed_orders.append(order)
+
+        return changed_orders, changed_items
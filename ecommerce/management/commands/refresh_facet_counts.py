@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from ecommerce.facets import refresh_facet_counts
+
+
+class Command(BaseCommand):
+    help = 'Recompute the facet counts summary table from the catalog'
+
+    def handle(self, *args, **options):
+        count = refresh_facet_counts()
+        self.stdout.write(self.style.SUCCESS(f'Stored {count} facet values'))
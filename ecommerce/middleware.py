@@ -0,0 +1,129 @@
+import json
+import logging
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from .guest_cart import GuestCart
+from .profiling import QueryRecorder, route_stats
+
+
+logger = logging.getLogger('ecommerce.profiling')
+
+
+def get_route(request):
+    match = getattr(request, 'resolver_match', None)
+    route = match.route if match is not None else '<unresolved>'
+    return f'{request.method} /{route}'
+
+
+class RecordedStream:
+    # a streamed body calling finish(size) after its last chunk, or when the response
+    # is closed half sent
+    def __init__(self, content, finish):
+        self.content = iter(content)
+        self.finish = finish
+        self.size = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            chunk = next(self.content)
+        except StopIteration:
+            self.close()
+            raise
+
+        self.size += len(chunk)
+        return chunk
+
+    def close(self):
+        if self.finish is not None:
+            finish, self.finish = self.finish, None
+            finish(self.size)
+
+
+class RequestProfilingMiddleware:
+    # wall time, query count, DB time, duplicated queries and response size per request
+    def __init__(self, get_response):
+        # removed from the middleware chain entirely when disabled
+        if not settings.REQUEST_PROFILING_ENABLED:
+            raise MiddlewareNotUsed
+
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = QueryRecorder()
+        start = time.perf_counter()
+
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            response = self.get_response(request)
+
+            if response.streaming:
+                # the body is built while it is sent, after this returns: keep recording
+                # until the last chunk and report then, as the headers are already gone
+                wrappers = stack.pop_all()
+
+                def finish(size):
+                    wrappers.close()
+                    self.record(request, response, recorder, start, size)
+
+                response.streaming_content = RecordedStream(response.streaming_content, finish)
+                return response
+
+        duration, db_duration = self.record(
+            request, response, recorder, start, len(response.content))
+
+        response['Server-Timing'] = ', '.join([
+            f'total;dur={duration:.1f}',
+            f'db;dur={db_duration:.1f};desc="{recorder.count} queries"',
+            f'app;dur={duration - db_duration:.1f}'
+        ])
+        return response
+
+    def record(self, request, response, recorder, start, size):
+        duration = (time.perf_counter() - start) * 1000
+        db_duration = recorder.duration * 1000
+        duplicates = recorder.duplicates()
+        route = get_route(request)
+
+        route_stats.record(route, duration, recorder.count, db_duration,
+                           sum(count - 1 for count in duplicates.values()), size)
+
+        if duration >= settings.REQUEST_PROFILING_SLOW_MS:
+            logger.warning(json.dumps({
+                'event': 'slow_request',
+                'route': route,
+                'path': request.get_full_path(),
+                'status': response.status_code,
+                'streamed': response.streaming,
+                'duration_ms': round(duration, 1),
+                'db_ms': round(db_duration, 1),
+                'queries': recorder.count,
+                'duplicated_queries': [
+                    {'sql': sql, 'count': count} for sql, count in duplicates.items()
+                ],
+                'response_bytes': size
+            }))
+
+        return duration, db_duration
+
+
+class GuestCartMiddleware:
+    # request.guest_cart for anonymous visitors, written back to its cookie when changed
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.guest_cart = GuestCart.from_request(request)
+        response = self.get_response(request)
+
+        if request.guest_cart.modified:
+            request.guest_cart.save(response)
+        return response
@@ -1,9 +1,13 @@
 from django.db import models
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.conf import settings
 from django.shortcuts import reverse
 from django_countries.fields import CountryField
 
+from .catalog import bump_catalog_version
+
+import hashlib
+
 
 CATEGORY_CHOICES = (
     ('T', 'Tablet'),
@@ -22,6 +26,21 @@ ADDRESS_CHOICES = (
     ('S', 'Shipping')
 )
 
+COUPON_KIND_CHOICES = (
+    ('F', 'Fixed amount'),
+    ('P', 'Percentage')
+)
+
+PAYMENT_STATUS_CHOICES = (
+    ('P', 'Pending'),
+    ('R', 'Processing'),
+    ('S', 'Succeeded'),
+    ('F', 'Failed')
+)
+
+# statuses of payment intents a worker may still charge, the cart must not change meanwhile
+PAYMENT_IN_PROGRESS = ('P', 'R')
+
 
 class UserProfile(models.Model):
     user = models.OneToOneField(
@@ -39,10 +58,13 @@ class Item(models.Model):
     discount_price = models.FloatField(blank=True, null=True)
     category = models.CharField(choices=CATEGORY_CHOICES, max_length=2)
     label = models.CharField(choices=LABEL_CHOICES, max_length=1)
-    slug = models.SlugField()
+    slug = models.SlugField(unique=True)
     short_description = models.TextField()
     long_description = models.TextField()
     image = models.ImageField(blank=True, null=True)
+    # content hash of the image, set once its resized derivatives are built (ecommerce.images)
+    image_hash = models.CharField(
+        max_length=32, blank=True, default='', editable=False)
 
     def __str__(self):
         return self.title
@@ -63,6 +85,37 @@ class Item(models.Model):
         })
 
 
+class SearchTerm(models.Model):
+    # inverted index of the catalog, used by ecommerce.search.InvertedIndexBackend
+    term = models.CharField(max_length=50)
+    item = models.ForeignKey('Item', on_delete=models.CASCADE)
+    weight = models.FloatField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['term', 'item'], name='searchterm_term_idx')
+        ]
+
+    def __str__(self):
+        return self.term
+
+
+class FacetCount(models.Model):
+    # number of items per facet value, refreshed by ecommerce.facets on catalog changes
+    facet = models.CharField(max_length=20)  # category, label, price or option
+    value = models.CharField(max_length=101)  # the filter value, e.g. color:black
+    name = models.CharField(max_length=100)
+    count = models.PositiveIntegerField()
+
+    class Meta:
+        unique_together = [
+            ['facet', 'value']
+        ]
+
+    def __str__(self):
+        return f'{self.facet}={self.value}'
+
+
 class Option(models.Model):
     item = models.ForeignKey('Item', on_delete=models.CASCADE)
     name = models.CharField(max_length=50)  # color
@@ -79,10 +132,12 @@ class Option(models.Model):
 class OptionValue(models.Model):
     option = models.ForeignKey('Option', on_delete=models.CASCADE)
     value = models.CharField(max_length=50)  # black, white, silver
-    # Todo : if additional price option is selected add the price
+    # added to both unit prices of a line with this value, see ecommerce.pricing
     additional_price = models.FloatField(blank=True, null=True)
     default = models.BooleanField(default=False)
     attachment = models.ImageField(blank=True, null=True)
+    attachment_hash = models.CharField(
+        max_length=32, blank=True, default='', editable=False)
 
     class Meta:
         unique_together = [
@@ -93,31 +148,102 @@ class OptionValue(models.Model):
         return self.value
 
 
+def get_option_signature(option_ids):
+    # canonical key of a set of option values, independent of the selection order
+    if not option_ids:
+        return ''
+
+    key = ','.join(str(option_id) for option_id in sorted(set(option_ids)))
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
 class OrderItem(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL,
                              on_delete=models.CASCADE)
     ordered = models.BooleanField(default=False)
     item = models.ForeignKey('Item', on_delete=models.CASCADE)
     item_options = models.ManyToManyField('OptionValue')
+    # get_option_signature() of item_options, to find a cart line in one lookup
+    option_signature = models.CharField(max_length=40, blank=True, default='')
     quantity = models.IntegerField(default=1)
+    # unit prices snapshotted when the line was added to the cart
+    unit_price = models.FloatField(blank=True, null=True)
+    final_unit_price = models.FloatField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['item', 'user'], condition=models.Q(ordered=False),
+                         name='orderitem_open_item_user_idx')
+        ]
 
     def __str__(self):
         return f'{self.quantity} of {self.item.title}'
 
+    def snapshot_prices(self, prices=None):
+        # prices: (unit price, final unit price) from ecommerce.pricing.get_unit_prices(),
+        # the price of the item without options by default
+        self.unit_price, self.final_unit_price = prices or (
+            self.item.price, self.item.discount_price or self.item.price)
+
+    def get_unit_prices(self):
+        # lines created before the snapshot columns existed use the current item price
+        if self.unit_price is None or self.final_unit_price is None:
+            return self.item.price, self.item.discount_price or self.item.price
+
+        return self.unit_price, self.final_unit_price
+
     def get_total_item_price(self):
-        return self.quantity * self.item.price
+        return self.quantity * self.get_unit_prices()[0]
 
     def get_total_discount_price(self):
-        return self.quantity * self.item.discount_price
+        return self.quantity * self.get_unit_prices()[1]
 
     def get_amount_saved(self):
         return self.get_total_item_price() - self.get_total_discount_price()
 
     def get_final_price(self):
-        if self.item.discount_price:
-            return self.get_total_discount_price()
+        return self.get_total_discount_price()
+
+
+class Stock(models.Model):
+    # units of an item with an option combination left to sell, split over shards so
+    # concurrent checkouts of a best seller decrement different rows; selections
+    # without stock rows are not tracked
+    item = models.ForeignKey('Item', on_delete=models.CASCADE)
+    option_signature = models.CharField(max_length=40, blank=True, default='')
+    shard = models.PositiveSmallIntegerField(default=0)
+    quantity = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = [
+            ['item', 'option_signature', 'shard']
+        ]
+
+    def __str__(self):
+        return f'{self.quantity} of {self.item.title}'
+
+
+class Reservation(models.Model):
+    # units taken from a stock shard by a cart at checkout, until it is paid or released
+    order = models.ForeignKey('Order', on_delete=models.CASCADE)
+    stock = models.ForeignKey('Stock', on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField()
+
+    def __str__(self):
+        return f'{self.quantity} of {self.stock.item.title}'
+
 
-        return self.get_total_item_price()
+class OrderQuerySet(models.QuerySet):
+    def with_items(self):
+        # load the whole cart (lines, items, options and their parent option, coupon)
+        # in a constant number of queries regardless of the cart size
+        option_values = OptionValue.objects.select_related('option')
+        order_items = OrderItem.objects.select_related('item').prefetch_related(
+            models.Prefetch('item_options', queryset=option_values)
+        )
+        return self.select_related('coupon').prefetch_related(
+            models.Prefetch('items', queryset=order_items)
+        )
 
 
 class Order(models.Model):
@@ -139,7 +265,9 @@ class Order(models.Model):
     coupon = models.ForeignKey(
         'Coupon', on_delete=models.SET_NULL, blank=True, null=True)
 
-    ref_code = models.CharField(max_length=30)
+    # carts have no reference code until they are paid
+    ref_code = models.CharField(
+        max_length=30, blank=True, null=True, unique=True)
 
     # Tracking process
     being_delivered = models.BooleanField(default=False)
@@ -147,19 +275,60 @@ class Order(models.Model):
     refund_requested = models.BooleanField(default=False)
     refund_granted = models.BooleanField(default=False)
 
+    # totals kept in step with the lines by ecommerce.cart
+    subtotal = models.FloatField(default=0)
+    discount = models.FloatField(default=0)
+    coupon_amount = models.FloatField(default=0)
+    total = models.FloatField(default=0)
+    line_count = models.IntegerField(default=0)
+    # last change of the cart, set by ecommerce.cart; idle carts are expired by cleanup_orders
+    updated = models.DateTimeField(auto_now=True)
+
+    objects = OrderQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['updated'], condition=models.Q(ordered=False),
+                         name='order_open_updated_idx')
+        ]
+        constraints = [
+            # also the index used to look up the user's cart
+            models.UniqueConstraint(fields=['user'], condition=models.Q(ordered=False),
+                                    name='unique_open_order_per_user')
+        ]
+
     def __str__(self):
         return self.user.username
 
     def get_total(self):
-        total = 0
+        return self.total
+
+    def calculate_totals(self):
+        # recompute the stored totals from the lines, used to backfill and verify them
+        subtotal = 0
+        discount = 0
+        line_count = 0
+        eligible = 0
 
         for order_item in self.items.all():
-            total += order_item.get_final_price()
+            subtotal += order_item.get_final_price()
+            discount += order_item.get_amount_saved()
+            line_count += 1
+            if self.coupon and order_item.item.category == self.coupon.category:
+                eligible += order_item.get_final_price()
 
+        coupon_amount = 0
         if self.coupon:
-            total -= self.coupon.amount
+            coupon_amount = self.coupon.get_discount(
+                subtotal, eligible if self.coupon.category else subtotal)
 
-        return total
+        return {
+            'subtotal': subtotal,
+            'discount': discount,
+            'coupon_amount': coupon_amount,
+            'total': subtotal - coupon_amount,
+            'line_count': line_count
+        }
 
 
 class Address(models.Model):
@@ -177,6 +346,14 @@ class Address(models.Model):
 
     class Meta:
         verbose_name_plural = 'Addresses'
+        indexes = [
+            models.Index(fields=['user', 'address_type', 'default'],
+                         name='address_user_type_default_idx')
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'address_type'], condition=models.Q(default=True),
+                                    name='unique_default_address')
+        ]
 
 
 class Payment(models.Model):
@@ -186,18 +363,99 @@ class Payment(models.Model):
     amount = models.FloatField()
     timestamp = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # payment history of a user, newest first
+            models.Index(fields=['user', '-timestamp', '-id'],
+                         name='payment_user_timestamp_idx')
+        ]
+
     def __str__(self):
         return self.user.username
 
 
+class PaymentIntent(models.Model):
+    # a checkout waiting for (or done with) its charge by the payment worker
+    idempotency_key = models.CharField(max_length=64, unique=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                             on_delete=models.CASCADE)
+    order = models.ForeignKey('Order', on_delete=models.CASCADE)
+    status = models.CharField(
+        max_length=1, choices=PAYMENT_STATUS_CHOICES, default='P')
+    amount = models.FloatField()
+    stripe_token = models.CharField(max_length=255)
+    # charge a saved Stripe customer (API) instead of the token alone (HTML)
+    save_card = models.BooleanField(default=False)
+    billing_address = models.ForeignKey(
+        'Address', on_delete=models.SET_NULL, related_name='+', blank=True, null=True)
+    shipping_address = models.ForeignKey(
+        'Address', on_delete=models.SET_NULL, related_name='+', blank=True, null=True)
+    payment = models.ForeignKey(
+        'Payment', on_delete=models.SET_NULL, blank=True, null=True)
+    attempts = models.IntegerField(default=0)
+    # lease token of the worker charging it; every status change after the claim checks it
+    claim = models.CharField(max_length=32, blank=True)
+    error = models.CharField(max_length=255, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'updated'],
+                         name='paymentintent_status_idx')
+        ]
+
+    def __str__(self):
+        return self.idempotency_key
+
+
 class Coupon(models.Model):
-    code = models.CharField(max_length=15)
-    # Todo : change to percentage
+    code = models.CharField(max_length=15, unique=True)
+    kind = models.CharField(choices=COUPON_KIND_CHOICES, max_length=1, default='F')
+    # an amount off, or a percentage of the eligible subtotal
     amount = models.FloatField()
+    # no discount below this cart subtotal
+    minimum_spend = models.FloatField(blank=True, null=True)
+    # only the lines of items in this category are discounted
+    category = models.CharField(choices=CATEGORY_CHOICES, max_length=2, blank=True)
+    # carts holding the coupon, counted by ecommerce.coupons only when there is a limit
+    max_uses = models.PositiveIntegerField(blank=True, null=True)
+    used = models.PositiveIntegerField(default=0, editable=False)
+    active = models.BooleanField(default=True)
 
     def __str__(self):
         return self.code
 
+    def get_discount(self, subtotal, eligible_subtotal):
+        # eligible_subtotal: the subtotal of the lines the category rule selects
+        if self.minimum_spend is not None and subtotal < self.minimum_spend:
+            return 0
+
+        if self.kind == 'P':
+            discount = eligible_subtotal * self.amount / 100
+        else:
+            discount = self.amount
+
+        # never more than the lines it applies to
+        return round(min(discount, eligible_subtotal), 2)
+
+
+class ArchivedOrder(models.Model):
+    # cold copy of a completed order, written by ecommerce.maintenance before the order,
+    # its lines and refunds are deleted from the hot tables
+    order_id = models.IntegerField(unique=True)
+    user_id = models.IntegerField(db_index=True)
+    ref_code = models.CharField(
+        max_length=30, blank=True, null=True, unique=True)
+    ordered_date = models.DateTimeField()
+    total = models.FloatField()
+    # the order as exported by ecommerce.order_export, as JSON
+    data = models.TextField()
+    archived = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.ref_code or str(self.order_id)
+
 
 class Refund(models.Model):
     order = models.ForeignKey(
@@ -216,3 +474,11 @@ def userprofile_receiver(sender, instance, created, *args, **kwargs):
 
 
 post_save.connect(userprofile_receiver, sender=settings.AUTH_USER_MODEL)
+
+# invalidate catalog ETags and caches whenever a product changes
+post_save.connect(bump_catalog_version, sender=Item)
+post_delete.connect(bump_catalog_version, sender=Item)
+post_save.connect(bump_catalog_version, sender=Option)
+post_delete.connect(bump_catalog_version, sender=Option)
+post_save.connect(bump_catalog_version, sender=OptionValue)
+post_delete.connect(bump_catalog_version, sender=OptionValue)
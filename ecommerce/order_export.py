@@ -0,0 +1,165 @@
+import csv
+import datetime
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .models import Order
+
+
+FORMATS = ('csv', 'jsonl')
+
+ADDRESS_FIELDS = ['street_address', 'apartment_address', 'country', 'zip']
+
+ORDER_FIELDS = [
+    'ref_code', 'username', 'email', 'ordered', 'start_date', 'ordered_date',
+    'being_delivered', 'received', 'refund_requested', 'refund_granted',
+    'subtotal', 'discount', 'coupon', 'coupon_amount', 'total'
+]
+
+# a CSV row is one order line, with the columns of its order repeated
+CSV_FIELDS = (
+    ORDER_FIELDS
+    + ['payment_charge_id', 'payment_amount', 'payment_timestamp']
+    + [f'billing_{field}' for field in ADDRESS_FIELDS]
+    + [f'shipping_{field}' for field in ADDRESS_FIELDS]
+    + ['item', 'title', 'options', 'quantity', 'unit_price', 'final_unit_price', 'line_total']
+)
+
+
+def parse_bound(value):
+    # an ISO date or datetime, naive values being in the current time zone
+    moment = parse_datetime(value)
+
+    if moment is None:
+        date = parse_date(value)
+        if date is None:
+            raise ValueError(f'Invalid date {value!r}')
+        moment = datetime.datetime.combine(date, datetime.time())
+
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def get_orders(since=None, until=None, include_open=False):
+    queryset = Order.objects.all()
+
+    if not include_open:
+        queryset = queryset.filter(ordered=True)
+
+    if since is not None:
+        queryset = queryset.filter(ordered_date__gte=since)
+
+    if until is not None:
+        queryset = queryset.filter(ordered_date__lt=until)
+
+    return queryset
+
+
+def serialize_address(address):
+    if address is None:
+        return None
+    return {field: str(getattr(address, field)) for field in ADDRESS_FIELDS}
+
+
+def serialize_order(order):
+    record = {
+        'ref_code': order.ref_code,
+        'username': order.user.username,
+        'email': order.user.email
+    }
+    record.update((field, getattr(order, field)) for field in ORDER_FIELDS[3:])
+    record['coupon'] = order.coupon.code if order.coupon is not None else None
+
+    payment = order.payment
+    record['payment'] = None if payment is None else {
+        'charge_id': payment.stripe_charge_id,
+        'amount': payment.amount,
+        'timestamp': payment.timestamp
+    }
+    record['billing_address'] = serialize_address(order.billing_address)
+    record['shipping_address'] = serialize_address(order.shipping_address)
+
+    record['lines'] = []
+    for order_item in order.items.all():
+        unit_price, final_unit_price = order_item.get_unit_prices()
+        record['lines'].append({
+            'item': order_item.item.slug,
+            'title': order_item.item.title,
+            'options': {value.option.name: value.value for value in order_item.item_options.all()},
+            'quantity': order_item.quantity,
+            'unit_price': unit_price,
+            'final_unit_price': final_unit_price,
+            'line_total': order_item.quantity * final_unit_price
+        })
+
+    return record
+
+
+def iter_orders(queryset, batch_size=500):
+    # orders walked by primary key, a fixed number of queries and one batch in memory
+    # at a time; iterator() cannot be combined with prefetch_related on this Django
+    queryset = queryset.with_items().select_related(
+        'user', 'payment', 'billing_address', 'shipping_address').order_by('pk')
+    last_pk = 0
+
+    while True:
+        batch = list(queryset.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            return
+
+        for order in batch:
+            yield serialize_order(order)
+
+        last_pk = batch[-1].pk
+
+
+class Echo:
+    # file-like object handing back what csv.writer writes, to stream it
+    def write(self, value):
+        return value
+
+
+def csv_rows(record):
+    order = [record[field] for field in ORDER_FIELDS]
+    payment = record['payment'] or {}
+    order += [payment.get('charge_id'), payment.get(
+        'amount'), payment.get('timestamp')]
+
+    for address in ('billing_address', 'shipping_address'):
+        address = record[address] or {}
+        order += [address.get(field) for field in ADDRESS_FIELDS]
+
+    if not record['lines']:
+        return [order]
+
+    return [
+        order + [
+            line['item'], line['title'],
+            '; '.join(f'{name}={value}' for name, value in line['options'].items()),
+            line['quantity'], line['unit_price'], line['final_unit_price'], line['line_total']
+        ]
+        for line in record['lines']
+    ]
+
+
+def stream_csv(records):
+    writer = csv.writer(Echo())
+    yield writer.writerow(CSV_FIELDS)
+
+    for record in records:
+        yield ''.join(writer.writerow(row) for row in csv_rows(record))
+
+
+def stream_jsonl(records):
+    for record in records:
+        yield json.dumps(record, cls=DjangoJSONEncoder) + '\n'
+
+
+def stream_orders(queryset, file_format, batch_size=500):
+    # text chunks of the export, one per order
+    stream = stream_csv if file_format == 'csv' else stream_jsonl
+    return stream(iter_orders(queryset, batch_size))
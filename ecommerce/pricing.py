@@ -0,0 +1,65 @@
+from collections import namedtuple
+
+from .catalog import get_cached_many
+from .models import OptionValue, get_option_signature
+
+
+LinePrice = namedtuple('LinePrice', [
+    'unit_price', 'final_unit_price', 'total', 'final_total', 'saved'])
+
+CartPrice = namedtuple('CartPrice', [
+    'lines', 'subtotal', 'discount', 'coupon_amount', 'total'])
+
+
+def get_unit_prices(selections):
+    # {(item id, option signature): (unit price, final unit price)} of [(item, option ids)],
+    # option surcharges included; cached until the catalog changes, the surcharges of
+    # the misses being loaded in one query
+    selections = {
+        (item.pk, get_option_signature(option_ids)): (item, option_ids)
+        for item, option_ids in selections
+    }
+    keys = {f'{item_id}:{signature}': (item_id, signature) for item_id, signature in selections}
+
+    def build(missing):
+        option_ids = {pk for key in missing for pk in selections[keys[key]][1]}
+        surcharges = dict(OptionValue.objects.filter(pk__in=option_ids).values_list(
+            'pk', 'additional_price')) if option_ids else {}
+
+        prices = {}
+        for key in missing:
+            item, option_ids = selections[keys[key]]
+            surcharge = sum(surcharges.get(pk) or 0 for pk in option_ids)
+            prices[key] = (
+                item.price + surcharge,
+                (item.discount_price or item.price) + surcharge
+            )
+        return prices
+
+    prices = get_cached_many('unit_prices', list(keys), build)
+    return {keys[key]: value for key, value in prices.items()}
+
+
+def price_lines(lines, coupon=None):
+    # prices of order lines, saved or not, and the totals of the cart in one pass
+    # without queries: lines are priced at the unit prices snapshotted when they were added
+    priced = []
+    subtotal = discount = 0
+    # subtotal of the lines the category rule of the coupon selects
+    eligible = 0
+
+    for line in lines:
+        unit_price, final_unit_price = line.get_unit_prices()
+        total = line.quantity * unit_price
+        final_total = line.quantity * final_unit_price
+        priced.append(LinePrice(unit_price, final_unit_price,
+                                total, final_total, total - final_total))
+        subtotal += final_total
+        discount += total - final_total
+        if coupon is not None and line.item.category == coupon.category:
+            eligible += final_total
+
+    coupon_amount = 0
+    if coupon is not None:
+        coupon_amount = coupon.get_discount(subtotal, eligible if coupon.category else subtotal)
+    return CartPrice(priced, subtotal, discount, coupon_amount, subtotal - coupon_amount)
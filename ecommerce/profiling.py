@@ -0,0 +1,97 @@
+import math
+import threading
+import time
+from collections import Counter, deque
+
+from django.conf import settings
+
+
+# upper bounds (ms) of the latency histogram buckets
+BUCKETS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+
+def percentile(values, percent):
+    # nearest-rank percentile of an already sorted list
+    if not values:
+        return None
+
+    rank = max(int(math.ceil(percent / 100 * len(values))) - 1, 0)
+    return values[rank]
+
+
+class QueryRecorder:
+    # connection.execute_wrapper() callable counting and timing every query of a request
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.fingerprints = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+
+        try:
+            return execute(sql, params, many, context)
+
+        finally:
+            self.duration += time.perf_counter() - start
+            self.count += 1
+            # the SQL still has its placeholders, so repeated lookups share a fingerprint
+            self.fingerprints[sql] += 1
+
+    def duplicates(self, threshold=2):
+        return {sql: count for sql, count in self.fingerprints.most_common() if count >= threshold}
+
+
+class RouteStats:
+    # rolling window of the latest requests of each route
+    def __init__(self, window):
+        self.window = window
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def record(self, route, duration, queries, db_duration, duplicates, size):
+        with self.lock:
+            samples = self.samples.get(route)
+            if samples is None:
+                samples = self.samples[route] = deque(maxlen=self.window)
+            samples.append((duration, queries, db_duration, duplicates, size))
+
+    def reset(self):
+        with self.lock:
+            self.samples.clear()
+
+    def summary(self):
+        with self.lock:
+            samples = {route: list(values)
+                       for route, values in self.samples.items()}
+
+        return {route: summarize(values) for route, values in sorted(samples.items())}
+
+
+def summarize(samples):
+    durations = sorted(sample[0] for sample in samples)
+    histogram = Counter()
+
+    for duration in durations:
+        bucket = next(
+            (f'<={bound}' for bound in BUCKETS if duration <= bound), f'>{BUCKETS[-1]}')
+        histogram[bucket] += 1
+
+    return {
+        'requests': len(samples),
+        'latency_ms': {
+            'p50': round(percentile(durations, 50), 3),
+            'p95': round(percentile(durations, 95), 3),
+            'p99': round(percentile(durations, 99), 3),
+            'max': round(durations[-1], 3)
+        },
+        'histogram': dict(histogram),
+        'queries_mean': round(sum(sample[1] for sample in samples) / len(samples), 2),
+        'queries_max': max(sample[1] for sample in samples),
+        'db_ms_mean': round(sum(sample[2] for sample in samples) / len(samples), 3),
+        'duplicated_queries_max': max(sample[3] for sample in samples),
+        'response_bytes_mean': round(sum(sample[4] for sample in samples) / len(samples))
+    }
+
+
+route_stats = RouteStats(settings.REQUEST_PROFILING_WINDOW)
@@ -0,0 +1,204 @@
+import re
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection, connections, transaction
+from django.db.models import Sum
+from django.db.models.signals import post_save, post_delete
+from django.utils.module_loading import import_string
+
+from .models import Item, OptionValue, SearchTerm
+
+
+# relative weight of a match in each indexed field
+FIELD_WEIGHTS = {
+    'title': 10.0,
+    'short_description': 4.0,
+    'long_description': 1.0,
+    'option_values': 2.0
+}
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    return [word.lower() for word in WORD_RE.findall(text or '')]
+
+
+def get_documents(items):
+    # the text indexed per item, with the option values of every item in one query
+    items = list(items)
+    values = defaultdict(list)
+    option_values = OptionValue.objects.filter(option__item__in=items).values_list(
+        'option__item_id', 'value')
+
+    for item_id, value in option_values:
+        values[item_id].append(value)
+
+    for item in items:
+        yield item.pk, {
+            'title': item.title,
+            'short_description': item.short_description,
+            'long_description': item.long_description,
+            'option_values': ' '.join(values[item.pk])
+        }
+
+
+class SQLiteFTSBackend:
+    # FTS5 virtual table whose rowid is the item id, ranked with bm25
+    table = 'ecommerce_item_search'
+
+    def ensure_table(self, cursor):
+        # a no-op once post_migrate created it, as creating it inside a transaction that is
+        # rolled back corrupts the database
+        cursor.execute(
+            f'CREATE VIRTUAL TABLE IF NOT EXISTS {self.table} USING fts5('
+            'title, short_description, long_description, option_values, '
+            "tokenize = 'unicode61 remove_diacritics 2')"
+        )
+
+    def index_items(self, items):
+        rows = [
+            (item_id, document['title'], document['short_description'],
+             document['long_description'], document['option_values'])
+            for item_id, document in get_documents(items)
+        ]
+
+        with connection.cursor() as cursor:
+            self.ensure_table(cursor)
+            cursor.executemany(
+                f'DELETE FROM {self.table} WHERE rowid = %s', [(row[0],) for row in rows])
+            cursor.executemany(
+                f'INSERT INTO {self.table} (rowid, title, short_description, long_description, '
+                'option_values) VALUES (%s, %s, %s, %s, %s)', rows)
+
+    def remove_item(self, item_id):
+        with connection.cursor() as cursor:
+            self.ensure_table(cursor)
+            cursor.execute(
+                f'DELETE FROM {self.table} WHERE rowid = %s', [item_id])
+
+    def clear(self):
+        with connection.cursor() as cursor:
+            self.ensure_table(cursor)
+            cursor.execute(f'DELETE FROM {self.table}')
+
+    def search(self, query, limit):
+        # every word must match, as a prefix so results show up while typing
+        words = tokenize(query)
+        if not words:
+            return []
+
+        match = ' '.join(f'"{word}"*' for word in words)
+        weights = ', '.join(str(weight) for weight in FIELD_WEIGHTS.values())
+
+        with connection.cursor() as cursor:
+            self.ensure_table(cursor)
+            cursor.execute(
+                f'SELECT rowid FROM {self.table} WHERE {self.table} MATCH %s '
+                f'ORDER BY bm25({self.table}, {weights}) LIMIT %s',
+                [match, limit]
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+class InvertedIndexBackend:
+    # portable index in the SearchTerm table, for databases without SQLite FTS5
+    def index_items(self, items):
+        terms = []
+        item_ids = []
+
+        for item_id, document in get_documents(items):
+            item_ids.append(item_id)
+            weights = defaultdict(float)
+            for field, text in document.items():
+                for word in tokenize(text):
+                    weights[word[:50]] += FIELD_WEIGHTS[field]
+
+            terms.extend(SearchTerm(item_id=item_id, term=term, weight=weight)
+                         for term, weight in weights.items())
+
+        with transaction.atomic():
+            SearchTerm.objects.filter(item_id__in=item_ids).delete()
+            SearchTerm.objects.bulk_create(terms, batch_size=1000)
+
+    def remove_item(self, item_id):
+        SearchTerm.objects.filter(item_id=item_id).delete()
+
+    def clear(self):
+        SearchTerm.objects.all().delete()
+
+    def search(self, query, limit):
+        words = tokenize(query)
+        if not words:
+            return []
+
+        # an item must match every word; its score is the weight of the matching terms
+        scores = None
+        for word in words:
+            matches = dict(SearchTerm.objects.filter(term__startswith=word).values(
+                'item_id').annotate(score=Sum('weight')).values_list('item_id', 'score'))
+
+            if scores is None:
+                scores = matches
+            else:
+                scores = {item_id: score + matches[item_id]
+                          for item_id, score in scores.items() if item_id in matches}
+
+        ranked = sorted(scores.items(), key=lambda pair: (-pair[1], pair[0]))
+        return [item_id for item_id, score in ranked[:limit]]
+
+
+def get_search_backend():
+    return import_string(settings.SEARCH_BACKEND)()
+
+
+def index_items(items):
+    get_search_backend().index_items(items)
+
+
+def rebuild_index(batch_size=500):
+    backend = get_search_backend()
+    backend.clear()
+
+    queryset = Item.objects.order_by('pk')
+    last_pk = 0
+    indexed = 0
+
+    while True:
+        batch = list(queryset.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            return indexed
+
+        backend.index_items(batch)
+        indexed += len(batch)
+        last_pk = batch[-1].pk
+
+
+def create_search_table(sender, using, **kwargs):
+    backend = get_search_backend()
+    if isinstance(backend, SQLiteFTSBackend) and connections[using].vendor == 'sqlite':
+        with connections[using].cursor() as cursor:
+            backend.ensure_table(cursor)
+
+
+def item_saved(sender, instance, **kwargs):
+    index_items([instance])
+
+
+def item_deleted(sender, instance, **kwargs):
+    get_search_backend().remove_item(instance.pk)
+
+
+def option_value_changed(sender, instance, **kwargs):
+    # the values are indexed with their item
+    item = Item.objects.filter(option__pk=instance.option_id).first()
+    if item is not None:
+        index_items([item])
+
+
+# keep the index in step with the catalog
+post_save.connect(item_saved, sender=Item)
+post_delete.connect(item_deleted, sender=Item)
+post_save.connect(option_value_changed, sender=OptionValue)
+post_delete.connect(option_value_changed, sender=OptionValue)
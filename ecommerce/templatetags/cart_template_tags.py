@@ -1,16 +1,37 @@
 from django import template
-from ecommerce.models import Order
+from ecommerce.cart import get_cart_count
 
 # register template tag
 register = template.Library()
 
-# register custom filter
-@register.filter
-def cart_item_count(user):
-    if user.is_authenticated:
-        queryset = Order.objects.filter(user=user, ordered=False)
 
-        if queryset.exists():
-            return queryset[0].items.count()
+def get_user_count(user):
+    # remember the count on the request's user so every use in a template shares it
+    if not hasattr(user, '_cart_item_count'):
+        user._cart_item_count = get_cart_count(user)
+
+    return user._cart_item_count
+
+
+# register custom tag: {% cart_item_count %}
+@register.simple_tag(takes_context=True)
+def cart_item_count(context):
+    # the saved cart of users, the cookie cart of visitors
+    request = context.get('request')
+    if request is None:
+        return 0
+
+    if request.user.is_authenticated:
+        return get_user_count(request.user)
+
+    guest_cart = getattr(request, 'guest_cart', None)
+    return guest_cart.get_count() if guest_cart is not None else 0
+
+
+# register custom filter: {{ request.user|cart_item_count }}, saved carts only
+@register.filter(name='cart_item_count')
+def user_cart_item_count(user):
+    if user.is_authenticated:
+        return get_user_count(user)
 
     return 0
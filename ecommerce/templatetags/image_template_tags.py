@@ -0,0 +1,14 @@
+from django import template
+from ecommerce.images import get_srcset
+
+register = template.Library()
+
+
+# {{ item.image_hash|srcset:'webp' }}, empty until the derivatives are built
+@register.filter
+def srcset(content_hash, image_format='webp'):
+    srcsets = get_srcset(content_hash)
+    if srcsets is None:
+        return ''
+
+    return srcsets[image_format]
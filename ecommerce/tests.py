@@ -1,3 +1,1419 @@
-from django.test import TestCase
+import asyncio
+import csv
+import io
+import json
+import os
+import tempfile
+import threading
+from datetime import timedelta
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.models import Sum
+from django.http import HttpResponse, QueryDict, StreamingHttpResponse
+from django.template import Context, Template
+from django.test import RequestFactory, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils.cache import has_vary_header
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.permissions import AllowAny
+from rest_framework.response import Response
+from rest_framework.test import APIClient, APIRequestFactory
+from rest_framework.views import APIView
+
+from .api.views.products import CatalogETagMixin
+from .asgi import ReadPathASGIHandler
+from .benchmarks.runner import run_concurrently
+from .cart import (
+    CartError, add_to_cart, apply_coupon, parse_operations, remove_from_cart, subtract_from_cart,
+    update_cart)
+from .catalog_io import FORMATS, iter_catalog, write_records
+from .checkout import (
+    FAILED, PENDING, PROCESSING, SUCCEEDED, claim_next_intent, create_payment_intent,
+    fail_intent, process_intent, process_pending_intents, release_stale_intents)
+from .facets import filter_items, get_filters, load_facet_counts, refresh_facet_counts
+from .gateways import FakeGateway, PaymentError
+from .guest_cart import GuestCart
+from .images import get_srcset
+from .inventory import get_available, set_stock
+from .maintenance import Budget, archive_orders, delete_orphan_lines, expire_carts
+from .middleware import RequestProfilingMiddleware
+from .models import (
+    ArchivedOrder, Item, Option, OptionValue, OrderItem, Order, Address, Coupon, FacetCount, Payment,
+    PaymentIntent, Refund, Reservation, Stock, get_option_signature)
+from .order_export import get_orders, stream_orders
+from .pricing import get_unit_prices, price_lines
+from .profiling import percentile, route_stats
+from .search import get_search_backend, rebuild_index
+from .views import HomeView
+
+
+def create_item(slug, price=10.0, discount_price=None):
+    return Item.objects.create(
+        title=slug,
+        price=price,
+        discount_price=discount_price,
+        category='P',
+        label='D',
+        slug=slug,
+        short_description='short',
+        long_description='long'
+    )
+
+
+class OrderSummaryQueryCountTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username='buyer', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.coupon = Coupon.objects.create(code='SALE', amount=5.0)
+
+    def fill_cart(self, line_count):
+        for index in range(line_count):
+            item = create_item(
+                f'item-{line_count}-{index}', discount_price=8.0)
+            color = Option.objects.create(item=item, name='color')
+            black = OptionValue.objects.create(option=color, value='black')
+            add_to_cart(self.user, item, [black.pk], quantity=2)
+
+        apply_coupon(self.user, self.coupon)
+        return Order.objects.get(user=self.user, ordered=False)
+
+    def count_summary_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('order-summary'))
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries), response.data
+
+    def test_query_count_is_independent_of_cart_size(self):
+        order = self.fill_cart(1)
+        small_count, data = self.count_summary_queries()
+        self.assertEqual(len(data['order_items']), 1)
+        self.assertEqual(data['total'], 16.0 - 5.0)
+
+        Order.objects.filter(pk=order.pk).delete()
+        self.fill_cart(200)
+        large_count, data = self.count_summary_queries()
+        self.assertEqual(len(data['order_items']), 200)
+        self.assertEqual(data['total'], 200 * 16.0 - 5.0)
+        self.assertEqual(
+            data['order_items'][0]['item_options'][0]['option']['name'], 'color')
+
+        self.assertEqual(small_count, large_count)
+        self.assertLessEqual(large_count, 3)
+
+
+class SearchBackendTestMixin:
+    def setUp(self):
+        self.phone = Item.objects.create(
+            title='Pixel phone', price=500.0, category='P', label='N', slug='pixel',
+            short_description='an android phone', long_description='camera')
+        self.case = Item.objects.create(
+            title='Leather case', price=20.0, category='P', label='D', slug='case',
+            short_description='fits the pixel', long_description='brown')
+        self.tablet = Item.objects.create(
+            title='Tablet', price=300.0, category='T', label='D', slug='tablet',
+            short_description='big screen', long_description='pairs with a pixel phone')
+
+    def search(self, query):
+        return get_search_backend().search(query, 10)
+
+    def test_matches_are_ranked_by_field(self):
+        # a title match outranks a short description, which outranks a long one
+        self.assertEqual(self.search('pixel'), [self.phone.pk, self.case.pk, self.tablet.pk])
+
+    def test_every_word_must_match_as_a_prefix(self):
+        self.assertEqual(self.search('pix phone'), [self.phone.pk, self.tablet.pk])
+        self.assertEqual(self.search('leather phone'), [])
+        self.assertEqual(self.search('  '), [])
+
+    def test_index_follows_the_catalog(self):
+        color = Option.objects.create(item=self.tablet, name='color')
+        OptionValue.objects.create(option=color, value='graphite')
+        self.assertEqual(self.search('graphite'), [self.tablet.pk])
+
+        self.case.title = 'Silicone case'
+        self.case.save()
+        self.assertEqual(self.search('leather'), [])
+        self.assertEqual(self.search('silicone'), [self.case.pk])
+
+        self.phone.delete()
+        self.assertEqual(self.search('android'), [])
+
+    def test_rebuild_index(self):
+        get_search_backend().clear()
+        self.assertEqual(self.search('pixel'), [])
+        self.assertEqual(rebuild_index(batch_size=2), 3)
+        self.assertEqual(len(self.search('pixel')), 3)
+
+    def test_search_endpoint_counts_facets_of_every_match(self):
+        response = APIClient().get(reverse('product-search'), {'q': 'pixel', 'label': 'D'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual([item['slug'] for item in response.data['results']], ['case', 'tablet'])
+        # the counts are of every match, before the filters
+        self.assertEqual(response.data['facets']['category'], [
+            {'value': 'T', 'name': 'Tablet', 'count': 1},
+            {'value': 'P', 'name': 'Phone', 'count': 2}])
+        self.assertEqual(response.data['facets']['label'], [
+            {'value': 'D', 'name': 'Default', 'count': 2},
+            {'value': 'N', 'name': 'New', 'count': 1}])
+
+
+@override_settings(SEARCH_BACKEND='ecommerce.search.SQLiteFTSBackend')
+class SQLiteFTSBackendTest(SearchBackendTestMixin, TestCase):
+    pass
+
+
+@override_settings(SEARCH_BACKEND='ecommerce.search.InvertedIndexBackend')
+class InvertedIndexBackendTest(SearchBackendTestMixin, TestCase):
+    pass
+
+
+class FacetTest(TestCase):
+    def setUp(self):
+        self.cheap = create_item('cheap', price=50.0)
+        self.discounted = create_item('discounted', price=600.0, discount_price=450.0)
+        self.tablet = Item.objects.create(
+            title='tablet', price=800.0, category='T', label='B', slug='tablet',
+            short_description='short', long_description='long')
+        for item, values in [(self.cheap, ['black']), (self.discounted, ['black', 'white']),
+                             (self.tablet, ['white'])]:
+            color = Option.objects.create(item=item, name='color')
+            for value in values:
+                OptionValue.objects.create(option=color, value=value)
+
+    def filter(self, **params):
+        query = QueryDict(mutable=True)
+        for name, values in params.items():
+            query.setlist(name, values)
+        return list(filter_items(Item.objects.order_by('pk'), get_filters(query)))
+
+    def test_catalog_changes_refresh_once_per_transaction(self):
+        scheduled = [func for sids, func in connection.run_on_commit if func is refresh_facet_counts]
+        self.assertEqual(len(scheduled), 1)
+
+    def test_counts(self):
+        refresh_facet_counts()
+        facets = load_facet_counts()
+
+        self.assertEqual(facets['category'], [
+            {'value': 'T', 'name': 'Tablet', 'count': 1},
+            {'value': 'P', 'name': 'Phone', 'count': 2}])
+        self.assertEqual(facets['label'], [
+            {'value': 'D', 'name': 'Default', 'count': 2},
+            {'value': 'B', 'name': 'Best seller', 'count': 1}])
+        # the discounted price is the one that counts
+        self.assertEqual([(entry['value'], entry['count']) for entry in facets['price']],
+                         [('0-100', 1), ('100-500', 1), ('500-1000', 1)])
+        self.assertEqual(facets['option'], [
+            {'value': 'color:black', 'name': 'black', 'count': 2, 'option': 'color'},
+            {'value': 'color:white', 'name': 'white', 'count': 2, 'option': 'color'}])
+
+    def test_refresh_replaces_the_counts(self):
+        refresh_facet_counts()
+        self.tablet.delete()
+        refresh_facet_counts()
+
+        self.assertEqual(load_facet_counts()['category'], [
+            {'value': 'P', 'name': 'Phone', 'count': 2}])
+        self.assertFalse(FacetCount.objects.filter(facet='label', value='B').exists())
+
+    def test_filters(self):
+        # values of one facet are alternatives, facets must all match
+        self.assertEqual(self.filter(category=['P', 'T']), [self.cheap, self.discounted, self.tablet])
+        self.assertEqual(self.filter(category=['P'], option=['color:white']), [self.discounted])
+        self.assertEqual(self.filter(price=['100-500']), [self.discounted])
+        self.assertEqual(self.filter(price=['0-100', '500-1000']), [self.cheap, self.tablet])
+        self.assertEqual(self.filter(option=['color:black', 'color:white'], label=['B']), [self.tablet])
+        self.assertEqual(self.filter(price=['unknown']), [])
+
+    def test_facet_endpoint(self):
+        refresh_facet_counts()
+        response = APIClient().get(reverse('product-facets'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, load_facet_counts())
+
+
+class CatalogIOTest(TestCase):
+    def setUp(self):
+        phone = create_item('phone', price=500.0, discount_price=450.0)
+        color = Option.objects.create(item=phone, name='color')
+        OptionValue.objects.create(option=color, value='black', default=True)
+        OptionValue.objects.create(option=color, value='gold', additional_price=25.0)
+        Option.objects.create(item=phone, name='engraving')
+        create_item('case', price=20.0)
+
+    def export(self, file_format):
+        file = io.StringIO()
+        self.assertEqual(write_records(iter_catalog(batch_size=1), file, file_format), 2)
+        return file.getvalue()
+
+    def normalized(self):
+        return sorted(
+            (dict(record, options=sorted(
+                (dict(option, values=sorted(option['values'], key=lambda value: value['value']))
+                 for option in record['options']), key=lambda option: option['name']))
+             for record in iter_catalog()), key=lambda record: record['slug'])
+
+    def import_file(self, text, file_format, **options):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, f'catalog.{file_format}')
+            with open(path, 'w', encoding='utf-8') as file:
+                file.write(text)
+            stderr = io.StringIO()
+            call_command('import_catalog', path, stdout=io.StringIO(), stderr=stderr, **options)
+            return stderr.getvalue()
+
+    def test_round_trip(self):
+        for file_format in FORMATS:
+            with self.subTest(file_format=file_format):
+                catalog = self.normalized()
+                text = self.export(file_format)
+
+                Item.objects.all().delete()
+                self.assertEqual(self.import_file(text, file_format), '')
+                self.assertEqual(self.normalized(), catalog)
+
+    def test_import_updates_by_slug_and_keeps_other_options(self):
+        self.import_file(json.dumps({
+            'slug': 'phone', 'title': 'phone', 'price': 400, 'category': 'P', 'label': 'N',
+            'options': [{'name': 'color', 'values': [
+                {'value': 'gold', 'additional_price': 30}, {'value': 'blue'}]}]
+        }) + '\n', 'jsonl')
+
+        phone = Item.objects.get(slug='phone')
+        self.assertEqual((phone.price, phone.discount_price, phone.label), (400.0, None, 'N'))
+        self.assertEqual(sorted(OptionValue.objects.filter(option__item=phone).values_list(
+            'value', 'additional_price')), [('black', None), ('blue', None), ('gold', 30.0)])
+        self.assertTrue(Option.objects.filter(item=phone, name='engraving').exists())
+        self.assertEqual(Item.objects.count(), 2)
+
+    def test_invalid_rows_are_rejected(self):
+        rows = [
+            {'slug': 'tablet', 'title': 'tablet', 'price': 300, 'category': 'T', 'label': 'D'},
+            {'slug': 'not a slug', 'title': 'x', 'price': 1, 'category': 'T', 'label': 'D'},
+            {'slug': 'laptop', 'title': 'laptop', 'price': -1, 'category': 'L', 'label': 'D'},
+            {'slug': 'watch', 'title': 'watch', 'price': 1, 'category': 'W', 'label': 'D'},
+        ]
+        text = '\n'.join(json.dumps(row) for row in rows) + '\n[]\n{not json\n'
+        errors = self.import_file(text, 'jsonl').splitlines()
+
+        self.assertEqual([error.partition(':')[0] for error in errors],
+                         ['line 2', 'line 3', 'line 4', 'line 5', 'line 6'])
+        self.assertIn('price must not be negative', errors[1])
+        self.assertEqual(sorted(Item.objects.values_list('slug', flat=True)), ['case', 'phone', 'tablet'])
+
+        with self.assertRaises(CommandError):
+            self.import_file(text, 'jsonl', max_errors=2)
+
+    def test_invalid_csv_row_is_rejected(self):
+        text = ('slug,title,price,discount_price,category,label,short_description,long_description,'
+                'option,value,additional_price,default\n'
+                'tablet,tablet,300,,T,D,short,long,color,black,,1\n'
+                'tablet,tablet,300,,T,D,short,long,color,white,free,\n')
+        errors = self.import_file(text, 'csv')
+
+        self.assertIn('line 2: additional_price must be a number', errors)
+        self.assertFalse(Item.objects.filter(slug='tablet').exists())
+
+
+class IndexUsageTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username='buyer', password='password')
+        self.item = create_item('phone')
+
+    def assertUsesIndex(self, queryset, *index_names):
+        plan = queryset.explain()
+        self.assertTrue(
+            any(index_name in plan for index_name in index_names), plan)
+
+    def test_open_order_lookup(self):
+        self.assertUsesIndex(
+            Order.objects.filter(user=self.user, ordered=False),
+            'unique_open_order_per_user')
+
+    def test_open_order_item_lookup(self):
+        self.assertUsesIndex(
+            OrderItem.objects.filter(
+                item=self.item, user=self.user, ordered=False),
+            'orderitem_open_item_user_idx')
+
+    def test_default_address_lookup(self):
+        self.assertUsesIndex(
+            Address.objects.filter(
+                user=self.user, address_type='S', default=True),
+            'unique_default_address', 'address_user_type_default_idx')
+
+    def test_unique_lookups(self):
+        self.assertUsesIndex(Item.objects.filter(
+            slug='phone'), 'sqlite_autoindex_ecommerce_item')
+        self.assertUsesIndex(Coupon.objects.filter(
+            code='SALE'), 'sqlite_autoindex_ecommerce_coupon')
+        self.assertUsesIndex(Order.objects.filter(
+            ref_code='abc'), 'sqlite_autoindex_ecommerce_order')
+
+
+class PaymentHistoryQueryCountTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username='buyer', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create_paid_orders(self, count):
+        for index in range(count):
+            for line in range(3):
+                item = create_item(f'item-{count}-{index}-{line}')
+                color = Option.objects.create(item=item, name='color')
+                black = OptionValue.objects.create(option=color, value='black')
+                add_to_cart(self.user, item, [black.pk])
+
+            payment = Payment.objects.create(
+                stripe_charge_id=f'ch_{count}_{index}', user=self.user, amount=30.0)
+            Order.objects.filter(user=self.user, ordered=False).update(
+                ordered=True, payment=payment)
+
+    def count_history_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries), response.data
+
+    def test_query_count_is_independent_of_page_size(self):
+        self.create_paid_orders(1)
+        small_count, data = self.count_history_queries(reverse('payment-list'))
+        self.assertEqual(len(data['results']), 1)
+        self.assertEqual(len(data['results'][0]['order']['order_items']), 3)
+
+        self.create_paid_orders(20)
+        large_count, data = self.count_history_queries(
+            reverse('payment-list') + '?page_size=10')
+        self.assertEqual(len(data['results']), 10)
+        self.assertEqual(
+            data['results'][0]['order']['order_items'][0]['item_options'][0]['option']['name'], 'color')
+        self.assertIsNotNone(data['next'])
+
+        self.assertEqual(small_count, large_count)
+
+    def test_date_range(self):
+        self.create_paid_orders(2)
+        Payment.objects.filter(stripe_charge_id='ch_2_0').update(
+            timestamp=timezone.now() - timedelta(days=10))
+
+        count, data = self.count_history_queries(
+            reverse('payment-list') + '?since=' + (timezone.now() - timedelta(days=1)).date().isoformat())
+        self.assertEqual([payment['id'] for payment in data['results']],
+                         list(Payment.objects.filter(stripe_charge_id='ch_2_1').values_list('pk', flat=True)))
+
+        response = self.client.get(reverse('payment-list') + '?until=yesterday')
+        self.assertEqual(response.status_code, 400)
+
+
+class ProductETagTest(TestCase):
+    def setUp(self):
+        self.item = create_item('phone')
+        self.client = APIClient()
+
+    def test_unchanged_catalog_is_not_modified(self):
+        response = self.client.get(reverse('product-list'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(has_vary_header(response, 'Accept'))
+        etag = response['ETag']
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('product-list'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertTrue(has_vary_header(response, 'Accept'))
+        self.assertEqual(len(context.captured_queries), 0)
+
+        # any catalog change gives a new tag
+        create_item('tablet')
+        response = self.client.get(reverse('product-list'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_vary_keeps_other_headers(self):
+        class CookieView(APIView):
+            permission_classes = [AllowAny]
+
+            def get(self, request):
+                response = Response({})
+                response['Vary'] = 'Cookie'
+                return response
+
+        class ETagCookieView(CatalogETagMixin, CookieView):
+            pass
+
+        response = ETagCookieView.as_view()(APIRequestFactory().get('/'))
+        self.assertTrue(has_vary_header(response, 'Accept'))
+        self.assertTrue(has_vary_header(response, 'Cookie'))
+
+
+class OrderExportTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username='buyer', password='password', email='buyer@example.com')
+        self.staff = get_user_model().objects.create_user(
+            username='staff', password='password', is_staff=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.staff)
+
+    def create_order(self, index, ordered=True, days_ago=0):
+        item = create_item(f'item-{index}', discount_price=8.0)
+        color = Option.objects.create(item=item, name='color')
+        black = OptionValue.objects.create(option=color, value='black')
+        add_to_cart(self.user, item, [black.pk], quantity=2)
+        add_to_cart(self.user, create_item(f'extra-{index}'))
+
+        order = Order.objects.get(user=self.user, ordered=False)
+        if ordered:
+            payment = Payment.objects.create(
+                stripe_charge_id=f'ch_{index}', user=self.user, amount=order.total)
+            Order.objects.filter(pk=order.pk).update(
+                ordered=True, payment=payment, ref_code=f'ref-{index}',
+                ordered_date=timezone.now() - timedelta(days=days_ago))
+        return order
+
+    def export(self, query=''):
+        response = self.client.get(reverse('order-export') + query)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode()
+
+    def test_only_staff_can_export(self):
+        self.assertIn(APIClient().get(reverse('order-export')).status_code, (401, 403))
+
+        client = APIClient()
+        client.force_authenticate(self.user)
+        self.assertEqual(client.get(reverse('order-export')).status_code, 403)
+
+    def test_jsonl(self):
+        self.create_order(0)
+        self.create_order(1, days_ago=10)
+        self.create_order(2, ordered=False)
+
+        records = [json.loads(line) for line in self.export('?output=jsonl').splitlines()]
+        self.assertEqual([record['ref_code'] for record in records], ['ref-0', 'ref-1'])
+        self.assertEqual(records[0]['email'], 'buyer@example.com')
+        self.assertEqual(records[0]['payment']['charge_id'], 'ch_0')
+        self.assertEqual(records[0]['total'], 26.0)
+        self.assertEqual(records[0]['lines'][0], {
+            'item': 'item-0', 'title': 'item-0', 'options': {'color': 'black'},
+            'quantity': 2, 'unit_price': 10.0, 'final_unit_price': 8.0, 'line_total': 16.0})
+
+        since = (timezone.now() - timedelta(days=1)).date().isoformat()
+        records = self.export(f'?output=jsonl&since={since}').splitlines()
+        self.assertEqual([json.loads(line)['ref_code'] for line in records], ['ref-0'])
+
+        records = self.export('?output=jsonl&include_open=1').splitlines()
+        self.assertEqual(len(records), 3)
+
+    def test_csv_has_a_row_per_line(self):
+        self.create_order(0)
+        rows = list(csv.DictReader(io.StringIO(self.export())))
+
+        self.assertEqual(len(rows), 2)
+        self.assertEqual({row['ref_code'] for row in rows}, {'ref-0'})
+        self.assertEqual(rows[0]['options'], 'color=black')
+        self.assertEqual(rows[0]['line_total'], '16.0')
+
+    def test_invalid_parameters(self):
+        self.assertEqual(self.client.get(reverse('order-export') + '?output=xml').status_code, 400)
+        self.assertEqual(self.client.get(reverse('order-export') + '?since=yesterday').status_code, 400)
+
+    def test_query_count_is_independent_of_order_count(self):
+        def count_queries():
+            with CaptureQueriesContext(connection) as context:
+                list(stream_orders(get_orders(), 'jsonl', batch_size=100))
+            return len(context.captured_queries)
+
+        self.create_order(0)
+        small_count = count_queries()
+        for index in range(1, 6):
+            self.create_order(index)
+        self.assertEqual(count_queries(), small_count)
+
+
+@override_settings(REQUEST_PROFILING_ENABLED=True, REQUEST_PROFILING_SLOW_MS=60 * 1000)
+class RequestProfilingTest(TestCase):
+    def setUp(self):
+        route_stats.reset()
+        self.item = create_item('phone')
+
+    def tearDown(self):
+        route_stats.reset()
+
+    def lookup_twice(self, request):
+        Item.objects.filter(slug='phone').exists()
+        Item.objects.filter(slug='phone').exists()
+        return HttpResponse('phone')
+
+    def stream_items(self, request):
+        def rows():
+            for slug in Item.objects.values_list('slug', flat=True):
+                yield f'{slug}\n'
+            yield f'{Item.objects.count()}\n'
+        return StreamingHttpResponse(rows())
+
+    def test_server_timing_and_route_stats(self):
+        for _ in range(2):
+            response = self.client.get(reverse('product-list'))
+        self.assertEqual(response.status_code, 200)
+        self.assertRegex(response['Server-Timing'],
+                         r'^total;dur=[\d.]+, db;dur=[\d.]+;desc="\d+ queries", app;dur=-?[\d.]+$')
+
+        stats = route_stats.summary()['GET /api/products/']
+        self.assertEqual(stats['requests'], 2)
+        self.assertGreater(stats['queries_max'], 0)
+        self.assertEqual(stats['response_bytes_mean'], len(response.content))
+
+    def test_duplicated_queries_and_slow_requests(self):
+        middleware = RequestProfilingMiddleware(self.lookup_twice)
+
+        with self.settings(REQUEST_PROFILING_SLOW_MS=0), \
+                self.assertLogs('ecommerce.profiling', 'WARNING') as logs:
+            response = middleware(RequestFactory().get('/phone/?size=large'))
+        self.assertIn('desc="2 queries"', response['Server-Timing'])
+
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(line['event'], 'slow_request')
+        self.assertEqual(line['path'], '/phone/?size=large')
+        self.assertEqual(line['queries'], 2)
+        self.assertEqual([query['count'] for query in line['duplicated_queries']], [2])
+        self.assertEqual(line['response_bytes'], 5)
+
+        stats = route_stats.summary()['GET /<unresolved>']
+        self.assertEqual(stats['duplicated_queries_max'], 1)
+
+    def test_streamed_responses_are_recorded_once_sent(self):
+        middleware = RequestProfilingMiddleware(self.stream_items)
+        response = middleware(RequestFactory().get('/items/'))
+        self.assertEqual(route_stats.summary(), {})
+
+        with self.settings(REQUEST_PROFILING_SLOW_MS=0), \
+                self.assertLogs('ecommerce.profiling', 'WARNING') as logs:
+            content = b''.join(response)
+        self.assertEqual(content, b'phone\n1\n')
+
+        line = json.loads(logs.records[0].getMessage())
+        self.assertTrue(line['streamed'])
+        self.assertEqual(line['queries'], 2)
+        self.assertEqual(line['response_bytes'], len(content))
+
+        # half sent: recorded when the server closes the response
+        response = middleware(RequestFactory().get('/items/'))
+        next(iter(response))
+        response.close()
+        self.assertEqual(route_stats.summary()['GET /<unresolved>']['requests'], 2)
+
+    def test_streamed_export(self):
+        staff = get_user_model().objects.create_user(
+            username='staff', password='password', is_staff=True)
+        client = APIClient()
+        client.force_authenticate(staff)
+
+        response = client.get(reverse('order-export'))
+        content = b''.join(response.streaming_content)
+
+        stats = route_stats.summary()
+        route = next(route for route in stats if 'export' in route)
+        self.assertGreater(stats[route]['queries_max'], 0)
+        self.assertEqual(stats[route]['response_bytes_mean'], len(content))
+
+    def test_percentile(self):
+        self.assertIsNone(percentile([], 50))
+        self.assertEqual(percentile([1, 2, 3, 4], 50), 2)
+        self.assertEqual(percentile([1, 2, 3, 4], 95), 4)
+        self.assertEqual(percentile([7], 99), 7)
+
+
+class HomePageTest(TestCase):
+    def get_page(self, query=''):
+        view = HomeView()
+        view.setup(RequestFactory().get('/' + query))
+        view.object_list = view.get_queryset()
+        return view.get_context_data()['object_list']
+
+    def test_only_the_page_rows_are_loaded(self):
+        items = [create_item(f'item-{index}') for index in range(6)]
+        self.assertEqual(self.get_page(), items[:4])
+
+        # the ids are cached: the second page loads its rows in one query
+        with CaptureQueriesContext(connection) as context:
+            page = self.get_page('?page=2')
+        self.assertEqual(page, items[4:])
+        self.assertEqual(sum('ecommerce_item' in query['sql'] for query in context.captured_queries), 1)
+
+
+class ImageHashTest(TestCase):
+    def test_removing_the_image_clears_its_derivatives(self):
+        item = create_item('phone')
+        Item.objects.filter(pk=item.pk).update(image='phone.png', image_hash='abc')
+        item.refresh_from_db()
+        self.assertIsNotNone(get_srcset(item.image_hash))
+
+        item.image = None
+        item.save()
+        self.assertEqual(Item.objects.get(pk=item.pk).image_hash, '')
+        self.assertEqual(item.image_hash, '')
+
+
+class AdminChangelistQueryCountTest(TestCase):
+    def setUp(self):
+        self.admin = get_user_model().objects.create_superuser(
+            username='admin', email='admin@example.com', password='password')
+        self.client.force_login(self.admin)
+
+    def create_orders(self, count):
+        start = Order.objects.count()
+        for index in range(start, start + count):
+            user = get_user_model().objects.create_user(
+                username=f'buyer-{index}', password='password')
+            address = Address.objects.create(
+                user=user, street_address='street', apartment_address='1', country='US',
+                zip='12345', address_type='B')
+            payment = Payment.objects.create(
+                stripe_charge_id=f'ch_{index}', user=user, amount=10.0)
+            Order.objects.create(
+                user=user, ordered=True, ordered_date=timezone.now(), billing_address=address,
+                shipping_address=address, payment=payment, ref_code=f'ref-{index}')
+
+    def count_changelist_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('admin:ecommerce_order_changelist'))
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def test_order_changelist_query_count_is_independent_of_rows(self):
+        self.create_orders(1)
+        small_count = self.count_changelist_queries()
+
+        self.create_orders(30)
+        self.assertEqual(small_count, self.count_changelist_queries())
+
+    def test_bulk_action_updates_every_selected_order(self):
+        self.create_orders(5)
+        response = self.client.post(reverse('admin:ecommerce_order_changelist'), {
+            'action': 'make_being_delivered',
+            '_selected_action': list(Order.objects.values_list('pk', flat=True))
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Order.objects.filter(being_delivered=True).count(), 5)
+
+
+class GuestCartTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username='buyer', password='password')
+        self.client = APIClient()
+
+    def test_guest_cart_is_merged_on_login(self):
+        phone = create_item('phone', discount_price=8.0)
+        create_item('case')
+        add_to_cart(self.user, phone, quantity=2)
+
+        with CaptureQueriesContext(connection) as context:
+            self.client.post(reverse('add-to-cart'),
+                             {'slug': 'phone'}, format='json')
+        self.assertEqual(len(context.captured_queries), 1)
+        self.client.post(reverse('add-to-cart'), {'slug': 'case'}, format='json')
+
+        response = self.client.get(reverse('order-summary'))
+        self.assertEqual(response.data['total'], 18.0)
+
+        response = self.client.post(
+            reverse('rest_login'), {'username': 'buyer', 'password': 'password'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.cookies['cart'].value, '')
+
+        order = Order.objects.with_items().get(user=self.user, ordered=False)
+        self.assertEqual(
+            sorted((line.item.slug, line.quantity) for line in order.items.all()),
+            [('case', 1), ('phone', 3)])
+        self.assertEqual((order.total, order.line_count), (34.0, 2))
+
+
+class HTMLAddToCartTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='buyer', password='password')
+        self.client.force_login(self.user)
+        self.item = create_item('phone')
+        color = Option.objects.create(item=self.item, name='color')
+        self.black = OptionValue.objects.create(option=color, value='black')
+        self.white = OptionValue.objects.create(option=color, value='white', default=True)
+
+    def get_options(self):
+        order_item = OrderItem.objects.get(user=self.user, ordered=False)
+        return list(order_item.item_options.values_list('pk', flat=True))
+
+    def test_links_add_the_default_options(self):
+        response = self.client.get(reverse('add-to-cart', args=['phone']))
+        self.assertRedirects(response, reverse('order-summary'), fetch_redirect_response=False)
+        self.assertEqual(self.get_options(), [self.white.pk])
+
+    def test_posted_options_are_used(self):
+        response = self.client.post(reverse('add-to-cart', args=['phone']), {'options': [self.black.pk]})
+        self.assertRedirects(response, reverse('order-summary'), fetch_redirect_response=False)
+        self.assertEqual(self.get_options(), [self.black.pk])
+
+    def test_options_without_default_must_be_picked(self):
+        OptionValue.objects.filter(pk=self.white.pk).update(default=False)
+        response = self.client.get(reverse('add-to-cart', args=['phone']))
+        self.assertRedirects(response, reverse('product', args=['phone']), fetch_redirect_response=False)
+        self.assertFalse(OrderItem.objects.exists())
+
+
+class CartBadgeTest(TestCase):
+    template = Template('{% load cart_template_tags %}{% cart_item_count %}')
+
+    def render(self, request):
+        return self.template.render(Context({'request': request}))
+
+    def test_badge_counts_the_guest_cart(self):
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        request.guest_cart = GuestCart({'1:': 2, '2:3': 1})
+        self.assertEqual(self.render(request), '2')
+
+    def test_badge_counts_the_saved_cart(self):
+        user = get_user_model().objects.create_user(username='buyer', password='password')
+        add_to_cart(user, create_item('phone'), quantity=2)
+        request = RequestFactory().get('/')
+        request.user = user
+        self.assertEqual(self.render(request), '1')
+
+
+class CartUpdateTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username='buyer', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def update(self, operations):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.patch(
+                reverse('cart'), {'operations': operations}, format='json')
+        return response, len(context.captured_queries)
+
+    def test_query_count_is_independent_of_operations(self):
+        items = [create_item(f'item-{i}') for i in range(6)]
+        lines = [add_to_cart(self.user, item)[0] for item in items[:3]]
+
+        response, few = self.update([
+            {'op': 'set', 'line': lines[0].pk, 'quantity': 2},
+            {'op': 'add', 'slug': 'item-3'}
+        ])
+        self.assertEqual(response.status_code, 200)
+
+        response, many = self.update([
+            {'op': 'set', 'line': lines[0].pk, 'quantity': 4},
+            {'op': 'set', 'line': lines[1].pk, 'quantity': 3},
+            {'op': 'remove', 'line': lines[2].pk},
+            {'op': 'add', 'slug': 'item-3', 'quantity': 2},
+            {'op': 'add', 'slug': 'item-4'}
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(many, few + 4)
+        self.assertEqual(response.data['total'], 110.0)
+
+        order = Order.objects.get(user=self.user, ordered=False)
+        self.assertEqual((order.total, order.line_count), (110.0, 4))
+
+    def test_failed_operation_changes_nothing(self):
+        line = add_to_cart(self.user, create_item('phone'))[0]
+
+        response, queries = self.update([
+            {'op': 'set', 'line': line.pk, 'quantity': 5},
+            {'op': 'add', 'slug': 'missing'}
+        ])
+        self.assertEqual(response.status_code, 400)
+
+        order = Order.objects.get(user=self.user, ordered=False)
+        self.assertEqual((order.total, order.items.get().quantity), (10.0, 1))
+
+
+class OrderTotalsTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='buyer', password='password')
+        self.phone = create_item('phone', discount_price=8.0)
+        color = Option.objects.create(item=self.phone, name='color')
+        self.black = OptionValue.objects.create(option=color, value='black')
+        self.gold = OptionValue.objects.create(option=color, value='gold', additional_price=2.5)
+        self.case = create_item('case', price=20.0)
+        Item.objects.filter(pk=self.case.pk).update(category='S')
+
+    def get_order(self):
+        return Order.objects.get(user=self.user, ordered=False)
+
+    def assert_totals(self):
+        # the totals kept up to date by the cart service match a full recomputation
+        order = self.get_order()
+        for field, value in order.calculate_totals().items():
+            self.assertAlmostEqual(getattr(order, field), value, places=2, msg=field)
+        return order
+
+    def test_incremental_totals(self):
+        add_to_cart(self.user, self.phone, [self.gold.pk], quantity=2)
+        self.assertEqual(self.assert_totals().total, 21.0)
+        add_to_cart(self.user, self.case)
+        self.assertEqual(self.assert_totals().line_count, 2)
+
+        apply_coupon(self.user, Coupon.objects.create(code='PHONES', kind='P', amount=10, category='P'))
+        self.assertEqual(self.assert_totals().coupon_amount, 2.1)
+        add_to_cart(self.user, self.phone, [self.gold.pk])
+        self.assert_totals()
+
+        subtract_from_cart(self.user, self.case)
+        self.assertEqual(self.assert_totals().line_count, 1)
+
+        apply_coupon(self.user, Coupon.objects.create(code='FIVE', amount=5))
+        self.assertEqual(self.assert_totals().coupon_amount, 5)
+
+        add_to_cart(self.user, self.phone, [self.black.pk])
+        remove_from_cart(self.user, self.phone, [self.gold.pk])
+        order = self.assert_totals()
+        self.assertEqual((order.subtotal, order.total, order.line_count), (8.0, 3.0, 1))
+
+        subtract_from_cart(self.user, self.phone, [self.black.pk])
+        order = self.assert_totals()
+        self.assertEqual((order.subtotal, order.coupon_amount, order.line_count), (0, 0, 0))
+
+    def recompute(self, *args):
+        out = io.StringIO()
+        call_command('recompute_order_totals', *args, stdout=out)
+        return out.getvalue()
+
+    def test_verify_reports_out_of_date_totals(self):
+        add_to_cart(self.user, self.phone, [self.gold.pk], quantity=2)
+        self.assertIn('All 1 orders are up to date', self.recompute('--verify'))
+
+        Order.objects.filter(user=self.user).update(total=999)
+        with self.assertRaisesMessage(CommandError, '1 of 1 orders have out of date totals'):
+            self.recompute('--verify')
+
+    def test_repair(self):
+        add_to_cart(self.user, self.phone, [self.gold.pk], quantity=2)
+        add_to_cart(self.user, self.case)
+        expected = self.get_order().calculate_totals()
+        Order.objects.filter(user=self.user).update(
+            subtotal=0, discount=0, coupon_amount=3, total=-3, line_count=7)
+
+        self.assertIn('Updated 1 of 1 orders and 0 lines', self.recompute('--batch-size', '1'))
+        order = self.get_order()
+        self.assertEqual({field: getattr(order, field) for field in expected}, expected)
+        self.assertIn('All 1 orders are up to date', self.recompute('--verify'))
+
+    def test_backfill_price_snapshots(self):
+        add_to_cart(self.user, self.phone, [self.gold.pk], quantity=2)
+        add_to_cart(self.user, self.case)
+        OrderItem.objects.filter(item=self.phone).update(
+            unit_price=None, final_unit_price=None, option_signature='')
+
+        with self.assertRaisesMessage(CommandError, '1 lines have no price snapshot'):
+            self.recompute('--verify')
+        self.assertIn('and 1 lines', self.recompute())
+
+        order_item = OrderItem.objects.get(item=self.phone)
+        self.assertEqual((order_item.unit_price, order_item.final_unit_price), (12.5, 10.5))
+        self.assertEqual(order_item.option_signature, get_option_signature([self.gold.pk]))
+        self.assertEqual(self.assert_totals().total, 41.0)
+
+
+class PricingTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username='buyer', password='password')
+        self.item = create_item('phone', discount_price=8.0)
+        color = Option.objects.create(item=self.item, name='color')
+        self.silver = OptionValue.objects.create(
+            option=color, value='silver', additional_price=5.0)
+
+    def test_option_surcharges_are_priced(self):
+        order_item, created = add_to_cart(self.user, self.item, [self.silver.pk], quantity=2)
+        self.assertEqual(order_item.get_unit_prices(), (15.0, 13.0))
+
+        order = Order.objects.with_items().get(user=self.user, ordered=False)
+        pricing = price_lines(order.items.all(), order.coupon)
+        self.assertEqual((pricing.subtotal, pricing.discount), (26.0, 4.0))
+        self.assertEqual((order.subtotal, order.discount, order.total), (26.0, 4.0, 26.0))
+
+    def test_unit_prices_are_cached_until_the_catalog_changes(self):
+        selection = [(self.item, [self.silver.pk])]
+        get_unit_prices(selection)
+
+        with self.assertNumQueries(0):
+            prices = get_unit_prices(selection)
+        self.assertEqual(list(prices.values()), [(15.0, 13.0)])
+
+        self.silver.additional_price = 7.0
+        self.silver.save()
+        self.assertEqual(list(get_unit_prices(selection).values()), [(17.0, 15.0)])
+
+
+class CouponTest(TestCase):
+    def setUp(self):
+        self.users = [
+            get_user_model().objects.create_user(username=f'buyer-{i}', password='password')
+            for i in range(2)
+        ]
+        self.phone = create_item('phone')
+        self.laptop = create_item('laptop', price=100.0)
+        self.laptop.category = 'L'
+        self.laptop.save()
+
+    def get_order(self, user):
+        return Order.objects.get(user=user, ordered=False)
+
+    def test_percentage_follows_the_cart(self):
+        coupon = Coupon.objects.create(code='TEN', kind='P', amount=10.0)
+        add_to_cart(self.users[0], self.phone, quantity=2)
+        apply_coupon(self.users[0], coupon)
+        self.assertEqual((self.get_order(self.users[0]).coupon_amount,
+                         self.get_order(self.users[0]).total), (2.0, 18.0))
+
+        add_to_cart(self.users[0], self.laptop)
+        order = self.get_order(self.users[0])
+        self.assertEqual((order.coupon_amount, order.total), (12.0, 108.0))
+
+    def test_category_and_minimum_spend_rules(self):
+        coupon = Coupon.objects.create(
+            code='LAPTOPS', kind='P', amount=50.0, category='L', minimum_spend=50.0)
+        add_to_cart(self.users[0], self.phone)
+
+        with self.assertRaises(CartError):
+            apply_coupon(self.users[0], coupon)
+
+        add_to_cart(self.users[0], self.laptop)
+        apply_coupon(self.users[0], coupon)
+        order = Order.objects.with_items().get(user=self.users[0], ordered=False)
+        self.assertEqual((order.coupon_amount, order.total), (50.0, 60.0))
+        self.assertEqual(price_lines(order.items.all(), order.coupon).total, 60.0)
+
+    def test_usage_limit(self):
+        coupon = Coupon.objects.create(code='ONCE', amount=5.0, max_uses=1)
+        other = Coupon.objects.create(code='OTHER', amount=1.0)
+        for user in self.users:
+            add_to_cart(user, self.phone)
+
+        apply_coupon(self.users[0], coupon)
+        apply_coupon(self.users[0], coupon)
+        with self.assertRaises(CartError):
+            apply_coupon(self.users[1], coupon)
+
+        # replacing the coupon gives its use back
+        apply_coupon(self.users[0], other)
+        apply_coupon(self.users[1], coupon)
+        coupon.refresh_from_db()
+        self.assertEqual(coupon.used, 1)
+
+
+class InventoryTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username='buyer', password='password')
+        self.address = Address.objects.create(
+            user=self.user, street_address='1 Street', apartment_address='1',
+            country='US', zip='12345', address_type='B', default=True)
+        self.item = create_item('phone')
+
+    def checkout(self):
+        return create_payment_intent(self.user, 'tok_visa', billing_address_id=self.address.pk)
+
+    def test_checkout_reserves_and_failure_releases(self):
+        set_stock(self.item, [], 3)
+        add_to_cart(self.user, self.item, quantity=2)
+
+        self.checkout()
+        self.assertEqual(get_available(self.item), 1)
+
+        self.assertTrue(fail_intent(claim_next_intent(), 'declined'))
+        self.assertEqual(get_available(self.item), 3)
+        self.assertFalse(Reservation.objects.exists())
+
+    def test_checkout_fails_when_out_of_stock(self):
+        set_stock(self.item, [], 1)
+        add_to_cart(self.user, self.item, quantity=2)
+
+        with self.assertRaises(CartError):
+            self.checkout()
+        self.assertEqual(get_available(self.item), 1)
+
+    def test_expired_carts_release_their_units(self):
+        set_stock(self.item, [], 3)
+        add_to_cart(self.user, self.item, quantity=2)
+        intent = self.checkout()
+        intent.status = 'F'
+        intent.save()
+
+        expire_carts(timezone.now() + timedelta(days=1))
+        self.assertEqual(get_available(self.item), 3)
+
+
+class BatchBudget(Budget):
+    # exhausted once the given number of batches were started
+    def __init__(self, batches):
+        super().__init__()
+        self.batches = batches
+
+    @property
+    def exhausted(self):
+        self.batches -= 1
+        return self.batches < 0
+
+
+class MaintenanceTest(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.idle_user = User.objects.create_user(username='idle', password='password')
+        self.active_user = User.objects.create_user(username='active', password='password')
+        self.item = create_item('phone')
+        self.now = timezone.now()
+
+    def fill_cart(self, user, days_idle=0):
+        add_to_cart(user, self.item, quantity=2)
+        order = Order.objects.get(user=user, ordered=False)
+        Order.objects.filter(pk=order.pk).update(updated=self.now - timedelta(days=days_idle))
+        return order
+
+    def create_received_order(self, user, days_ago, refund_requested=False):
+        order = self.fill_cart(user)
+        payment = Payment.objects.create(stripe_charge_id=f'ch_{order.pk}', user=user, amount=20.0)
+        Order.objects.filter(pk=order.pk).update(
+            ordered=True, received=True, payment=payment, ref_code=f'ref-{order.pk}',
+            refund_requested=refund_requested, ordered_date=self.now - timedelta(days=days_ago))
+        return order
+
+    def test_expire_idle_carts_releases_their_coupon_uses(self):
+        coupon = Coupon.objects.create(code='SALE', amount=5.0, max_uses=10)
+        idle = self.fill_cart(self.idle_user, days_idle=40)
+        apply_coupon(self.idle_user, coupon)
+        Order.objects.filter(pk=idle.pk).update(updated=self.now - timedelta(days=40))
+        active = self.fill_cart(self.active_user)
+
+        totals = expire_carts(self.now - timedelta(days=30))
+        # the line, its link to the order and the order
+        self.assertEqual(totals, {'objects': 1, 'rows': 3})
+        self.assertFalse(Order.objects.filter(pk=idle.pk).exists())
+        self.assertFalse(OrderItem.objects.filter(user=self.idle_user).exists())
+        self.assertTrue(Order.objects.filter(pk=active.pk).exists())
+        coupon.refresh_from_db()
+        self.assertEqual(coupon.used, 0)
+
+    def test_expire_skips_carts_being_paid(self):
+        address = Address.objects.create(
+            user=self.idle_user, street_address='1 Street', apartment_address='1',
+            country='US', zip='12345', address_type='B', default=True)
+        set_stock(self.item, [], 5)
+        order = self.fill_cart(self.idle_user)
+        intent = create_payment_intent(self.idle_user, 'tok_visa', billing_address_id=address.pk)
+        Order.objects.filter(pk=order.pk).update(updated=self.now - timedelta(days=40))
+
+        expire_carts(self.now - timedelta(days=30))
+        self.assertTrue(Order.objects.filter(pk=order.pk).exists())
+        self.assertEqual(get_available(self.item), 3)
+
+        # once the payment failed the cart and its stock are reclaimed
+        PaymentIntent.objects.filter(pk=intent.pk).update(status=FAILED)
+        expire_carts(self.now - timedelta(days=30))
+        self.assertFalse(Order.objects.filter(pk=order.pk).exists())
+        self.assertEqual(get_available(self.item), 5)
+
+    def test_delete_orphan_lines(self):
+        self.fill_cart(self.active_user)
+        orphan = OrderItem.objects.create(user=self.idle_user, item=self.item)
+
+        self.assertEqual(delete_orphan_lines(), {'objects': 1, 'rows': 1})
+        self.assertFalse(OrderItem.objects.filter(pk=orphan.pk).exists())
+        self.assertEqual(OrderItem.objects.count(), 1)
+
+    def test_archive_old_received_orders(self):
+        old = self.create_received_order(self.idle_user, days_ago=400)
+        Refund.objects.create(order=old, reason='broken', accepted=False, email='a@example.com')
+        disputed = self.create_received_order(self.active_user, days_ago=400, refund_requested=True)
+        recent = self.create_received_order(self.idle_user, days_ago=10)
+
+        totals = archive_orders(self.now - timedelta(days=365))
+        self.assertEqual(totals['objects'], 1)
+        self.assertEqual(list(Order.objects.order_by('pk').values_list('pk', flat=True)),
+                         [disputed.pk, recent.pk])
+        self.assertTrue(Payment.objects.filter(stripe_charge_id=f'ch_{old.pk}').exists())
+
+        archived = ArchivedOrder.objects.get(order_id=old.pk)
+        data = json.loads(archived.data)
+        self.assertEqual(archived.ref_code, f'ref-{old.pk}')
+        self.assertEqual(data['lines'][0]['quantity'], 2)
+        self.assertEqual(data['refunds'], [{'reason': 'broken', 'accepted': False, 'email': 'a@example.com'}])
+
+    def test_time_budget_stops_between_batches(self):
+        for index in range(3):
+            OrderItem.objects.create(user=self.idle_user, item=self.item)
+
+        self.assertEqual(delete_orphan_lines(batch_size=1, budget=BatchBudget(2))['objects'], 2)
+        self.assertEqual(OrderItem.objects.count(), 1)
+        self.assertEqual(delete_orphan_lines(batch_size=1, budget=Budget(0))['objects'], 0)
+
+    def test_command(self):
+        self.fill_cart(self.idle_user, days_idle=40)
+        OrderItem.objects.create(user=self.active_user, item=self.item)
+
+        stdout = io.StringIO()
+        call_command('cleanup_orders', '--dry-run', stdout=stdout)
+        self.assertEqual(stdout.getvalue().strip(),
+                         '1 idle carts, 1 orphaned lines and 0 orders to archive')
+
+        stdout = io.StringIO()
+        call_command('cleanup_orders', stdout=stdout)
+        self.assertIn('Reclaimed 4 rows', stdout.getvalue())
+        self.assertFalse(OrderItem.objects.exists())
+
+
+class FlakyGateway(FakeGateway):
+    def charge(self, intent):
+        raise PaymentError('Network error', retryable=True)
+
+
+class PaymentWorkerTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username='buyer', password='password')
+        self.address = Address.objects.create(
+            user=self.user, street_address='1 Street', apartment_address='1',
+            country='US', zip='12345', address_type='B', default=True)
+        self.item = create_item('phone')
+        add_to_cart(self.user, self.item)
+        self.gateway = FakeGateway()
+
+    def checkout(self, token='tok_visa'):
+        return create_payment_intent(self.user, token, billing_address_id=self.address.pk)
+
+    def get_status(self, intent):
+        return PaymentIntent.objects.values_list('status', flat=True).get(pk=intent.pk)
+
+    def test_charge_finalizes_the_order(self):
+        intent = self.checkout()
+        self.assertEqual(process_pending_intents(self.gateway), 1)
+
+        self.assertEqual(self.get_status(intent), SUCCEEDED)
+        order = Order.objects.get(pk=intent.order_id)
+        self.assertTrue(order.ordered)
+        self.assertEqual(order.payment.amount, 10.0)
+
+    def test_cart_is_frozen_during_checkout(self):
+        intent = self.checkout()
+
+        with self.assertRaises(CartError):
+            add_to_cart(self.user, self.item, quantity=3)
+        with self.assertRaises(CartError):
+            update_cart(self.user, parse_operations([{'op': 'add', 'slug': self.item.slug}]))
+        # submitting again returns the checkout in progress
+        self.assertEqual(self.checkout().pk, intent.pk)
+
+        process_pending_intents(self.gateway)
+        self.assertEqual(Order.objects.get(pk=intent.order_id).total, 10.0)
+        add_to_cart(self.user, self.item)
+
+    def test_changed_total_is_refunded(self):
+        intent = self.checkout()
+        Order.objects.filter(pk=intent.order_id).update(total=1510.0)
+
+        process_pending_intents(self.gateway)
+        self.assertEqual(self.get_status(intent), FAILED)
+        self.assertEqual(len(self.gateway.refunds), 1)
+        self.assertFalse(Order.objects.get(pk=intent.order_id).ordered)
+        self.assertFalse(Payment.objects.exists())
+
+    def test_declined_charge_fails(self):
+        intent = self.checkout('tok_chargeDeclined')
+        process_pending_intents(self.gateway)
+
+        self.assertEqual(self.get_status(intent), FAILED)
+        self.assertFalse(Order.objects.get(pk=intent.order_id).ordered)
+        add_to_cart(self.user, self.item)
+
+    def test_idempotency_keys(self):
+        intent = create_payment_intent(
+            self.user, 'tok_visa', billing_address_id=self.address.pk, idempotency_key='key-1')
+        self.assertEqual(create_payment_intent(
+            self.user, 'tok_visa', billing_address_id=self.address.pk, idempotency_key='key-1').pk,
+            intent.pk)
+
+        other = get_user_model().objects.create_user(username='other', password='password')
+        address = Address.objects.create(
+            user=other, street_address='1 Street', apartment_address='1',
+            country='US', zip='12345', address_type='B', default=True)
+        set_stock(self.item, [], 5)
+        add_to_cart(other, self.item)
+
+        client = APIClient()
+        client.force_authenticate(other)
+        for key in ['key-1', 'x' * 65, 'not a key']:
+            with self.subTest(key=key):
+                response = client.post(reverse('checkout'), {
+                    'stripeToken': 'tok_visa', 'defaultBillingAddress': address.pk
+                }, format='json', HTTP_IDEMPOTENCY_KEY=key)
+                self.assertEqual(response.status_code, 400)
+
+        # nothing was reserved for the rejected checkouts
+        self.assertEqual(get_available(self.item), 5)
+        self.assertFalse(PaymentIntent.objects.filter(user=other).exists())
+
+    def test_claim_is_exclusive(self):
+        intent = self.checkout()
+
+        claimed = claim_next_intent()
+        self.assertEqual(claimed.pk, intent.pk)
+        self.assertEqual(self.get_status(intent), PROCESSING)
+        self.assertIsNone(claim_next_intent())
+
+    def test_retryable_errors_are_retried_until_the_limit(self):
+        intent = self.checkout()
+
+        with self.settings(PAYMENT_INTENT_MAX_ATTEMPTS=2):
+            process_intent(claim_next_intent(), FlakyGateway())
+            self.assertEqual(self.get_status(intent), PENDING)
+
+            process_intent(claim_next_intent(), FlakyGateway())
+            self.assertEqual(self.get_status(intent), FAILED)
+
+        self.assertEqual(PaymentIntent.objects.get(pk=intent.pk).attempts, 2)
+
+    def test_expired_lease_cannot_overwrite_the_new_worker(self):
+        intent = self.checkout()
+        first = claim_next_intent()
+
+        # the first worker stalls past its lease, a second one takes over and finishes
+        PaymentIntent.objects.filter(pk=intent.pk).update(
+            updated=timezone.now() - timedelta(days=1))
+        self.assertEqual(release_stale_intents(), 1)
+        second = claim_next_intent()
+        process_intent(second, self.gateway)
+        self.assertEqual(self.get_status(intent), SUCCEEDED)
+
+        # the first worker's charge replays the same one: no failure, refund or second payment
+        process_intent(first, self.gateway)
+        self.assertFalse(fail_intent(first, 'late'))
+        self.assertEqual(self.get_status(intent), SUCCEEDED)
+        self.assertEqual(self.gateway.refunds, [])
+        self.assertEqual(Payment.objects.count(), 1)
+        self.assertTrue(Order.objects.get(pk=intent.order_id).ordered)
+
+
+class AddToCartConcurrencyTest(TransactionTestCase):
+    def test_concurrent_adds_of_the_same_selection_make_one_line(self):
+        user = get_user_model().objects.create_user(username='buyer', password='password')
+        item = create_item('phone')
+        color = Option.objects.create(item=item, name='color')
+        black = OptionValue.objects.create(option=color, value='black')
+
+        outcomes, elapsed = run_concurrently(add_to_cart, [(user, item, [black.pk])] * 2, threads=2)
+        self.assertEqual([result for result, duration, retries in outcomes
+                          if isinstance(result, Exception)], [])
+
+        order_item = OrderItem.objects.get(user=user, ordered=False)
+        self.assertEqual(order_item.quantity, 2)
+        self.assertEqual(Order.objects.get(user=user, ordered=False).line_count, 1)
+
+
+class InventoryConcurrencyTest(TransactionTestCase):
+    checkouts = 200
+    units = 50
+
+    def test_no_oversell_under_parallel_checkouts(self):
+        item = create_item('best-seller')
+        item.label = 'B'
+        item.save()
+        set_stock(item, [], self.units)
+
+        User = get_user_model()
+        User.objects.bulk_create([User(username=f'buyer-{i}') for i in range(self.checkouts)])
+        users = list(User.objects.order_by('pk'))
+        Address.objects.bulk_create([
+            Address(user=user, street_address='1 Street', apartment_address='1',
+                    country='US', zip='12345', address_type='B', default=True)
+            for user in users
+        ])
+        addresses = dict(Address.objects.values_list('user_id', 'pk'))
+        for index, user in enumerate(users):
+            add_to_cart(user, item, quantity=1 + (index % 3 == 0))
+
+        outcomes, elapsed = run_concurrently(create_payment_intent, [
+            (user, 'tok_visa', addresses[user.pk]) for user in users
+        ], threads=8)
+
+        errors = [result for result, duration, retries in outcomes if isinstance(result, Exception)]
+        self.assertTrue(all(isinstance(error, CartError) for error in errors), errors)
+        self.assertLess(len(errors), self.checkouts)
+
+        reserved = Reservation.objects.aggregate(units=Sum('quantity'))['units']
+        self.assertEqual(reserved + get_available(item), self.units)
+        self.assertEqual(Stock.objects.filter(item=item).count(), 8)
+
+        # every successful checkout holds exactly the units of its cart
+        for intent, duration, retries in outcomes:
+            if not isinstance(intent, Exception):
+                self.assertEqual(
+                    Reservation.objects.filter(order=intent.order_id).aggregate(
+                        units=Sum('quantity'))['units'],
+                    OrderItem.objects.get(order=intent.order_id).quantity)
+
+
+class RecordingASGIHandler(ReadPathASGIHandler):
+    def __init__(self):
+        super().__init__()
+        self.threads = []
+
+    def get_read_response(self, request):
+        self.threads.append(threading.current_thread().name)
+        return super().get_read_response(request)
+
+
+class ReadPathASGITest(TransactionTestCase):
+    def setUp(self):
+        user = get_user_model().objects.create_user(username='reader', password='password')
+        self.user_id = user.pk
+        self.token = Token.objects.create(user=user).key
+        self.handler = RecordingASGIHandler()
+        self.addCleanup(self.handler.executor.shutdown)
+
+    def request(self, method, path):
+        scope = {
+            'type': 'http',
+            'method': method,
+            'path': path,
+            'query_string': b'',
+            'headers': [(b'host', b'testserver'),
+                        (b'authorization', f'Token {self.token}'.encode())]
+        }
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        asyncio.run(self.handler(scope, receive, send))
+        body = b''.join(message.get('body', b'') for message in messages[1:])
+        return messages[0]['status'], body
+
+    def test_read_endpoints_run_in_the_pool(self):
+        status, body = self.request('GET', '/api/user/id/')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body), {'userID': self.user_id})
+        self.assertEqual(len(self.handler.threads), 1)
+        self.assertTrue(self.handler.threads[0].startswith('asgi-read'))
+
+    def test_other_requests_keep_the_default_path(self):
+        status, body = self.request('POST', '/api/add-coupon/')
+        self.assertEqual(status, 400)
+        self.assertEqual(self.handler.threads, [])
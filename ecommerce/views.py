@@ -1,35 +1,76 @@
-from django.conf import settings
 from django.shortcuts import render, get_object_or_404, redirect
 from django.core.exceptions import ObjectDoesNotExist
 from django.contrib import messages
-from django.contrib.auth.decorators import login_required
-from django.contrib.auth.mixins import LoginRequiredMixin
-from django.utils import timezone
+from django.db.models import Count
+from django.utils.http import urlencode
 from django.views.generic import ListView, DetailView, View
 
-from .models import Item, OrderItem, Order, Address, Payment, Coupon, Refund
+from . import cart, coupons, facets
+from .cart import CartError
+from .catalog import get_cached
+from .checkout import create_payment_intent
+from .models import Item, Order, Address, Refund
+from .pricing import price_lines
 from .forms import CheckoutForm, CouponForm, RefundForm
 
-import random
-import string
-
-import stripe
-stripe.api_key = settings.STRIPE_SECRET_KEY
-
 
 class HomeView(ListView):
     model = Item
     paginate_by = 4
     template_name = "home.html"
 
+    def get_queryset(self):
+        self.filters = facets.get_filters(self.request.GET)
+
+        # only the ids are cached, replaced as soon as the catalog version changes
+        return get_cached(
+            'home-item-ids',
+            urlencode(self.filters, doseq=True),
+            lambda: list(facets.filter_items(
+                Item.objects.order_by('id'), self.filters).values_list('pk', flat=True))
+        )
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator, page, object_list, is_paginated = super().paginate_queryset(
+            queryset, page_size)
+
+        # rows of the current page only, in the order of the ids
+        items = Item.objects.in_bulk(page.object_list)
+        page.object_list = [items[pk] for pk in page.object_list if pk in items]
+        return paginator, page, page.object_list, is_paginated
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['facets'] = facets.get_facet_counts()
+        context['filters'] = self.filters
+        # appended to the pagination links to keep the selection
+        context['filter_query'] = urlencode(self.filters, doseq=True)
+        return context
+
 
-class OrderSummaryView(LoginRequiredMixin, View):
-    # LoginRequiredMixin : if required, redirects to the login page first == @login_required
+class OrderSummaryView(View):
     def get(self, *args, **kwargs):
+        # visitors see the cart of their cookie, as unsaved order lines
+        if not self.request.user.is_authenticated:
+            guest_cart = self.request.guest_cart
+            if not guest_cart.lines:
+                messages.warning(self.request, "You do not have an active order")
+                return redirect("/")
+
+            context = {
+                'order': None,
+                'guest_lines': guest_cart.get_lines(),
+                'guest_total': guest_cart.get_total(),
+                'pricing': price_lines(guest_cart.get_lines())
+            }
+            return render(self.request, "order_summary.html", context)
+
         try:
-            order = Order.objects.get(user=self.request.user, ordered=False)
+            order = Order.objects.with_items().get(
+                user=self.request.user, ordered=False)
             context = {
-                'order': order
+                'order': order,
+                'pricing': price_lines(order.items.all(), order.coupon)
             }
             return render(self.request, "order_summary.html", context)
 
@@ -42,99 +83,73 @@ class ItemDetailView(DetailView):
     model = Item
     template_name = "product.html"
 
+    def get_object(self, queryset=None):
+        return get_cached(
+            'item', self.kwargs['slug'],
+            lambda: super(ItemDetailView, self).get_object(queryset)
+        )
+
 
-@login_required
 def add_to_cart(request, slug):
-    item = get_object_or_404(Item, slug=slug)
-    # get_or_create : returns a tuple
-    order_item, created = OrderItem.objects.get_or_create(
-        item=item, user=request.user, ordered=False)
-    # retrieve the cart items which is not ordered yet, from the explicit user
-    order_queryset = Order.objects.filter(user=request.user, ordered=False)
-
-    if order_queryset.exists():
-        order = order_queryset[0]
-        # if the item is in the cart
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item.quantity += 1
-            order_item.save()
-            messages.info(request, "This item quantity was updated")
-            return redirect('order-summary')
+    item = get_object_or_404(
+        Item.objects.annotate(option_count=Count('option')), slug=slug)
 
+    # the options picked on the product page, or the default value of each option
+    # for the links that cannot send them
+    option_ids = request.POST.getlist('options') or request.GET.getlist('options')
+    if not option_ids and item.option_count:
+        option_ids = cart.get_default_options(item)
+
+    try:
+        if request.user.is_authenticated:
+            order_item, created = cart.add_to_cart(request.user, item, option_ids)
         else:
-            order.items.add(order_item)
-            messages.info(request, "This item was added to your cart")
-            return redirect('order-summary')
+            created = request.guest_cart.add(item, option_ids)
 
-    else:
-        ordered_date = timezone.now()
-        order = Order.objects.create(
-            user=request.user, ordered_date=ordered_date
-        )
-        order.items.add(order_item)
+    except CartError as e:
+        messages.warning(request, str(e))
+        return redirect('product', slug=slug)
+
+    if created:
         messages.info(request, "This item was added to your cart")
-        return redirect('order-summary')
+    else:
+        messages.info(request, "This item quantity was updated")
+    return redirect('order-summary')
 
 
-@login_required
 def remove_from_cart(request, slug):
     item = get_object_or_404(Item, slug=slug)
-    order_queryset = Order.objects.filter(user=request.user, ordered=False)
-
-    # if an active cart exists
-    if order_queryset.exists():
-        order = order_queryset[0]
-        # if the item is in the cart
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item = OrderItem.objects.filter(
-                item=item, user=request.user, ordered=False
-            )[0]
-            order.items.remove(order_item)
-            order_item.quantity = 1
-            order_item.save()
-            messages.info(request, "This item was removed from your cart")
-            return redirect('order-summary')
 
+    try:
+        if request.user.is_authenticated:
+            cart.remove_from_cart(request.user, item)
         else:
-            messages.warning(request, "This item is not in your cart")
-            return redirect('order-summary')
+            request.guest_cart.remove(item)
 
-    else:
-        messages.warning(request, "You do not have an active order")
+    except CartError as e:
+        messages.warning(request, str(e))
         return redirect('order-summary')
 
+    messages.info(request, "This item was removed from your cart")
+    return redirect('order-summary')
+
 
-@login_required
 def remove_single_item_from_cart(request, slug):
     item = get_object_or_404(Item, slug=slug)
-    order_queryset = Order.objects.filter(user=request.user, ordered=False)
-
-    # if an active cart exists
-    if order_queryset.exists():
-        order = order_queryset[0]
-        # if the item is in the cart
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item = OrderItem.objects.filter(
-                item=item, user=request.user, ordered=False
-            )[0]
-
-            if order_item.quantity > 1:
-                order_item.quantity -= 1
-                order_item.save()
-            else:
-                order.items.remove(order_item)
-
-            messages.info(request, 'This items quantity was updated')
-            return redirect('order-summary')
 
+    try:
+        if request.user.is_authenticated:
+            cart.subtract_from_cart(request.user, item)
         else:
-            messages.warning(request, 'This item is not in your cart')
-            return redirect('product', slug=slug)
+            request.guest_cart.subtract(item)
 
-    else:
-        messages.warning(request, 'You do not have an active order')
+    except CartError as e:
+        messages.warning(request, str(e))
         return redirect('product', slug=slug)
 
+    messages.info(request, 'This items quantity was updated')
+    return redirect('order-summary')
+
 
 # check if every field was entered
 def is_valid_form(*values):
@@ -204,7 +219,7 @@ class CheckoutView(View):
                     if shipping_address_queryset.exists():
                         shipping_address = shipping_address_queryset[0]
                         order.shipping_address = shipping_address
-                        order.save()
+                        order.save(update_fields=['shipping_address'])
                     else:
                         messages.info(
                             self.request, 'No default shipping address available.')
@@ -233,12 +248,16 @@ class CheckoutView(View):
 
                         # save the shipping address to the order
                         order.shipping_address = shipping_address
-                        order.save()
+                        order.save(update_fields=['shipping_address'])
 
                         # if checked, set shipping address to default address
                         set_default_shipping = form.cleaned_data.get(
                             'set_default_shipping')
                         if set_default_shipping:
+                            # at most one default address per type
+                            Address.objects.filter(
+                                user=self.request.user, address_type='S', default=True
+                            ).update(default=False)
                             shipping_address.default = True
                             shipping_address.save()
 
@@ -258,11 +277,11 @@ class CheckoutView(View):
                 if same_billing_address:
                     billing_address = shipping_address
                     billing_address.pk = None
-                    billing_address.save()
                     billing_address.address_type = 'B'
+                    billing_address.default = False
                     billing_address.save()
                     order.billing_address = billing_address
-                    order.save()
+                    order.save(update_fields=['billing_address'])
 
                 elif use_default_billing:
                     # Using the default billing address
@@ -274,7 +293,7 @@ class CheckoutView(View):
                     if billing_address_queryset.exists():
                         billing_address = billing_address_queryset[0]
                         order.billing_address = billing_address
-                        order.save()
+                        order.save(update_fields=['billing_address'])
                     else:
                         messages.info(
                             self.request, 'No default billing address available.')
@@ -302,12 +321,15 @@ class CheckoutView(View):
 
                         # save the billing address to the order
                         order.billing_address = billing_address
-                        order.save()
+                        order.save(update_fields=['billing_address'])
 
                         # if checked, set billing address to default address
                         set_default_billing = form.cleaned_data.get(
                             'set_default_billing')
                         if set_default_billing:
+                            Address.objects.filter(
+                                user=self.request.user, address_type='B', default=True
+                            ).update(default=False)
                             billing_address.default = True
                             billing_address.save()
 
@@ -334,11 +356,6 @@ class CheckoutView(View):
             return redirect('order-summary')
 
 
-def create_ref_code():
-    # create a random ordered char + number code which the length is 20
-    return ''.join(random.choices(string.ascii_lowercase + string.digits, k=20))
-
-
 class PaymentView(View):
     def get(self, *args, **kwargs):
         order = Order.objects.get(user=self.request.user, ordered=False)
@@ -356,83 +373,26 @@ class PaymentView(View):
             return redirect('checkout')
 
     def post(self, *args, **kwargs):
-        order = Order.objects.get(user=self.request.user, ordered=False)
-        token = self.request.POST.get('stripeToken')
-        amount = int(order.get_total() * 100)  # cents
-
+        # the charge is made by the payment worker
         try:
-            charge = stripe.Charge.create(
-                amount=amount,
-                currency='usd',
-                source=token,
-            )
-
-            # create the payment
-            payment = Payment(
-                stripe_charge_id=charge['id'],
-                user=self.request.user,
-                amount=order.get_total()
-            )
-            payment.save()
-
-            # assign the payment to the order
-            order_items = order.items.all()
-            order_items.update(ordered=True)
-            for item in order_items:
-                item.save()
-
-            order.ordered = True
-            order.payment = payment
-
-            # assign reference code
-            order.ref_code = create_ref_code()
-            order.save()
+            create_payment_intent(
+                self.request.user, self.request.POST.get('stripeToken'))
+            messages.info(self.request, 'Your payment is being processed.')
 
-            messages.success(self.request, 'Your order was successful!')
-            return redirect('/')
+        except CartError as e:
+            messages.warning(self.request, str(e))
 
-        # stripe exceptions
-        except stripe.error.CardError as e:
-            body = e.json_body
-            err = body.get('error', {})
-            messages.warning(self.request, f"{err.get('message')}")
-            return redirect('/')
-
-        except stripe.error.RateLimitError as e:
-            messages.warning(self.request, 'Rate limit error.')
-            return redirect('/')
-
-        except stripe.error.InvalidRequestError as e:
-            messages.warning(self.request, 'Invalid parameters.')
-            return redirect('/')
-
-        except stripe.error.AuthenticationError as e:
-            messages.warning(self.request, 'Not authenticated.')
-            return redirect('/')
-
-        except stripe.error.APIConnectionError as e:
-            messages.warning(self.request, 'Network error.')
-            return redirect('/')
-
-        except stripe.error.StripeError as e:
-            messages.warning(
-                self.request, 'Something went wrong. You are not charged. Please try again.')
-            return redirect('/')
-
-        except Exception as e:
-            messages.warning(
-                self.request, 'A serious error occurred. We have been notified.')
-            return redirect('/')
+        return redirect('/')
 
 
 def get_coupon(request, code):
-    try:
-        coupon = Coupon.objects.get(code=code)
-        return coupon
+    coupon = coupons.get_coupon(code)
 
-    except ObjectDoesNotExist:
+    if coupon is None:
         raise ValueError
 
+    return coupon
+
 
 class AddCouponView(View):
     def post(self, *args, **kwargs):
@@ -441,16 +401,13 @@ class AddCouponView(View):
         if form.is_valid():
             try:
                 code = form.cleaned_data.get('code')
-                order = Order.objects.get(
-                    user=self.request.user, ordered=False)
-                order.coupon = get_coupon(self.request, code)
-                order.save()
+                cart.apply_coupon(self.request.user,
+                                  get_coupon(self.request, code))
                 messages.info(self.request, 'Successfully adding coupon.')
                 return redirect('checkout')
 
-            except ObjectDoesNotExist:
-                messages.warning(
-                    self.request, 'You do not have an active order.')
+            except CartError as e:
+                messages.warning(self.request, str(e))
                 return redirect('checkout')
 
             except ValueError:
@@ -478,7 +435,7 @@ class RequestRefundView(View):
                 # edit the order
                 order = Order.objects.get(ref_code=ref_code)
                 order.refund_requested = True
-                order.save()
+                order.save(update_fields=['refund_requested'])
 
                 # store the refund
                 refund = Refund(